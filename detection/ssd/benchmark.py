@@ -0,0 +1,191 @@
+"""Micro-benchmarks of SSD utility functions
+
+python3 benchmark.py --iou
+python3 benchmark.py --backbones
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import timeit
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import backend as K
+from tensorflow.keras.layers import Conv2D, DepthwiseConv2D, Dense
+from tensorflow.keras.models import Model
+
+import layer_utils
+from resnet import build_resnet
+from mobilenet import build_mobilenet
+
+
+def tiled_iou(boxes1, boxes2):
+    """IoU using np.tile copies of boxes (previous implementation)
+    kept as a baseline for benchmarking"""
+    m = boxes1.shape[0]
+    n = boxes2.shape[0]
+
+    boxes1_min = np.tile(np.expand_dims(boxes1[:, [0, 2]], axis=1), (1, n, 1))
+    boxes2_min = np.tile(np.expand_dims(boxes2[:, [0, 2]], axis=0), (m, 1, 1))
+    min_xy = np.maximum(boxes1_min, boxes2_min)
+    boxes1_max = np.tile(np.expand_dims(boxes1[:, [1, 3]], axis=1), (1, n, 1))
+    boxes2_max = np.tile(np.expand_dims(boxes2[:, [1, 3]], axis=0), (m, 1, 1))
+    max_xy = np.minimum(boxes1_max, boxes2_max)
+    side_lengths = np.maximum(0, max_xy - min_xy)
+    intersection_areas = side_lengths[:, :, 0] * side_lengths[:, :, 1]
+
+    areas1 = (boxes1[:, 1] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 2])
+    areas2 = (boxes2[:, 1] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 2])
+    union_areas = np.tile(np.expand_dims(areas1, axis=1), (1, n))
+    union_areas = union_areas + np.tile(np.expand_dims(areas2, axis=0), (m, 1))
+    union_areas -= intersection_areas
+    return intersection_areas / union_areas
+
+
+def random_boxes(n, width=640, height=480, seed=0):
+    """Random boxes in minmax format"""
+    rng = np.random.RandomState(seed)
+    x = rng.uniform(0, width, (n, 2))
+    y = rng.uniform(0, height, (n, 2))
+    return np.stack([x.min(axis=1), x.max(axis=1),
+                     y.min(axis=1), y.max(axis=1)], axis=1)
+
+
+def time_it(func, repeat=5, number=3):
+    """Best time per call in msec"""
+    times = timeit.repeat(func, repeat=repeat, number=number)
+    return 1000 * min(times) / number
+
+
+def latencies(func, runs=100, warmup=10):
+    """Latency of each call in msec after warmup calls"""
+    for _ in range(warmup):
+        func()
+    times = np.empty(runs)
+    for i in range(runs):
+        start = timeit.default_timer()
+        func()
+        times[i] = 1000 * (timeit.default_timer() - start)
+    return times
+
+
+def print_latencies(name, times):
+    """Print p50 and p99 latencies in msec"""
+    print("%-20s p50 %8.2fms  p99 %8.2fms  mean %8.2fms" 
+          % (name,
+             np.percentile(times, 50),
+             np.percentile(times, 99),
+             np.mean(times)))
+
+
+def check_iou(m=1624, n=8, max_bytes=(1 << 10)):
+    """Integer and float boxes give the same IoUs"""
+    boxes1 = np.round(random_boxes(m, seed=1))
+    boxes2 = np.round(random_boxes(n, seed=2))
+    ious = layer_utils.iou(boxes1, boxes2)
+    int_boxes1 = boxes1.astype(int)
+    int_boxes2 = boxes2.astype(int)
+    assert np.allclose(ious, layer_utils.iou(int_boxes1, int_boxes2))
+    assert np.allclose(ious, layer_utils.iou(int_boxes1,
+                                             int_boxes2,
+                                             max_bytes=max_bytes))
+    assert np.allclose(np.diagonal(ious[:n]),
+                       layer_utils.paired_iou(int_boxes1[:n], int_boxes2))
+
+
+def benchmark_iou(sizes=((1624, 8), (6500, 32), (26000, 64), (26000, 256)),
+                  max_bytes=(16 << 20)):
+    """Compare tiled IoU with broadcast, float32 and chunked IoU"""
+    check_iou()
+    print("%8s %5s %10s %10s %10s %10s" % ("anchors", "boxes", "tiled",
+                                            "broadcast", "float32",
+                                            "chunked"))
+    for m, n in sizes:
+        boxes1 = random_boxes(m, seed=1)
+        boxes2 = random_boxes(n, seed=2)
+        assert np.allclose(tiled_iou(boxes1, boxes2),
+                           layer_utils.iou(boxes1, boxes2))
+        results = [
+            time_it(lambda: tiled_iou(boxes1, boxes2)),
+            time_it(lambda: layer_utils.iou(boxes1, boxes2)),
+            time_it(lambda: layer_utils.iou(boxes1,
+                                            boxes2,
+                                            dtype=np.float32)),
+            time_it(lambda: layer_utils.iou(boxes1,
+                                            boxes2,
+                                            max_bytes=max_bytes)),
+        ]
+        print("%8d %5d %8.2fms %8.2fms %8.2fms %8.2fms" % (m, n, *results))
+
+
+def count_macs(model):
+    """Number of multiply-accumulates of the conv and dense layers
+    of a model for one input (FLOPs is about 2x MACs)"""
+    macs = 0
+    for layer in model.layers:
+        if isinstance(layer, Model):
+            # nested model eg backbone
+            macs += count_macs(layer)
+        elif isinstance(layer, DepthwiseConv2D):
+            _, height, width, channels = K.int_shape(layer.output)
+            kernel = np.prod(layer.kernel_size)
+            macs += height * width * kernel * channels
+        elif isinstance(layer, Conv2D):
+            _, height, width, filters = K.int_shape(layer.output)
+            channels = K.int_shape(layer.input)[-1]
+            kernel = np.prod(layer.kernel_size)
+            macs += height * width * kernel * channels * filters
+        elif isinstance(layer, Dense):
+            macs += K.int_shape(layer.input)[-1] * layer.units
+    return macs
+
+
+def benchmark_backbones(input_shape=(480, 640, 3),
+                        n_layers=4,
+                        alphas=(1.0, 0.75, 0.5),
+                        runs=20):
+    """Compare MACs, parameters and CPU latency per frame
+    of ResNet and MobileNet backbones"""
+    backbones = [build_resnet(input_shape, n_layers=n_layers)]
+    for alpha in alphas:
+        backbones.append(build_mobilenet(input_shape,
+                                         n_layers=n_layers,
+                                         alpha=alpha))
+    image = np.random.uniform(0, 1, (1,) + input_shape).astype(np.float32)
+    image = tf.constant(image)
+    print("%-14s %8s %8s %10s %10s" % ("backbone", "GMACs", "Mparams",
+                                       "p50", "p99"))
+    for backbone in backbones:
+        predict_fn = tf.function(lambda x: backbone(x, training=False))
+        times = latencies(lambda: predict_fn(image), runs=runs, warmup=3)
+        print("%-14s %8.2f %8.2f %8.2fms %8.2fms" 
+              % (backbone.name,
+                 count_macs(backbone) / 1e9,
+                 backbone.count_params() / 1e6,
+                 np.percentile(times, 50),
+                 np.percentile(times, 99)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SSD micro-benchmarks')
+    help_ = "Benchmark IoU kernels"
+    parser.add_argument("--iou",
+                        default=False,
+                        action='store_true',
+                        help=help_)
+    help_ = "Benchmark ResNet and MobileNet backbones"
+    parser.add_argument("--backbones",
+                        default=False,
+                        action='store_true',
+                        help=help_)
+    args = parser.parse_args()
+
+    if args.iou:
+        benchmark_iou()
+
+    if args.backbones:
+        benchmark_backbones()
@@ -13,22 +13,177 @@ import matplotlib.pyplot as plt
 import os
 import layer_utils
 import label_utils
-import math
 
 from skimage.io import imread
 from matplotlib.patches import Rectangle
 from matplotlib.lines import Line2D
-from layer_utils import anchor_boxes, minmax2centroid, centroid2minmax
+from layer_utils import minmax2centroid, centroid2minmax, get_anchor_bank
 from label_utils import index2class, get_box_color
 
 
+def decode_offsets(offsets,
+                   anchors,
+                   normalize=False,
+                   anchors_centroid=None):
+    """Convert predicted offsets to bounding boxes
+
+    Arguments:
+        offsets (tensor): Predicted offsets (..., n_boxes, 4 or 8)
+        anchors (tensor): Anchor boxes in minmax format (n_boxes, 4)
+        normalize (bool): If offsets are normalized (Equation 11.4.8)
+        anchors_centroid (tensor): Optional anchor boxes in
+            centroid format (eg AnchorBank.centroid)
+
+    Returns:
+        boxes (tensor): Bounding boxes in minmax format (..., n_boxes, 4)
+    """
+    if not normalize:
+        return anchors + offsets[..., 0:4]
+
+    # invert Equation 11.4.8 in (cx, cy, w, h) format
+    if anchors_centroid is None:
+        anchors_centroid = minmax2centroid(anchors)
+    cxcy = offsets[..., 0:2] * 0.1
+    cxcy *= anchors_centroid[:, 2:4]
+    cxcy += anchors_centroid[:, 0:2]
+    wh = np.exp(offsets[..., 2:4] * 0.2)
+    wh *= anchors_centroid[:, 2:4]
+    boxes = np.concatenate([cxcy, wh], axis=-1)
+    return centroid2minmax(boxes)
+
+
+def hard_suppress(ious, valid, iou_threshold=0.2):
+    """Greedy hard NMS over candidates sorted by decreasing score.
+
+    Arguments:
+        ious (tensor): (batch, k, k) IoU matrices of the sorted
+            candidates. IoU of boxes of different classes must be zero.
+        valid (tensor): (batch, k) mask of valid candidates
+        iou_threshold (float): Boxes with IoU >= threshold wrt
+            a kept box of higher score are removed
+
+    Returns:
+        keep (tensor): (batch, k) mask of kept candidates
+    """
+    # a box can only be suppressed by a box with higher score
+    overlap = np.triu(ious >= iou_threshold, k=1)
+    suppressed = np.logical_not(valid)
+    # all images in the batch are processed in one step
+    for i in range(ious.shape[1]):
+        active = np.logical_not(suppressed[:, i])
+        suppressed |= overlap[:, i] & active[:, None]
+    return np.logical_not(suppressed)
+
+
+def soft_suppress(ious,
+                  scores,
+                  valid,
+                  class_threshold=0.5,
+                  iou_threshold=0.2,
+                  method="gaussian",
+                  sigma=0.5):
+    """Soft NMS. Instead of removing overlapping boxes,
+    their scores are decayed (Line 8 of Algorithm 11.12.1).
+
+    Arguments:
+        ious (tensor): (batch, k, k) IoU matrices of the candidates.
+            IoU of boxes of different classes must be zero.
+        scores (tensor): (batch, k) scores of the candidates
+        valid (tensor): (batch, k) mask of valid candidates
+        class_threshold (float): Min decayed score of a kept box
+        iou_threshold (float): Overlap where linear decay starts
+        method (string): gaussian or linear decay
+        sigma (float): Gaussian decay parameter
+
+    Returns:
+        keep (tensor): (batch, k) mask of kept candidates
+        scores (tensor): Decayed scores of all candidates
+    """
+    scores = np.where(valid, scores, -1.0)
+    remaining = np.copy(valid)
+    keep = np.zeros(valid.shape, dtype=bool)
+    rows = np.arange(scores.shape[0])
+    for _ in range(scores.shape[1]):
+        masked = np.where(remaining, scores, -1.0)
+        i = np.argmax(masked, axis=1)
+        selected = masked[rows, i] >= class_threshold
+        if not np.any(selected):
+            break
+        keep[rows[selected], i[selected]] = True
+        remaining[rows, i] = False
+        # images w/o a box above threshold are done
+        remaining[np.logical_not(selected)] = False
+        iou = ious[rows, i]
+        if method == "linear":
+            decay = np.where(iou >= iou_threshold, 1.0 - iou, 1.0)
+        else:
+            decay = np.exp(-(iou * iou) / sigma)
+        scores = np.where(remaining, scores * decay, scores)
+
+    return keep, scores
+
+
+def batch_suppress(args, classes, boxes):
+    """Class-aware NMS on a batch of predictions.
+    Candidates are pre-filtered by class threshold and top-k,
+    then suppressed using one IoU matrix per image.
+
+    Arguments:
+        args : User-defined configurations
+        classes (tensor): (batch, n_boxes, n_classes) predicted classes
+        boxes (tensor): (batch, n_boxes, 4) predicted boxes
+
+    Returns:
+        objects (tensor): (batch, n_boxes) class predictions per anchor
+        candidates (tensor): (batch, k) anchor indexes of candidates
+            sorted by decreasing score
+        keep (tensor): (batch, k) mask of candidates kept by NMS
+        scores (tensor): (batch, k) scores of candidates
+    """
+    # class prediction and its probability per anchor
+    objects = np.argmax(classes, axis=-1)
+    probs = np.amax(classes, axis=-1)
+
+    # non-background objects above threshold (Line 1)
+    valid = (objects > 0) & (probs >= args.class_threshold)
+    probs = np.where(valid, probs, -1.0)
+    # keep only the top-k by score, sorted by decreasing score
+    candidates = np.argsort(-probs, axis=1, kind="stable")
+    candidates = candidates[:, :args.nms_top_k]
+    scores = np.take_along_axis(probs, candidates, axis=1)
+    valid = np.take_along_axis(valid, candidates, axis=1)
+
+    # IoU of all candidate boxes (Line 6)
+    cand_boxes = np.take_along_axis(boxes, candidates[..., None], axis=1)
+    ious = layer_utils.batch_iou(cand_boxes, cand_boxes)
+    # objects of different classes do not suppress each other
+    cand_objects = np.take_along_axis(objects, candidates, axis=1)
+    same_class = cand_objects[:, :, None] == cand_objects[:, None, :]
+    ious = np.where(same_class, ious, 0.0)
+
+    # soft NMS (Lines 7 and 8) or NMS (Lines 9 and 10)
+    if args.soft_nms:
+        keep, scores = soft_suppress(ious,
+                                     scores,
+                                     valid,
+                                     args.class_threshold,
+                                     args.iou_threshold,
+                                     args.soft_nms_method,
+                                     args.soft_nms_sigma)
+    else:
+        keep = hard_suppress(ious, valid, args.iou_threshold)
+
+    return objects, candidates, keep, scores
+
+
 def nms(args, classes, offsets, anchors):
-    """Perform NMS (Algorithm 11.12.1).
+    """Perform class-aware NMS (Algorithm 11.12.1) on one image.
 
     Arguments:
         args : User-defined configurations
         classes (tensor): Predicted classes
         offsets (tensor): Predicted offsets
+        anchors (tensor): Anchor boxes in minmax format
         
     Returns:
         objects (tensor): class predictions per anchor
@@ -37,71 +192,65 @@ def nms(args, classes, offsets, anchors):
         scores (tensor): array of detected objects scores
             filtered by NMS
     """
+    boxes = anchors + offsets[:, 0:4]
+    objects, candidates, keep, cand_scores = \
+            batch_suppress(args, classes[None], boxes[None])
 
-    # get all non-zero (non-background) objects
-    objects = np.argmax(classes, axis=1)
-    # non-zero indexes are not background
-    nonbg = np.nonzero(objects)[0]
-
-    # D and S indexes in Line 1
-    indexes = []
-    while True:
-        # list of zero probability values
-        scores = np.zeros((classes.shape[0],))
-        # set probability values of non-background
-        scores[nonbg] = np.amax(classes[nonbg], axis=1)
-
-        # max probability given the list
-        # Lines 3 and 4
-        score_idx = np.argmax(scores, axis=0)
-        score_max = scores[score_idx]
-        
-        # get all non max probability & set it as new nonbg
-        # Line 5
-        nonbg = nonbg[nonbg != score_idx]
+    indexes = candidates[keep].tolist()
 
-        # if max obj probability is less than threshold (def 0.8)
-        if score_max < args.class_threshold:
-            # we are done
-            break
+    # get the array of object scores
+    scores = np.zeros((classes.shape[0],))
+    scores[indexes] = cand_scores[keep]
 
-        # Line 5
-        indexes.append(score_idx)
-        score_anc = anchors[score_idx]
-        score_off = offsets[score_idx][0:4]
-        score_box = score_anc + score_off
-        score_box = np.expand_dims(score_box, axis=0)
-        nonbg_copy = np.copy(nonbg)
-
-        # get all overlapping predictions (Line 6)
-        # perform Non-Max Suppression (NMS)
-        for idx in nonbg_copy:
-            anchor = anchors[idx]
-            offset = offsets[idx][0:4]
-            box = anchor + offset
-            box = np.expand_dims(box, axis=0)
-            iou = layer_utils.iou(box, score_box)[0][0]
-            # if soft NMS is chosen (Line 7)
-            if args.soft_nms:
-                # adjust score: Line 8
-                iou = -2 * iou * iou
-                classes[idx] *= math.exp(iou)
-            # else NMS (Line 9), (iou threshold def 0.2)
-            elif iou >= args.iou_threshold:
-                # remove overlapping predictions with iou>threshold
-                # Line 10
-                nonbg = nonbg[nonbg != idx]
-
-        # Line 2, nothing else to process
-        if nonbg.size == 0:
-            break
+    return objects[0], indexes, scores
 
 
-    # get the array of object scores
-    scores = np.zeros((classes.shape[0],))
-    scores[indexes] = np.amax(classes[indexes], axis=1)
+def batch_nms(args, classes, offsets, anchors, max_detections=None):
+    """Decode and perform NMS on a batch of predictions
+    in a single vectorized pass
 
-    return objects, indexes, scores
+    Arguments:
+        args : User-defined configurations
+        classes (tensor): (batch, n_boxes, n_classes) predicted classes
+        offsets (tensor): (batch, n_boxes, 8) predicted offsets
+        anchors (AnchorBank): Anchor boxes of all ssd head layers
+        max_detections (int): Detections per image after padding
+            (default is args.nms_top_k)
+
+    Returns:
+        boxes (tensor): (batch, max_detections, 4) detected boxes
+            in minmax format sorted by decreasing score
+        class_ids (tensor): (batch, max_detections) class ids
+        scores (tensor): (batch, max_detections) scores
+        valid_counts (tensor): (batch,) number of valid detections.
+            Entries past valid_counts are zero padding.
+    """
+    if max_detections is None:
+        max_detections = args.nms_top_k
+    boxes = decode_offsets(offsets,
+                           anchors.minmax,
+                           normalize=args.normalize,
+                           anchors_centroid=anchors.centroid)
+    objects, candidates, keep, scores = batch_suppress(args,
+                                                       classes,
+                                                       boxes)
+
+    # kept detections first, sorted by decreasing score
+    scores = np.where(keep, scores, -1.0)
+    order = np.argsort(-scores, axis=1, kind="stable")
+    order = order[:, :max_detections]
+    keep = np.take_along_axis(keep, order, axis=1)
+    indexes = np.take_along_axis(candidates, order, axis=1)
+
+    scores = np.take_along_axis(scores, order, axis=1)
+    scores = np.where(keep, scores, 0.0)
+    class_ids = np.take_along_axis(objects, indexes, axis=1)
+    class_ids = np.where(keep, class_ids, 0)
+    boxes = np.take_along_axis(boxes, indexes[..., None], axis=1)
+    boxes = np.where(keep[..., None], boxes, 0.0)
+    valid_counts = np.sum(keep, axis=1)
+
+    return boxes, class_ids, scores, valid_counts
 
 
 def show_boxes(args,
@@ -126,35 +275,20 @@ def show_boxes(args,
         class_ids (list): Class ids of detected objects
         boxes (list): Anchor boxes of detected objects
     """
-    # generate all anchor boxes per feature map
-    anchors = []
-    n_layers = len(feature_shapes)
-    for index, feature_shape in enumerate(feature_shapes):
-        anchor = anchor_boxes(feature_shape,
-                              image.shape,
-                              index=index)
-        anchor = np.reshape(anchor, [-1, 4])
-        if index == 0:
-            anchors = anchor
-        else:
-            anchors = np.concatenate((anchors, anchor), axis=0)
+    # anchor boxes of all feature maps (computed once)
+    bank = get_anchor_bank(feature_shapes,
+                           image.shape,
+                           n_layers=len(feature_shapes))
+    anchors = bank.minmax
 
-    # get all non-zero (non-background) objects
-    # objects = np.argmax(classes, axis=1)
-    # print(np.unique(objects, return_counts=True))
-    # nonbg = np.nonzero(objects)[0]
     if args.normalize:
         print("Normalize")
-        anchors_centroid = minmax2centroid(anchors)
-        offsets[:, 0:2] *= 0.1
-        offsets[:, 0:2] *= anchors_centroid[:, 2:4]
-        offsets[:, 0:2] += anchors_centroid[:, 0:2]
-        offsets[:, 2:4] *= 0.2
-        offsets[:, 2:4] = np.exp(offsets[:, 2:4])
-        offsets[:, 2:4] *= anchors_centroid[:, 2:4]
-        offsets = centroid2minmax(offsets)
         # convert fr cx,cy,w,h to real offsets
-        offsets[:, 0:4] = offsets[:, 0:4] - anchors
+        boxes = decode_offsets(offsets,
+                               anchors,
+                               normalize=True,
+                               anchors_centroid=bank.centroid)
+        offsets[:, 0:4] = boxes - anchors
 
     objects, indexes, scores = nms(args,
                                    classes,
@@ -170,10 +304,7 @@ def show_boxes(args,
         ax.imshow(image)
     for idx in indexes:
         #batch, row, col, box
-        anchor = anchors[idx] 
-        offset = offsets[idx]
-        
-        anchor += offset[0:4]
+        anchor = anchors[idx] + offsets[idx][0:4]
         # default anchor box format is 
         # xmin, xmax, ymin, ymax
         boxes.append(anchor)
@@ -16,8 +16,9 @@ import label_utils
 import os
 import skimage
 
-from layer_utils import get_gt_data
-from layer_utils import anchor_boxes
+from layer_utils import get_gt_data_batch, pad_labels
+from layer_utils import encode_gt_batch, pack_sparse_gt, dense_to_sparse_gt
+from layer_utils import get_anchor_bank
 
 from skimage.io import imread
 from skimage.util import random_noise
@@ -35,6 +36,10 @@ class DataGenerator(Sequence):
         feature_shapes (tensor): Shapes of ssd head feature maps
         n_anchors (int): Number of anchor boxes per feature map pt
         shuffle (Bool): If dataset should be shuffled bef sampling
+        target_store (TargetStore): If given, ground truth is read
+            from the pre-encoded store instead of being computed
+        image_store (ImageStore): If given, uint8 images are gathered
+            from the pre-decoded store instead of decoding files
     """
     def __init__(self,
                  args,
@@ -42,7 +47,9 @@ class DataGenerator(Sequence):
                  n_classes,
                  feature_shapes=[],
                  n_anchors=4,
-                 shuffle=True):
+                 shuffle=True,
+                 target_store=None,
+                 image_store=None):
         self.args = args
         self.dictionary = dictionary
         self.n_classes = n_classes
@@ -53,8 +60,14 @@ class DataGenerator(Sequence):
         self.feature_shapes = feature_shapes
         self.n_anchors = n_anchors
         self.shuffle = shuffle
+        self.target_store = target_store
+        self.image_store = image_store
         self.on_epoch_end()
         self.get_n_boxes()
+        # anchor boxes depend only on the model geometry
+        self.anchor_bank = get_anchor_bank(self.feature_shapes,
+                                           self.input_shape,
+                                           n_layers=args.layers)
 
 
     def __len__(self):
@@ -124,18 +137,31 @@ class DataGenerator(Sequence):
         Returns:
             x (tensor): Batch images
             y (tensor): Batch classes, offsets, and masks
+                or sparse ground truth (see sparse_ground_truth)
         """
+        # a label entry is made of 4-dim bounding box coords
+        # and 1-dim class label
+        labels = [self.dictionary[key] for key in keys]
+        if self.image_store is not None:
+            # uint8 images, model converts them to float
+            dim = (self.args.batch_size, *self.input_shape)
+            x = np.zeros(dim, dtype=np.uint8)
+            self.image_store.gather(keys, out=x[:len(keys)])
+        else:
+            x = self.read_images(keys)
+
+        if self.args.sparse_targets:
+            y = self.sparse_ground_truth(keys, labels)
+        else:
+            y = self.dense_ground_truth(keys, labels)
+
+        return x, y
+
+
+    def read_images(self, keys):
+        """Read and decode a batch of image files"""
         # train input data
         x = np.zeros((self.args.batch_size, *self.input_shape))
-        dim = (self.args.batch_size, self.n_boxes, self.n_classes)
-        # class ground truth
-        gt_class = np.zeros(dim)
-        dim = (self.args.batch_size, self.n_boxes, 4)
-        # offsets ground truth
-        gt_offset = np.zeros(dim)
-        # masks of valid bounding boxes
-        gt_mask = np.zeros(dim)
-
         for i, key in enumerate(keys):
             # images are assumed to be stored in self.args.data_path
             # key is the image filename 
@@ -143,47 +169,80 @@ class DataGenerator(Sequence):
             image = skimage.img_as_float(imread(image_path))
             # assign image to a batch index
             x[i] = image
-            # a label entry is made of 4-dim bounding box coords
-            # and 1-dim class label
-            labels = self.dictionary[key]
-            labels = np.array(labels)
-            # 4 bounding box coords are 1st four items of labels
-            # last item is object class label
-            boxes = labels[:,0:-1]
-            for index, feature_shape in enumerate(self.feature_shapes):
-                # generate anchor boxes
-                anchors = anchor_boxes(feature_shape,
-                                       image.shape,
-                                       index=index,
-                                       n_layers=self.args.layers)
-                # each feature layer has a row of anchor boxes
-                anchors = np.reshape(anchors, [-1, 4])
-                # compute IoU of each anchor box 
-                # with respect to each bounding boxes
-                iou = layer_utils.iou(anchors, boxes)
-
-                # generate ground truth class, offsets & mask
-                gt = get_gt_data(iou,
-                                 n_classes=self.n_classes,
-                                 anchors=anchors,
-                                 labels=labels,
-                                 normalize=self.args.normalize,
-                                 threshold=self.args.threshold)
-                gt_cls, gt_off, gt_msk = gt
-                if index == 0:
-                    cls = np.array(gt_cls)
-                    off = np.array(gt_off)
-                    msk = np.array(gt_msk)
-                else:
-                    cls = np.append(cls, gt_cls, axis=0)
-                    off = np.append(off, gt_off, axis=0)
-                    msk = np.append(msk, gt_msk, axis=0)
-
-            gt_class[i] = cls
-            gt_offset[i] = off
-            gt_mask[i] = msk
-
-
-        y = [gt_class, np.concatenate((gt_offset, gt_mask), axis=-1)]
+        return x
 
-        return x, y
+
+    def dense_ground_truth(self, keys, labels):
+        """Ground truth classes, offsets and masks of all anchor boxes
+
+        Arguments:
+            keys (array): Image filenames of the batch
+            labels (list): Labels of each image
+
+        Returns:
+            y (tensor): Batch classes, offsets, and masks
+        """
+        if self.target_store is not None:
+            # float32 slices of the memory-mapped store
+            gt_class, gt_offset_mask = self.target_store.gather(keys)
+            return [gt_class, gt_offset_mask]
+
+        dim = (self.args.batch_size, self.n_boxes, self.n_classes)
+        # class ground truth
+        gt_class = np.zeros(dim)
+        dim = (self.args.batch_size, self.n_boxes, 8)
+        # offsets ground truth and masks of valid bounding boxes
+        # share one buffer as expected by the offsets loss
+        gt_offset_mask = np.zeros(dim)
+        gt_offset = gt_offset_mask[..., 0:4]
+        gt_mask = gt_offset_mask[..., 4:8]
+
+        # match all anchor boxes of all layers against 
+        # the ground truth boxes of the whole batch
+        labels, counts = pad_labels(labels)
+        get_gt_data_batch(labels,
+                          counts,
+                          self.anchor_bank,
+                          gt_class[:len(keys)],
+                          gt_offset[:len(keys)],
+                          gt_mask[:len(keys)],
+                          normalize=self.args.normalize,
+                          threshold=self.args.threshold,
+                          dense=self.args.dense_matching)
+
+        return [gt_class, gt_offset_mask]
+
+
+    def sparse_ground_truth(self, keys, labels):
+        """Ground truth of positive anchor boxes only. Expanded to
+        dense format by the loss functions (loss.sparse_loss).
+
+        Arguments:
+            keys (array): Image filenames of the batch
+            labels (list): Labels of each image
+
+        Returns:
+            y (tensor): Sparse ground truth (see pack_sparse_gt) 
+                for both the classes and offsets outputs
+        """
+        if self.target_store is not None:
+            gt_class, gt_offset_mask = self.dense_ground_truth(keys, labels)
+            gt_sparse = dense_to_sparse_gt(gt_class,
+                                           gt_offset_mask,
+                                           self.args.max_positives)
+            return [gt_sparse, gt_sparse]
+
+        labels, counts = pad_labels(labels)
+        class_ids, positive_ids, offsets = \
+                encode_gt_batch(labels,
+                                counts,
+                                self.anchor_bank,
+                                normalize=self.args.normalize,
+                                threshold=self.args.threshold,
+                                dense=self.args.dense_matching)
+        gt_sparse = pack_sparse_gt(class_ids,
+                                   positive_ids,
+                                   offsets,
+                                   self.args.batch_size,
+                                   self.args.max_positives)
+        return [gt_sparse, gt_sparse]
@@ -0,0 +1,124 @@
+"""Knowledge distillation of a trained (teacher) SSD into a
+smaller (student) SSD w/ the same anchor boxes
+
+The student is trained on the ground truth and on the teacher
+predictions on the same batch:
+
+    class loss = (1 - alpha) * loss(gt class, student class)
+                 + alpha * T^2 * CE(teacher class at T, student class at T)
+    offset target = (1 - alpha) * gt offset + alpha * teacher offset
+
+Both teacher and student classes are softened at temperature T.
+The T^2 factor keeps the gradients of the soft targets on the scale
+of the ground truth ones. Offsets are only trained on positive 
+anchors of the ground truth mask.
+
+python3 ssd.py --train --backbone=mobilenet --distill \
+        --teacher-weights=<teacher weights.h5>
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from tensorflow.python.keras.utils.data_utils import Sequence
+
+import numpy as np
+import tensorflow as tf
+
+
+def soften(probs, temperature=1.0):
+    """Softmax probabilities at a higher temperature
+    (same as softmax of logits / temperature)"""
+    if temperature == 1.0:
+        return probs
+    logits = np.log(np.maximum(probs, 1e-7)) / temperature
+    logits -= np.max(logits, axis=-1, keepdims=True)
+    probs = np.exp(logits)
+    return probs / np.sum(probs, axis=-1, keepdims=True)
+
+
+def distillation_loss(loss, alpha=0.5, temperature=1.0):
+    """Wrap a class loss function to train on the ground truth and
+    on the softened teacher classes (see DistillationGenerator)
+
+    Arguments:
+        loss : Loss function or name of a Keras loss function
+        alpha (float): Weight of the teacher loss (0.0 to 1.0)
+        temperature (float): Softening of student and teacher classes
+
+    Returns:
+        loss_fn : Loss function of gt classes and softened teacher
+            classes concatenated on the last axis
+    """
+    loss = tf.keras.losses.get(loss)
+    def loss_fn(y_true, y_pred):
+        y_true = tf.cast(y_true, y_pred.dtype)
+        n_classes = y_pred.shape[-1]
+        gt_class = y_true[..., :n_classes]
+        teacher_class = y_true[..., n_classes:]
+        # student log probabilities at temperature
+        logits = tf.math.log(tf.maximum(y_pred, 1e-7)) / temperature
+        soft_loss = -tf.reduce_sum(teacher_class * tf.nn.log_softmax(logits),
+                                   axis=-1)
+        return (1 - alpha) * loss(gt_class, y_pred) \
+               + alpha * temperature**2 * soft_loss
+    loss_fn.__name__ = "distill_" + loss.__name__
+    return loss_fn
+
+
+class DistillationGenerator(Sequence):
+    """Train data generator w/ ground truth and teacher targets.
+    Class targets are the gt classes and the teacher classes softened
+    at temperature concatenated on the last axis (see 
+    distillation_loss). Offset targets are mixed.
+
+    Arguments:
+        generator (DataGenerator): Ground truth data generator 
+            w/ dense targets
+        teacher (model): Trained ssd model w/ the same anchor boxes
+        alpha (float): Weight of teacher offsets (0.0 to 1.0)
+        temperature (float): Softening of teacher class predictions
+    """
+    def __init__(self,
+                 generator,
+                 teacher,
+                 alpha=0.5,
+                 temperature=1.0):
+        self.generator = generator
+        self.alpha = alpha
+        self.temperature = temperature
+        self.teacher = teacher
+        # traced once per batch shape
+        self.predict_fn = tf.function(
+                lambda x: teacher(x, training=False))
+
+
+    def __len__(self):
+        """Number of batches per epoch"""
+        return len(self.generator)
+
+
+    def __getitem__(self, index):
+        """Batch w/ distillation targets"""
+        x, y = self.generator[index]
+        gt_class, gt_offset_mask = y
+        classes, offsets = self.predict_fn(tf.constant(x))
+        classes = soften(classes.numpy(), self.temperature)
+        offsets = offsets.numpy()
+
+        alpha = self.alpha
+        gt_class = np.concatenate([gt_class, classes], axis=-1)
+        gt_offset_mask = np.array(gt_offset_mask)
+        # mask is the last 4 items, offsets of negatives are masked out
+        gt_offset_mask[..., 0:4] *= (1 - alpha)
+        gt_offset_mask[..., 0:4] += alpha * offsets[..., 0:4] \
+                                    * gt_offset_mask[..., 4:8]
+        return x, [gt_class, gt_offset_mask]
+
+
+    def on_epoch_end(self):
+        """Shuffle the ground truth generator"""
+        self.generator.on_epoch_end()
@@ -0,0 +1,314 @@
+"""Parallel and batched evaluation of SSD on a test set
+
+Test images are decoded by a thread pool ahead of the model.
+The model runs on batches of images while NMS of previous batches
+is performed by post-processing workers. Detections are streamed 
+to a JSONL file, one image per line, so an interrupted evaluation
+resumes where it stopped. The 1st line of the file holds the model 
+hash and NMS settings: a file of other settings is not resumed.
+
+With a PredictionCache, raw predictions are saved per image and only
+uncached images go through the model. sweep() reruns NMS and the 
+metrics on a grid of post-processing settings from the raw predictions.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import copy
+import json
+import skimage
+import numpy as np
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from skimage.io import imread
+from common_utils import print_log
+from metrics import DetectionMetrics
+
+
+# args used by batch_nms (detections depend on them)
+NMS_SETTINGS = ('class_threshold', 'iou_threshold', 'soft_nms',
+                'soft_nms_method', 'soft_nms_sigma', 'nms_top_k',
+                'normalize')
+
+
+def read_image(image_file):
+    """Read an image file as float (0.0 to 1.0)"""
+    return skimage.img_as_float(imread(image_file))
+
+
+class Evaluator:
+    """Evaluation engine. 
+
+    Arguments:
+        detector (SSD): Object detector w/ predict_batch() for
+            raw predictions and postprocess() for batched NMS
+        batch_size (int): Number of images per model call
+        workers (int): Number of decoding and of post-processing threads
+        prefetch (int): Number of batches decoded ahead of the model
+        results_file (string): JSONL file of detections. Images 
+            already in the file are not evaluated again.
+        settings (dict): Model hash and NMS settings of the detections
+            in results_file
+        cache (PredictionCache): Cache of raw predictions
+        verbose (int): Level of verbosity for print function
+    """
+    def __init__(self,
+                 detector,
+                 batch_size=8,
+                 workers=4,
+                 prefetch=2,
+                 results_file=None,
+                 settings=None,
+                 cache=None,
+                 verbose=1):
+        self.detector = detector
+        self.batch_size = batch_size
+        self.workers = workers
+        self.prefetch = prefetch
+        self.results_file = results_file
+        # as read back from json
+        self.settings = json.loads(json.dumps(settings))
+        self.cache = cache
+        self.verbose = verbose
+
+
+    def load_results(self):
+        """Detections of a previous run (key is image filename)
+        or None if there is none w/ the same settings"""
+        if self.results_file is None:
+            return None
+        if not os.path.isfile(self.results_file):
+            return None
+        detections = {}
+        with open(self.results_file) as f:
+            try:
+                header = json.loads(f.readline())
+            except ValueError:
+                header = None
+            if not isinstance(header, dict) \
+                    or header.get('settings') != self.settings:
+                log = "%s has detections of another model or NMS " \
+                      "settings, starting over" % self.results_file
+                print_log(log, self.verbose)
+                return None
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    # incomplete last line of an interrupted run
+                    continue
+                detections[result['key']] = self.to_arrays(result)
+        return detections
+
+
+    @staticmethod
+    def to_arrays(result):
+        """Detections of an image as np arrays"""
+        return {
+            'boxes': np.reshape(np.array(result['boxes']), (-1, 4)),
+            'class_ids': np.array(result['class_ids'], dtype=int),
+            'scores': np.array(result['scores']),
+        }
+
+
+    def load(self, image_file):
+        """Cached raw prediction or else decoded image of an image file
+
+        Returns:
+            filename (string): Cache file name (None if no cache)
+            raw (tuple): Cached classes, offsets or None
+            image (tensor): Decoded image if not cached
+        """
+        filename = None
+        if self.cache is not None:
+            filename = self.cache.filename(image_file)
+            raw = self.cache.get(filename)
+            if raw is not None:
+                return filename, raw, None
+        return filename, None, read_image(image_file)
+
+
+    def predict(self, keys, data_path):
+        """Raw predictions of batches of images. Uncached images are
+        decoded ahead by the thread pool and predicted by the model.
+
+        Arguments:
+            keys (array): Image filenames
+            data_path (string): Directory of image files
+
+        Yields:
+            batch (list): Image filenames of the batch
+            classes (tensor): (batch, n_boxes, n_classes) predicted classes
+            offsets (tensor): (batch, n_boxes, 8) predicted offsets
+        """
+        batches = [keys[i : i + self.batch_size]
+                   for i in range(0, len(keys), self.batch_size)]
+        loaders = ThreadPoolExecutor(max_workers=self.workers)
+        writes = []
+
+        def load(index):
+            """Submit loading of batch index"""
+            return [loaders.submit(self.load, os.path.join(data_path, key))
+                    for key in batches[index]]
+
+        try:
+            loading = deque(load(i) for i in 
+                            range(min(self.prefetch, len(batches))))
+            for index, batch in enumerate(batches):
+                loaded = [f.result() for f in loading.popleft()]
+                if index + self.prefetch < len(batches):
+                    loading.append(load(index + self.prefetch))
+
+                todo = [i for i, item in enumerate(loaded) if item[1] is None]
+                if todo:
+                    images = np.stack([loaded[i][2] for i in todo])
+                    classes, offsets = self.detector.predict_batch(images)
+                    for j, i in enumerate(todo):
+                        filename = loaded[i][0]
+                        raw = (classes[j], offsets[j])
+                        loaded[i] = (filename, raw, None)
+                        if self.cache is not None:
+                            writes.append(loaders.submit(self.cache.put,
+                                                         filename,
+                                                         *raw))
+
+                classes = np.stack([item[1][0] for item in loaded])
+                offsets = np.stack([item[1][1] for item in loaded])
+                yield batch, classes, offsets
+        finally:
+            for write in writes:
+                write.result()
+            loaders.shutdown()
+
+
+    def run(self, keys, data_path):
+        """Detect objects on the images keys
+
+        Arguments:
+            keys (array): Image filenames
+            data_path (string): Directory of image files
+
+        Returns:
+            detections (dict): Key is image filename, value is a dict of
+                boxes (minmax format), class_ids, and scores arrays
+        """
+        detections = self.load_results()
+        resume = detections is not None
+        if not resume:
+            detections = {}
+        keys = [key for key in keys if key not in detections]
+        if len(detections) > 0:
+            log = "Resuming evaluation: %d done, %d to go" \
+                  % (len(detections), len(keys))
+            print_log(log, self.verbose)
+
+        results = None
+        if self.results_file is not None:
+            if resume:
+                results = open(self.results_file, "a")
+            else:
+                results = open(self.results_file, "w")
+                header = {'settings': self.settings}
+                results.write(json.dumps(header) + "\n")
+        postprocessors = ThreadPoolExecutor(max_workers=self.workers)
+
+        def collect(batch, future):
+            """Save detections of a post-processed batch"""
+            boxes, class_ids, scores, valid_counts = future.result()
+            for i, key in enumerate(batch):
+                n = valid_counts[i]
+                result = {
+                    'key': str(key),
+                    'boxes': boxes[i, :n].tolist(),
+                    'class_ids': class_ids[i, :n].tolist(),
+                    'scores': scores[i, :n].tolist(),
+                }
+                detections[key] = self.to_arrays(result)
+                if results is not None:
+                    results.write(json.dumps(result) + "\n")
+            if results is not None:
+                results.flush()
+
+        try:
+            pending = deque()
+            for batch, classes, offsets in self.predict(keys, data_path):
+                future = postprocessors.submit(self.detector.postprocess,
+                                               classes,
+                                               offsets)
+                pending.append((batch, future))
+                # save finished batches, in order
+                while pending and (pending[0][1].done() 
+                                   or len(pending) > self.workers):
+                    collect(*pending.popleft())
+
+            while pending:
+                collect(*pending.popleft())
+        finally:
+            postprocessors.shutdown()
+            if results is not None:
+                results.close()
+
+        return detections
+
+
+    def sweep(self, keys, data_path, dictionary, n_classes, grid):
+        """mAP of the test set for each post-processing setting
+
+        Raw predictions are computed (or loaded from the cache) once
+        per batch, then NMS of the batch runs in parallel for all the
+        settings. Only one batch of raw predictions is in memory.
+
+        Arguments:
+            keys (array): Image filenames
+            data_path (string): Directory of image files
+            dictionary (dict): Ground truth labels per image filename
+            n_classes (int): Number of classes including background
+            grid (list): Dicts of args overrides, 
+                eg {'class_threshold': 0.5, 'iou_threshold': 0.2}
+
+        Returns:
+            results (list): (settings, metrics results) per grid entry
+        """
+        # args overridden by settings and metrics per grid entry
+        entries = []
+        for settings in grid:
+            args = copy.copy(self.detector.args)
+            for name, value in settings.items():
+                setattr(args, name, value)
+            entries.append((args, DetectionMetrics(n_classes)))
+
+        def evaluate(entry, batch, classes, offsets):
+            """NMS and metrics of a batch w/ the args of an entry"""
+            args, metrics = entry
+            boxes, class_ids, scores, valid_counts = \
+                    self.detector.postprocess(classes, offsets, args)
+            for i, key in enumerate(batch):
+                labels = np.array(dictionary[key])
+                n = valid_counts[i]
+                metrics.add(labels[:, 0:-1],
+                            labels[:, -1],
+                            boxes[i, :n],
+                            class_ids[i, :n],
+                            scores[i, :n])
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for batch, classes, offsets in self.predict(keys, data_path):
+                # the metrics of an entry are updated by one thread
+                # at a time, the batch is released once all are done
+                futures = [pool.submit(evaluate, 
+                                       entry, 
+                                       batch, 
+                                       classes, 
+                                       offsets)
+                           for entry in entries]
+                for future in futures:
+                    future.result()
+
+        return [(settings, metrics.evaluate())
+                for settings, (_, metrics) in zip(grid, entries)]
@@ -0,0 +1,116 @@
+"""Pre-decoded image store
+
+Images are decoded once and packed in a memory-mapped uint8 array.
+The data generator gathers batches by index instead of decoding
+JPEG files every epoch. Conversion to float is done by the model
+(see build_ssd rescale_input).
+
+python3 ssd.py --decode-images --image-store=dataset/drinks/images
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import json
+import numpy as np
+import skimage
+
+from skimage.io import imread
+from common_utils import print_log
+
+
+class ImageStore:
+    """A (n_images, height, width, channels) uint8 array saved as .npy
+    and an index of image filename (dictionary key) to array row.
+
+    Arguments:
+        path (string): Directory of the image store
+        verbose (int): Level of verbosity for print function
+    """
+    def __init__(self, path, verbose=1):
+        self.path = path
+        self.verbose = verbose
+        self.data_file = os.path.join(path, "images.npy")
+        self.index_file = os.path.join(path, "index.json")
+        self.images = None
+        self.index = {}
+        if os.path.isfile(self.index_file):
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+
+
+    def __getstate__(self):
+        """Memory map is not pickled but opened again by workers"""
+        state = self.__dict__.copy()
+        state['images'] = None
+        return state
+
+
+    def open(self):
+        """Memory map the image array"""
+        if self.images is None:
+            self.images = np.load(self.data_file, mmap_mode='r')
+        return self.images
+
+
+    def is_complete(self, keys, image_shape):
+        """If all images keys of image_shape are in the store"""
+        if not os.path.isfile(self.data_file):
+            return False
+        if tuple(self.open().shape[1:]) != tuple(image_shape):
+            return False
+        return all(key in self.index for key in keys)
+
+
+    def build(self, keys, data_path, image_shape):
+        """Decode images and save them in the store
+
+        Arguments:
+            keys (array): Image filenames (dictionary keys)
+            data_path (string): Directory of image files
+            image_shape (list): Shape of each image
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        self.images = None
+        tmp_file = self.data_file + ".tmp"
+        dim = (len(keys), *image_shape)
+        images = np.lib.format.open_memmap(tmp_file,
+                                           mode='w+',
+                                           dtype=np.uint8,
+                                           shape=dim)
+        index = {}
+        for i, key in enumerate(keys):
+            image_path = os.path.join(data_path, key)
+            images[i] = skimage.img_as_ubyte(imread(image_path))
+            index[str(key)] = i
+        images.flush()
+        del images
+        os.replace(tmp_file, self.data_file)
+
+        with open(self.index_file + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(self.index_file + ".tmp", self.index_file)
+        self.index = index
+
+        log = "Decoded images: %d %s" % (len(keys), dim[1:])
+        print_log(log, self.verbose)
+
+
+    def gather(self, keys, out=None):
+        """Gather the uint8 images of keys
+
+        Arguments:
+            keys (array): Image filenames (dictionary keys)
+            out (tensor): Optional (len(keys), ...) output tensor
+
+        Returns:
+            images (tensor): (len(keys), height, width, channels) images
+        """
+        rows = np.array([self.index[key] for key in keys], dtype=int)
+        return np.take(self.open(), rows, axis=0, out=out)
@@ -129,6 +129,161 @@ def anchor_boxes(feature_shape,
     return boxes
 
 
+class AnchorBank:
+    """Anchor boxes of all ssd head layers. Anchors depend only
+    on the model geometry so they are computed once and shared
+    by the data generator, post-processing and evaluation.
+    Use get_anchor_bank() to retrieve a cached instance.
+
+    Arguments:
+        feature_shapes (list): Feature map shapes of ssd head layers
+        image_shape (list): Image size shape
+        n_layers (int): Number of ssd head layers
+        aspect_ratios (list): Anchor box aspect ratios
+
+    Attributes:
+        minmax (tensor): (n_boxes, 4) anchors in minmax format
+        centroid (tensor): (n_boxes, 4) anchors in centroid format
+        areas (tensor): (n_boxes,) anchor box areas
+        offsets (list): Index of the 1st anchor box of each layer
+        grid_shapes (list): (height, width, n_boxes) of each layer
+        grid_index (AnchorGridIndex): Spatial index of anchor boxes
+    """
+    def __init__(self,
+                 feature_shapes,
+                 image_shape,
+                 n_layers=4,
+                 aspect_ratios=(1, 2, 0.5)):
+        anchors = []
+        self.offsets = [0]
+        self.grid_shapes = []
+        for index, feature_shape in enumerate(feature_shapes):
+            anchor = anchor_boxes(feature_shape,
+                                  image_shape,
+                                  index=index,
+                                  n_layers=n_layers,
+                                  aspect_ratios=aspect_ratios)
+            self.grid_shapes.append(anchor.shape[1:4])
+            anchor = np.reshape(anchor, [-1, 4])
+            anchors.append(anchor)
+            self.offsets.append(self.offsets[-1] + anchor.shape[0])
+
+        self.minmax = np.concatenate(anchors, axis=0)
+        self.centroid = minmax2centroid(self.minmax)
+        self.areas = self.centroid[:, 2] * self.centroid[:, 3]
+        # shared by all users, must not be modified in place
+        for array in (self.minmax, self.centroid, self.areas):
+            array.flags.writeable = False
+        self.grid_index = AnchorGridIndex(self)
+
+
+    def __len__(self):
+        """Total number of anchor boxes"""
+        return self.minmax.shape[0]
+
+
+    def layer(self, index):
+        """Anchor boxes of the ssd head layer index (minmax format)"""
+        return self.minmax[self.offsets[index] : self.offsets[index + 1]]
+
+
+class AnchorGridIndex:
+    """Spatial index of anchor boxes keyed on the grid of each
+    ssd head layer. Anchor boxes of a layer are laid on a regular
+    grid (see anchor_boxes()) so the rows and columns whose anchor
+    boxes overlap a given box are found by binary search.
+
+    Arguments:
+        anchor_bank (AnchorBank): Anchor boxes of all ssd head layers
+    """
+    def __init__(self, anchor_bank):
+        self.layers = []
+        for index, shape in enumerate(anchor_bank.grid_shapes):
+            # (feature_height, feature_width, n_boxes, 4)
+            anchors = np.reshape(anchor_bank.layer(index), (*shape, 4))
+            # x coords depend only on column and box,
+            # y coords depend only on row and box
+            # all are (n_boxes, n_columns or n_rows) 
+            xmin = anchors[0, :, :, 0].T
+            xmax = anchors[0, :, :, 1].T
+            ymin = anchors[:, 0, :, 2].T
+            ymax = anchors[:, 0, :, 3].T
+            self.layers.append((shape, xmin, xmax, ymin, ymax))
+
+
+    def query(self, index, boxes):
+        """Find the anchor boxes of a layer that overlap boxes
+
+        Arguments:
+            index (int): Indicates which of ssd head layers
+            boxes (tensor): (n, 4) boxes in minmax format
+
+        Returns:
+            box_ids (tensor): Index of box of each overlapping pair
+            anchor_ids (tensor): Index of anchor box (within the layer)
+                of each overlapping pair
+        """
+        shape, xmin, xmax, ymin, ymax = self.layers[index]
+        _, feature_width, n_boxes = shape
+        box_ids = []
+        anchor_ids = []
+        for k in range(n_boxes):
+            # columns and rows where anchor box k has a 
+            # non-zero intersection with each box
+            col_start = np.searchsorted(xmax[k], boxes[:, 0], side='right')
+            col_end = np.searchsorted(xmin[k], boxes[:, 1], side='left')
+            row_start = np.searchsorted(ymax[k], boxes[:, 2], side='right')
+            row_end = np.searchsorted(ymin[k], boxes[:, 3], side='left')
+            n_cols = np.maximum(col_end - col_start, 0)
+            n_rows = np.maximum(row_end - row_start, 0)
+
+            # enumerate the n_rows x n_cols cells of each box
+            counts = n_cols * n_rows
+            box_id = np.repeat(np.arange(boxes.shape[0]), counts)
+            cell = np.arange(np.sum(counts))
+            cell -= np.repeat(np.cumsum(counts) - counts, counts)
+            row = row_start[box_id] + cell // n_cols[box_id]
+            col = col_start[box_id] + cell % n_cols[box_id]
+
+            box_ids.append(box_id)
+            anchor_ids.append((row * feature_width + col) * n_boxes + k)
+
+        return np.concatenate(box_ids), np.concatenate(anchor_ids)
+
+
+_anchor_banks = {}
+
+
+def get_anchor_bank(feature_shapes,
+                    image_shape,
+                    n_layers=4,
+                    aspect_ratios=(1, 2, 0.5)):
+    """Retrieve the AnchorBank of a given model geometry.
+    It is computed on first use only.
+
+    Arguments:
+        feature_shapes (list): Feature map shapes of ssd head layers
+        image_shape (list): Image size shape
+        n_layers (int): Number of ssd head layers
+        aspect_ratios (list): Anchor box aspect ratios
+
+    Returns:
+        bank (AnchorBank): Anchor boxes of all ssd head layers
+    """
+    key = (tuple(tuple(int(d) for d in shape) for shape in feature_shapes),
+           tuple(int(d) for d in image_shape),
+           n_layers,
+           tuple(aspect_ratios))
+    bank = _anchor_banks.get(key)
+    if bank is None:
+        bank = AnchorBank(feature_shapes,
+                          image_shape,
+                          n_layers=n_layers,
+                          aspect_ratios=aspect_ratios)
+        _anchor_banks[key] = bank
+    return bank
+
+
 def centroid2minmax(boxes):
     """Centroid to minmax format 
     (cx, cy, w, h) to (xmin, xmax, ymin, ymax)
@@ -168,89 +323,165 @@ def minmax2centroid(boxes):
 
 
 
+def box_areas(boxes):
+    """Compute areas of boxes in minmax format
+
+    Arguments:
+        boxes (tensor): (..., n, 4) boxes coordinates in pixels
+
+    Returns:
+        areas (tensor): (..., n) areas of boxes
+    """
+    xmin = 0
+    xmax = 1
+    ymin = 2
+    ymax = 3
+
+    width = (boxes[..., xmax] - boxes[..., xmin])
+    height = (boxes[..., ymax] - boxes[..., ymin])
+    return width * height
+
+
 def intersection(boxes1, boxes2):
-    """Compute intersection of batch of boxes1 and boxes2
+    """Compute intersection of batch of boxes1 and boxes2.
+    Boxes are broadcast against each other (no tiled copies).
     
     Arguments:
-        boxes1 (tensor): Boxes coordinates in pixels
-        boxes2 (tensor): Boxes coordinates in pixels
+        boxes1 (tensor): (..., m, 4) boxes coordinates in pixels
+        boxes2 (tensor): (..., n, 4) boxes coordinates in pixels
 
     Returns:
-        intersection_areas (tensor): intersection of areas of
-            boxes1 and boxes2
+        intersection_areas (tensor): (..., m, n) intersection 
+            of areas of boxes1 and boxes2
     """
-    m = boxes1.shape[0] # The number of boxes in `boxes1`
-    n = boxes2.shape[0] # The number of boxes in `boxes2`
-
     xmin = 0
     xmax = 1
     ymin = 2
     ymax = 3
 
-    boxes1_min = np.expand_dims(boxes1[:, [xmin, ymin]], axis=1)
-    boxes1_min = np.tile(boxes1_min, reps=(1, n, 1))
-    boxes2_min = np.expand_dims(boxes2[:, [xmin, ymin]], axis=0)
-    boxes2_min = np.tile(boxes2_min, reps=(m, 1, 1))
-    min_xy = np.maximum(boxes1_min, boxes2_min)
+    # (..., m, 1, 4) and (..., 1, n, 4)
+    boxes1 = np.expand_dims(boxes1, axis=-2)
+    boxes2 = np.expand_dims(boxes2, axis=-3)
 
-    boxes1_max = np.expand_dims(boxes1[:, [xmax, ymax]], axis=1)
-    boxes1_max = np.tile(boxes1_max, reps=(1, n, 1))
-    boxes2_max = np.expand_dims(boxes2[:, [xmax, ymax]], axis=0)
-    boxes2_max = np.tile(boxes2_max, reps=(m, 1, 1))
-    max_xy = np.minimum(boxes1_max, boxes2_max)
+    width = np.minimum(boxes1[..., xmax], boxes2[..., xmax])
+    width -= np.maximum(boxes1[..., xmin], boxes2[..., xmin])
+    np.maximum(width, 0, out=width)
+    height = np.minimum(boxes1[..., ymax], boxes2[..., ymax])
+    height -= np.maximum(boxes1[..., ymin], boxes2[..., ymin])
+    np.maximum(height, 0, out=height)
 
-    side_lengths = np.maximum(0, max_xy - min_xy)
-
-    intersection_areas = side_lengths[:, :, 0] * side_lengths[:, :, 1]
-    return intersection_areas
+    width *= height
+    return width
 
 
 def union(boxes1, boxes2, intersection_areas):
     """Compute union of batch of boxes1 and boxes2
 
     Arguments:
-        boxes1 (tensor): Boxes coordinates in pixels
-        boxes2 (tensor): Boxes coordinates in pixels
+        boxes1 (tensor): (..., m, 4) boxes coordinates in pixels
+        boxes2 (tensor): (..., n, 4) boxes coordinates in pixels
+        intersection_areas (tensor): (..., m, n) intersection
+            of areas of boxes1 and boxes2
 
     Returns:
-        union_areas (tensor): union of areas of
+        union_areas (tensor): (..., m, n) union of areas of
             boxes1 and boxes2
     """
-    m = boxes1.shape[0] # number of boxes in boxes1
-    n = boxes2.shape[0] # number of boxes in boxes2
+    boxes1_areas = np.expand_dims(box_areas(boxes1), axis=-1)
+    boxes2_areas = np.expand_dims(box_areas(boxes2), axis=-2)
+    union_areas = boxes1_areas + boxes2_areas
+    union_areas -= intersection_areas
+    return union_areas
+
+
+def iou(boxes1, boxes2, dtype=None, max_bytes=None):
+    """Compute IoU of batch boxes1 and boxes2
+
+    Arguments:
+        boxes1 (tensor): (..., m, 4) boxes coordinates in pixels
+        boxes2 (tensor): (..., n, 4) boxes coordinates in pixels
+        dtype (dtype): Compute in this precision (eg np.float32)
+            instead of the precision of the inputs
+        max_bytes (int): If given, boxes1 is processed in chunks
+            so that each temporary (..., chunk, n) array is 
+            at most max_bytes
+
+    Returns:
+        iou (tensor): (..., m, n) intersection over union 
+            of areas of boxes1 and boxes2
+    """
+    if dtype is not None:
+        boxes1 = np.asarray(boxes1, dtype=dtype)
+        boxes2 = np.asarray(boxes2, dtype=dtype)
+
+    m = boxes1.shape[-2]
+    n = boxes2.shape[-2]
+    batch = max(np.prod(boxes1.shape[:-2], dtype=int),
+                np.prod(boxes2.shape[:-2], dtype=int))
+    itemsize = np.result_type(boxes1, boxes2).itemsize
+    chunk = m
+    if max_bytes is not None:
+        chunk = max(1, max_bytes // max(1, batch * n * itemsize))
+
+    if chunk >= m:
+        intersection_areas = intersection(boxes1, boxes2)
+        union_areas = union(boxes1, boxes2, intersection_areas)
+        # not in-place: integer boxes give float IoUs
+        return intersection_areas / union_areas
+
+    ious = None
+    for start in range(0, m, chunk):
+        end = start + chunk
+        chunk_iou = iou(boxes1[..., start:end, :], boxes2)
+        if ious is None:
+            shape = chunk_iou.shape[:-2] + (m, n)
+            ious = np.empty(shape, dtype=chunk_iou.dtype)
+        ious[..., start:end, :] = chunk_iou
+    return ious
+
+
+def paired_iou(boxes1, boxes2):
+    """Compute IoU of each box in boxes1 with the box 
+    of the same index in boxes2
 
+    Arguments:
+        boxes1 (tensor): (..., 4) boxes coordinates in pixels
+        boxes2 (tensor): (..., 4) boxes coordinates in pixels
+
+    Returns:
+        iou (tensor): (...) intersection over union of areas
+            of boxes1 and boxes2
+    """
     xmin = 0
     xmax = 1
     ymin = 2
     ymax = 3
 
-    width = (boxes1[:, xmax] - boxes1[:, xmin])
-    height = (boxes1[:, ymax] - boxes1[:, ymin])
-    areas = width * height
-    boxes1_areas = np.tile(np.expand_dims(areas, axis=1), reps=(1,n))
-    width = (boxes2[:,xmax] - boxes2[:,xmin])
-    height = (boxes2[:,ymax] - boxes2[:,ymin])
-    areas = width * height
-    boxes2_areas = np.tile(np.expand_dims(areas, axis=0), reps=(m,1))
+    width = np.minimum(boxes1[..., xmax], boxes2[..., xmax])
+    width -= np.maximum(boxes1[..., xmin], boxes2[..., xmin])
+    np.maximum(width, 0, out=width)
+    height = np.minimum(boxes1[..., ymax], boxes2[..., ymax])
+    height -= np.maximum(boxes1[..., ymin], boxes2[..., ymin])
+    np.maximum(height, 0, out=height)
+    width *= height
 
-    union_areas = boxes1_areas + boxes2_areas - intersection_areas
-    return union_areas
+    union_areas = box_areas(boxes1) + box_areas(boxes2)
+    union_areas -= width
+    return width / union_areas
 
 
-def iou(boxes1, boxes2):
-    """Compute IoU of batch boxes1 and boxes2
+def batch_iou(boxes1, boxes2):
+    """Compute IoU of boxes1 and boxes2 per batch item
 
     Arguments:
-        boxes1 (tensor): Boxes coordinates in pixels
-        boxes2 (tensor): Boxes coordinates in pixels
+        boxes1 (tensor): (batch, m, 4) boxes coordinates in pixels
+        boxes2 (tensor): (batch, n, 4) boxes coordinates in pixels
 
     Returns:
-        iou (tensor): intersectiin of union of areas of
-            boxes1 and boxes2
+        iou (tensor): (batch, m, n) intersection over union of 
+            areas of boxes1 and boxes2
     """
-    intersection_areas = intersection(boxes1, boxes2)
-    union_areas = union(boxes1, boxes2, intersection_areas)
-    return intersection_areas / union_areas
+    return iou(boxes1, boxes2)
 
 
 def get_gt_data(iou,
@@ -342,3 +573,322 @@ def get_gt_data(iou,
     gt_offset[maxiou_per_gt] = offsets
 
     return gt_class, gt_offset, gt_mask
+
+
+def pad_labels(labels_list):
+    """Stack per-image ground truth labels in a zero-padded tensor
+
+    Arguments:
+        labels_list (list): Per-image (n_gt, 5) labels made of
+            box coords (xmin, xmax, ymin, ymax) and class
+
+    Returns:
+        labels (tensor): (batch, max n_gt, 5) padded labels
+        counts (tensor): (batch,) number of valid labels per image
+    """
+    labels_list = [np.reshape(np.array(labels), (-1, 5))
+                   for labels in labels_list]
+    counts = np.array([len(labels) for labels in labels_list], dtype=int)
+    dtype = np.result_type(*labels_list) if labels_list else np.float32
+    labels = np.zeros((len(labels_list), max(counts, default=0), 5),
+                      dtype=dtype)
+    for i, label in enumerate(labels_list):
+        labels[i, :counts[i]] = label
+    return labels, counts
+
+
+def dense_matches(anchors, boxes, valid, threshold=0.6):
+    """Match anchor boxes of a layer with ground truth boxes
+    using the IoU of all anchor boxes wrt all ground truth boxes
+
+    Arguments:
+        anchors (tensor): (n_anchors, 4) anchor boxes of a layer
+        boxes (tensor): (batch, max n_gt, 4) padded ground truth boxes
+        valid (tensor): (batch, max n_gt) mask of valid boxes
+        threshold (float): If less than 1.0, anchor boxes>threshold
+            are also part of positive anchor boxes
+
+    Returns:
+        batch_ids, anchor_ids, gt_ids (tensor): Matched triplets
+        is_extra (tensor): If the match is an extra anchor box
+    """
+    # (batch, n_anchors, n_gt) IoU of each anchor box
+    # with respect to each bounding box
+    ious = iou(anchors[None], boxes)
+    # index of anchor w/ max iou per ground truth bbox
+    batch_ids, gt_ids = np.nonzero(valid)
+    anchor_ids = np.argmax(ious, axis=1)[valid]
+    is_extra = np.zeros(batch_ids.shape, dtype=bool)
+
+    # extra anchor boxes based on IoU
+    if threshold < 1.0:
+        extra = np.nonzero((ious > threshold) & valid[:, None, :])
+        batch_ids = np.concatenate([batch_ids, extra[0]])
+        anchor_ids = np.concatenate([anchor_ids, extra[1]])
+        gt_ids = np.concatenate([gt_ids, extra[2]])
+        is_extra = np.concatenate([is_extra, np.ones(extra[0].shape, 
+                                                     dtype=bool)])
+
+    return batch_ids, anchor_ids, gt_ids, is_extra
+
+
+def grid_matches(anchor_bank, index, boxes, valid, threshold=0.6):
+    """Match anchor boxes of a layer with ground truth boxes
+    using the anchor grid index. Only anchor boxes that overlap
+    a ground truth box are considered. Same matches as 
+    dense_matches().
+
+    Arguments:
+        anchor_bank (AnchorBank): Anchor boxes of all ssd head layers
+        index (int): Indicates which of ssd head layers
+        boxes (tensor): (batch, max n_gt, 4) padded ground truth boxes
+        valid (tensor): (batch, max n_gt) mask of valid boxes
+        threshold (float): If less than 1.0, anchor boxes>threshold
+            are also part of positive anchor boxes
+
+    Returns:
+        batch_ids, anchor_ids, gt_ids (tensor): Matched triplets
+        is_extra (tensor): If the match is an extra anchor box
+    """
+    anchors = anchor_bank.layer(index)
+    batch_ids, gt_ids = np.nonzero(valid)
+    boxes = boxes[valid]
+    box_ids, pair_anchors = anchor_bank.grid_index.query(index, boxes)
+    ious = paired_iou(anchors[pair_anchors], boxes[box_ids])
+
+    # anchor w/ max iou per ground truth bbox, lowest index on ties.
+    # like np.argmax, a bbox w/o overlapping anchor gets anchor 0
+    order = np.lexsort((pair_anchors, -ious, box_ids))
+    first = np.ones(order.shape, dtype=bool)
+    first[1:] = box_ids[order[1:]] != box_ids[order[:-1]]
+    anchor_ids = np.zeros(boxes.shape[0], dtype=int)
+    anchor_ids[box_ids[order[first]]] = pair_anchors[order[first]]
+    is_extra = np.zeros(batch_ids.shape, dtype=bool)
+
+    # extra anchor boxes based on IoU
+    if threshold < 1.0:
+        extra = ious > threshold
+        box_ids = box_ids[extra]
+        batch_ids = np.concatenate([batch_ids, batch_ids[box_ids]])
+        anchor_ids = np.concatenate([anchor_ids, pair_anchors[extra]])
+        gt_ids = np.concatenate([gt_ids, gt_ids[box_ids]])
+        is_extra = np.concatenate([is_extra, np.ones(box_ids.shape,
+                                                     dtype=bool)])
+
+    return batch_ids, anchor_ids, gt_ids, is_extra
+
+
+def encode_gt_batch(labels,
+                    counts,
+                    anchor_bank,
+                    normalize=False,
+                    threshold=0.6,
+                    dense=False):
+    """Match and encode the ground truth of a whole batch across
+    all ssd head layers. Same matching rules as get_gt_data() 
+    applied per layer: the best anchor box of each ground truth
+    box plus anchor boxes with IoU>threshold.
+
+    Arguments:
+        labels (tensor): (batch, max n_gt, 5) padded ground truth labels
+        counts (tensor): (batch,) number of valid labels per image
+        anchor_bank (AnchorBank): Anchor boxes of all ssd head layers
+        normalize (bool): If normalization should be applied
+        threshold (float): If less than 1.0, anchor boxes>threshold
+            are also part of positive anchor boxes
+        dense (bool): Compute IoU of all anchor boxes instead of
+            using the anchor grid index (for verification)
+
+    Returns:
+        class_ids (tuple): (batch ids, anchor ids, class ids) of 
+            positive anchor boxes. An anchor box matched by ground 
+            truth boxes of different classes has several entries.
+        positive_ids (tuple): (batch ids, anchor ids) of positive
+            anchor boxes. Each anchor box has one entry.
+        offsets (tensor): (n_positives, 4) offsets of positive
+            anchor boxes
+    """
+    empty = np.zeros((0,), dtype=int)
+    class_ids = [[empty], [empty], [empty]]
+    positive_ids = [[empty], [empty]]
+    all_offsets = [np.zeros((0, 4))]
+
+    n_gt = labels.shape[1]
+    # padded ground truth boxes are never matched
+    valid = np.arange(n_gt)[None, :] < np.reshape(counts, (-1, 1))
+    boxes = labels[..., 0:4]
+    classes = labels[..., 4].astype(int)
+
+    for index in range(len(anchor_bank.offsets) - 1):
+        if n_gt == 0:
+            break
+        start = anchor_bank.offsets[index]
+        anchors = anchor_bank.layer(index)
+        if dense:
+            matches = dense_matches(anchors, boxes, valid, threshold)
+        else:
+            matches = grid_matches(anchor_bank,
+                                   index,
+                                   boxes,
+                                   valid,
+                                   threshold)
+        b, a, g, is_extra = matches
+
+        # class generation
+        class_ids[0].append(b)
+        class_ids[1].append(start + a)
+        class_ids[2].append(classes[b, g])
+
+        # an anchor box matched by several ground truth boxes 
+        # gets the offsets of the last extra match, else of
+        # the last best match (same as get_gt_data)
+        priority = is_extra * n_gt + g
+        order = np.lexsort((priority, a, b))
+        b, a, g = b[order], a[order], g[order]
+        last = np.ones(order.shape, dtype=bool)
+        last[:-1] = (b[1:] != b[:-1]) | (a[1:] != a[:-1])
+        b, a, g = b[last], a[last], g[last]
+        positive_ids[0].append(b)
+        positive_ids[1].append(start + a)
+
+        # offsets generation
+        label = labels[b, g]
+        #(cx, cy, w, h) format
+        if normalize:
+            anchor = anchor_bank.centroid[start + a]
+            label = minmax2centroid(label)
+            # Equation 11.4.8
+            offsets1 = label[:, 0:2] - anchor[:, 0:2]
+            offsets1 /= anchor[:, 2:4]
+            offsets1 /= 0.1
+            offsets2 = np.log(label[:, 2:4]/anchor[:, 2:4])
+            offsets2 /= 0.2
+            offsets = np.concatenate([offsets1, offsets2], axis=-1)
+        # (xmin, xmax, ymin, ymax) format
+        else:
+            offsets = label[:, 0:4] - anchors[a]
+        all_offsets.append(offsets)
+
+    class_ids = tuple(np.concatenate(ids).astype(int) for ids in class_ids)
+    positive_ids = tuple(np.concatenate(ids).astype(int) 
+                         for ids in positive_ids)
+    return class_ids, positive_ids, np.concatenate(all_offsets, axis=0)
+
+
+def get_gt_data_batch(labels,
+                      counts,
+                      anchor_bank,
+                      gt_class,
+                      gt_offset,
+                      gt_mask,
+                      normalize=False,
+                      threshold=0.6,
+                      dense=False):
+    """Retrieve ground truth class, bbox offset, and mask of a 
+    whole batch across all ssd head layers (see encode_gt_batch()).
+    Results are written in the given preallocated tensors.
+
+    Arguments:
+        labels (tensor): (batch, max n_gt, 5) padded ground truth labels
+        counts (tensor): (batch,) number of valid labels per image
+        anchor_bank (AnchorBank): Anchor boxes of all ssd head layers
+        gt_class (tensor): (batch, n_boxes, n_classes) output classes
+        gt_offset (tensor): (batch, n_boxes, 4) output offsets
+        gt_mask (tensor): (batch, n_boxes, 4) output masks
+        normalize (bool): If normalization should be applied
+        threshold (float): If less than 1.0, anchor boxes>threshold
+            are also part of positive anchor boxes
+        dense (bool): Compute IoU of all anchor boxes instead of
+            using the anchor grid index (for verification)
+    """
+    gt_class[...] = 0
+    # by default all are background (index 0)
+    gt_class[..., 0] = 1
+    gt_offset[...] = 0
+    gt_mask[...] = 0
+
+    class_ids, positive_ids, offsets = encode_gt_batch(labels,
+                                                       counts,
+                                                       anchor_bank,
+                                                       normalize,
+                                                       threshold,
+                                                       dense)
+    b, a, c = class_ids
+    gt_class[b, a, 0] = 0
+    gt_class[b, a, c] = 1.0
+    gt_mask[positive_ids] = 1.0
+    gt_offset[positive_ids] = offsets
+
+
+def pack_sparse_gt(class_ids,
+                   positive_ids,
+                   offsets,
+                   batch_size,
+                   max_positives=256):
+    """Pack positive anchor boxes in a sparse ground truth tensor.
+    Each row is (anchor id, class id, 4 offsets). An anchor box of
+    several classes has one row per class. Unused rows have
+    anchor id -1. Use loss.sparse_to_dense() to expand it.
+
+    Arguments:
+        class_ids (tuple): (batch ids, anchor ids, class ids) 
+            of positive anchor boxes
+        positive_ids (tuple): (batch ids, anchor ids) of positive
+            anchor boxes, one entry per anchor box
+        offsets (tensor): (n_positives, 4) offsets of positive
+            anchor boxes
+        batch_size (int): Number of images in the batch
+        max_positives (int): Rows per image. Rounded up to a multiple
+            of max_positives if an image has more rows.
+
+    Returns:
+        gt_sparse (tensor): (batch_size, n_rows, 6) float32 ground truth
+    """
+    rows = np.unique(np.stack(class_ids, axis=1), axis=0)
+    rows = np.reshape(rows, (-1, 3))
+    batch_ids, anchor_ids, classes = rows[:, 0], rows[:, 1], rows[:, 2]
+
+    # offsets of the anchor box of each row
+    n_boxes = 1 + max(np.amax(anchor_ids, initial=0),
+                      np.amax(positive_ids[1], initial=0))
+    keys = positive_ids[0] * n_boxes + positive_ids[1]
+    order = np.argsort(keys)
+    index = np.searchsorted(keys[order], batch_ids * n_boxes + anchor_ids)
+    row_offsets = offsets[order[index]] if len(rows) else offsets[:0]
+
+    # rows are sorted by batch id, slot is the position in an image
+    counts = np.bincount(batch_ids, minlength=batch_size)
+    slots = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts,
+                                             counts)
+    n_rows = max_positives * max(1, -(-np.amax(counts, initial=0)
+                                      // max_positives))
+
+    gt_sparse = np.zeros((batch_size, n_rows, 6), dtype=np.float32)
+    gt_sparse[..., 0] = -1
+    gt_sparse[batch_ids, slots, 0] = anchor_ids
+    gt_sparse[batch_ids, slots, 1] = classes
+    gt_sparse[batch_ids, slots, 2:6] = row_offsets
+    return gt_sparse
+
+
+def dense_to_sparse_gt(gt_class, gt_offset_mask, max_positives=256):
+    """Convert dense ground truth to the sparse format of
+    pack_sparse_gt()
+
+    Arguments:
+        gt_class (tensor): (batch, n_boxes, n_classes) classes
+        gt_offset_mask (tensor): (batch, n_boxes, 8) offsets and masks
+        max_positives (int): Rows per image
+
+    Returns:
+        gt_sparse (tensor): (batch, n_rows, 6) float32 ground truth
+    """
+    positive_ids = np.nonzero(gt_offset_mask[..., 4] > 0)
+    index, classes = np.nonzero(gt_class[positive_ids] > 0)
+    class_ids = (positive_ids[0][index], positive_ids[1][index], classes)
+    offsets = gt_offset_mask[positive_ids][:, 0:4]
+    return pack_sparse_gt(class_ids,
+                          positive_ids,
+                          offsets,
+                          gt_class.shape[0],
+                          max_positives)
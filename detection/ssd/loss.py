@@ -101,3 +101,65 @@ def smooth_l1_loss(y_true, y_pred):
     offset, pred = mask_offset(y_true, y_pred)
     # Huber loss as approx of smooth L1
     return Huber()(offset, pred)
+
+
+def sparse_positives(y_true):
+    """Rows of positive anchor boxes of sparse ground truth
+    (see layer_utils.pack_sparse_gt)
+
+    Returns:
+        batch_ids (tensor): Image index of each row
+        anchor_ids (tensor): Anchor box index of each row
+        values (tensor): (n_rows, 6) anchor id, class id, offsets
+    """
+    rows = tf.where(y_true[..., 0] >= 0)
+    values = tf.gather_nd(y_true, rows)
+    batch_ids = tf.cast(rows[:, 0], tf.int32)
+    anchor_ids = tf.cast(values[:, 0], tf.int32)
+    return batch_ids, anchor_ids, values
+
+
+def sparse_to_dense_class(y_true, y_pred):
+    """Expand sparse ground truth to one-hot classes
+    of the same shape as y_pred (batch, n_boxes, n_classes)"""
+    shape = tf.shape(y_pred)
+    batch_ids, anchor_ids, values = sparse_positives(y_true)
+    class_ids = tf.cast(values[:, 1], tf.int32)
+    indexes = tf.stack([batch_ids, anchor_ids, class_ids], axis=1)
+    positives = tf.scatter_nd(indexes, tf.ones_like(values[:, 1]), shape)
+    # an anchor box is counted once per class
+    positives = tf.minimum(positives, 1.0)
+    # anchor boxes w/o object are background (index 0)
+    background = 1.0 - K.max(positives, axis=-1, keepdims=True)
+    background *= tf.one_hot(0, shape[-1], dtype=positives.dtype)
+    return positives + background
+
+
+def sparse_to_dense_offset(y_true, y_pred):
+    """Expand sparse ground truth to offsets and masks
+    of the same shape as y_pred (batch, n_boxes, 8)"""
+    shape = tf.shape(y_pred)
+    batch_ids, anchor_ids, values = sparse_positives(y_true)
+    indexes = tf.stack([batch_ids, anchor_ids], axis=1)
+    mask = tf.ones_like(values[:, 2:6])
+    updates = tf.concat([values[:, 2:6], mask], axis=-1)
+    # rows of the same anchor box have the same offsets
+    dense = tf.zeros(shape, dtype=y_true.dtype)
+    return tf.tensor_scatter_nd_update(dense, indexes, updates)
+
+
+def sparse_loss(loss, expand):
+    """Wrap a loss function to accept sparse ground truth
+
+    Arguments:
+        loss : Loss function or name of a Keras loss function
+        expand : sparse_to_dense_class or sparse_to_dense_offset
+
+    Returns:
+        sparse_loss : Loss function of sparse ground truth
+    """
+    loss = tf.keras.losses.get(loss)
+    def loss_fn(y_true, y_pred):
+        return loss(expand(y_true, y_pred), y_pred)
+    loss_fn.__name__ = "sparse_gt_" + loss.__name__
+    return loss_fn
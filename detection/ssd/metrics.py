@@ -0,0 +1,218 @@
+"""Detection metrics: VOC and COCO style mean average precision
+
+Detections and ground truth of all test images are accumulated
+then per class AP is computed at many IoU thresholds in one pass.
+
+    metrics = DetectionMetrics(n_classes)
+    for each test image:
+        metrics.add(gt_boxes, gt_class_ids, boxes, class_ids, scores)
+    results = metrics.evaluate()
+
+Boxes are in minmax format (xmin, xmax, ymin, ymax).
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import numpy as np
+
+from layer_utils import iou
+
+
+# COCO IoU thresholds 0.50:0.05:0.95
+COCO_IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+
+
+def match_detections(ious, iou_thresholds):
+    """Greedy matching of detections to ground truth bboxes at 
+    all IoU thresholds. Detections must be sorted by decreasing 
+    score. A ground truth bbox is matched at most once.
+
+    Arguments:
+        ious (tensor): (n_detections, n_gt) IoUs of same class
+            detections and ground truth bboxes (-1 otherwise)
+        iou_thresholds (array): (n_thresholds,) IoU thresholds
+
+    Returns:
+        tp (tensor): (n_detections, n_thresholds) True if the 
+            detection is a true positive at the IoU threshold
+    """
+    n_dets, n_gt = ious.shape
+    tp = np.zeros((n_dets, len(iou_thresholds)), dtype=bool)
+    if n_dets == 0 or n_gt == 0:
+        return tp
+
+    # detections that do not overlap enough any ground truth bbox 
+    # are false positives at all thresholds
+    candidates = np.flatnonzero(ious.max(axis=1) >= iou_thresholds.min())
+    # matched[t, g]: ground truth g is matched at threshold t
+    matched = np.zeros((len(iou_thresholds), n_gt), dtype=bool)
+    rows = np.arange(len(iou_thresholds))
+    for d in candidates:
+        # unmatched ground truth bboxes above each threshold
+        ok = (ious[d] >= iou_thresholds[:, None]) & ~matched
+        best = np.argmax(np.where(ok, ious[d], -1), axis=1)
+        hit = ok[rows, best]
+        matched[rows[hit], best[hit]] = True
+        tp[d] = hit
+    return tp
+
+
+def precision_recall(tp, scores, n_gt):
+    """Precision and recall curves of a class
+
+    Arguments:
+        tp (tensor): (n_detections, n_thresholds) true positives
+        scores (array): (n_detections,) detection scores
+        n_gt (int): Number of ground truth bboxes
+
+    Returns:
+        precision, recall (tensor): (n_detections, n_thresholds) 
+            curves by decreasing score
+    """
+    order = np.argsort(-scores, kind='mergesort')
+    tp = tp[order]
+    tp_sum = np.cumsum(tp, axis=0)
+    fp_sum = np.cumsum(~tp, axis=0)
+    precision = tp_sum / np.maximum(tp_sum + fp_sum, 1)
+    recall = tp_sum / max(n_gt, 1)
+    return precision, recall
+
+
+def interpolated_ap(precision, recall, recall_points):
+    """Average of interpolated precision at recall points
+
+    Arguments:
+        precision, recall (tensor): (n_detections, n_thresholds) curves
+        recall_points (array): Recall levels, eg 11 for VOC 
+            and 101 for COCO
+
+    Returns:
+        ap (array): (n_thresholds,) average precision per IoU threshold
+    """
+    n_thresholds = precision.shape[1]
+    if precision.shape[0] == 0:
+        return np.zeros(n_thresholds)
+    # precision envelope: max precision at recall >= r
+    envelope = np.maximum.accumulate(precision[::-1], axis=0)[::-1]
+    ap = np.empty(n_thresholds)
+    for t in range(n_thresholds):
+        # recall is non decreasing per column
+        index = np.searchsorted(recall[:, t], recall_points, side='left')
+        valid = index < len(envelope)
+        p = np.zeros(len(recall_points))
+        p[valid] = envelope[index[valid], t]
+        ap[t] = np.mean(p)
+    return ap
+
+
+class DetectionMetrics:
+    """Accumulates detections and ground truth of a test set.
+
+    Arguments:
+        n_classes (int): Number of classes including background (0)
+        iou_thresholds (array): IoU thresholds for AP
+    """
+    def __init__(self, n_classes, iou_thresholds=COCO_IOU_THRESHOLDS):
+        self.n_classes = n_classes
+        self.iou_thresholds = np.asarray(iou_thresholds, dtype=float)
+        self.tp = [[] for _ in range(n_classes)]
+        self.scores = [[] for _ in range(n_classes)]
+        self.n_gt = np.zeros(n_classes, dtype=int)
+        self.n_images = 0
+
+
+    def add(self, gt_boxes, gt_class_ids, boxes, class_ids, scores):
+        """Add ground truth and detections of an image"""
+        gt_boxes = np.reshape(np.asarray(gt_boxes, dtype=float), (-1, 4))
+        gt_class_ids = np.asarray(gt_class_ids).astype(int)
+        boxes = np.reshape(np.asarray(boxes, dtype=float), (-1, 4))
+        class_ids = np.asarray(class_ids).astype(int)
+        scores = np.asarray(scores, dtype=float)
+
+        self.n_images += 1
+        self.n_gt += np.bincount(gt_class_ids, minlength=self.n_classes)
+        if len(boxes) == 0:
+            return
+
+        order = np.argsort(-scores, kind='mergesort')
+        boxes = boxes[order]
+        class_ids = class_ids[order]
+        scores = scores[order]
+
+        ious = iou(boxes, gt_boxes)
+        # detections are only matched w/ ground truth of the same class
+        same_class = class_ids[:, None] == gt_class_ids[None, :]
+        ious = np.where(same_class, ious, -1)
+        tp = match_detections(ious, self.iou_thresholds)
+        for class_id in np.unique(class_ids):
+            mask = class_ids == class_id
+            self.tp[class_id].append(tp[mask])
+            self.scores[class_id].append(scores[mask])
+
+
+    def evaluate(self):
+        """AP per class and mAP over classes w/ ground truth
+
+        Returns:
+            results (dict):
+                ap_voc (array): (n_classes,) VOC 11-point AP at IoU 0.5
+                ap_coco (array): (n_classes, n_thresholds) 101-point AP
+                map_voc (float): mean of ap_voc
+                map_coco (float): mean of ap_coco over classes and 
+                    thresholds (COCO AP@[.50:.95])
+                map_50, map_75 (float): COCO mAP at IoU 0.5 and 0.75
+                    (nan if not an IoU threshold)
+        """
+        n_thresholds = len(self.iou_thresholds)
+        ap_voc = np.full(self.n_classes, np.nan)
+        ap_coco = np.full((self.n_classes, n_thresholds), np.nan)
+        # VOC AP is at IoU 0.5
+        voc_index = np.flatnonzero(np.isclose(self.iou_thresholds, 0.5))
+        voc_points = np.linspace(0, 1, 11)
+        coco_points = np.linspace(0, 1, 101)
+        # skip background
+        for class_id in range(1, self.n_classes):
+            if self.n_gt[class_id] == 0:
+                continue
+            if self.tp[class_id]:
+                tp = np.concatenate(self.tp[class_id])
+                scores = np.concatenate(self.scores[class_id])
+            else:
+                tp = np.zeros((0, n_thresholds), dtype=bool)
+                scores = np.zeros(0)
+            precision, recall = precision_recall(tp,
+                                                 scores,
+                                                 self.n_gt[class_id])
+            ap_coco[class_id] = interpolated_ap(precision,
+                                                recall,
+                                                coco_points)
+            if len(voc_index) > 0:
+                i = voc_index[0]
+                ap_voc[class_id] = interpolated_ap(precision[:, i:i+1],
+                                                   recall[:, i:i+1],
+                                                   voc_points)[0]
+
+        has_gt = self.n_gt[1:] > 0
+        results = {
+            'ap_voc': ap_voc,
+            'ap_coco': ap_coco,
+            'map_voc': np.nan,
+            'map_coco': np.nan,
+            'map_50': np.nan,
+            'map_75': np.nan,
+        }
+        if not np.any(has_gt):
+            return results
+
+        ap_coco = ap_coco[1:][has_gt]
+        results['map_voc'] = np.mean(ap_voc[1:][has_gt])
+        results['map_coco'] = np.mean(ap_coco)
+        for key, threshold in (('map_50', 0.5), ('map_75', 0.75)):
+            index = np.flatnonzero(np.isclose(self.iou_thresholds, threshold))
+            if len(index) > 0:
+                results[key] = np.mean(ap_coco[:, index[0]])
+        return results
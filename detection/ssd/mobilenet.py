@@ -0,0 +1,120 @@
+"""MobileNet model builder as SSD backbone
+
+Depthwise separable convolutions w/ a width multiplier (alpha)
+for real-time detection on CPU.
+
+MobileNets: Efficient Convolutional Neural Networks for 
+Mobile Vision Applications
+https://arxiv.org/pdf/1704.04861.pdf
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from tensorflow.keras.layers import Conv2D, DepthwiseConv2D
+from tensorflow.keras.layers import BatchNormalization, ReLU, Input
+from tensorflow.keras.models import Model
+
+
+def make_divisible(filters, divisor=8):
+    """Round number of filters to a multiple of divisor"""
+    return max(divisor, int(filters + divisor / 2) // divisor * divisor)
+
+
+def conv_bn_relu(inputs,
+                 filters,
+                 kernel_size=3,
+                 strides=1,
+                 name=None):
+    """Conv2D-BN-ReLU6 (stem of the network)"""
+    x = Conv2D(filters,
+               kernel_size=kernel_size,
+               strides=strides,
+               padding='same',
+               use_bias=False,
+               kernel_initializer='he_normal',
+               name=name)(inputs)
+    x = BatchNormalization(name=name + '_bn')(x)
+    return ReLU(6., name=name + '_relu')(x)
+
+
+def separable_layer(inputs,
+                    filters,
+                    strides=1,
+                    name=None):
+    """3x3 DepthwiseConv2D-BN-ReLU6 then 1x1 Conv2D-BN-ReLU6
+
+    Arguments:
+        inputs (tensor): Input tensor from previous layer
+        filters (int): Number of pointwise filters
+        strides (int): Depthwise conv strides
+        name (string): Layer names prefix
+
+    Returns:
+        x (tensor): Tensor as input to the next layer
+    """
+    x = DepthwiseConv2D(kernel_size=3,
+                        strides=strides,
+                        padding='same',
+                        use_bias=False,
+                        name=name + '_dw')(inputs)
+    x = BatchNormalization(name=name + '_dw_bn')(x)
+    x = ReLU(6., name=name + '_dw_relu')(x)
+    return conv_bn_relu(x, filters, kernel_size=1, name=name + '_pw')
+
+
+def build_mobilenet(input_shape,
+                    n_layers=4,
+                    alpha=1.0):
+    """Build a MobileNet as backbone of SSD. Like the ResNet 
+    backbone, the 1st feature map is 1/16 of the input size and
+    each additional feature map halves the previous one.
+
+    Arguments:
+        input_shape (list): Input image size and channels
+        n_layers (int): Number of feature layers for SSD
+        alpha (float): Width multiplier of the number of filters
+
+    Returns:
+        model (Keras Model)
+    """
+    def filters(n):
+        return make_divisible(n * alpha)
+
+    inputs = Input(shape=input_shape)
+    # 1/2
+    x = conv_bn_relu(inputs, filters(32), strides=2, name='conv1')
+    x = separable_layer(x, filters(64), name='sep1')
+    # 1/4
+    x = separable_layer(x, filters(128), strides=2, name='sep2')
+    x = separable_layer(x, filters(128), name='sep3')
+    # 1/8
+    x = separable_layer(x, filters(256), strides=2, name='sep4')
+    x = separable_layer(x, filters(256), name='sep5')
+    # 1/16
+    x = separable_layer(x, filters(512), strides=2, name='sep6')
+    for i in range(5):
+        x = separable_layer(x, filters(512), name='sep' + str(i + 7))
+
+    # 1st feature map layer
+    outputs = [x]
+    prev_conv = x
+    n_filters = 256
+
+    # additional feature map layers
+    for i in range(n_layers - 1):
+        name = "sep_layer" + str(i + 2)
+        conv = separable_layer(prev_conv,
+                               filters(n_filters),
+                               strides=2,
+                               name=name)
+        outputs.append(conv)
+        prev_conv = conv
+
+    name = 'MobileNet%d' % int(round(alpha * 100))
+    model = Model(inputs=inputs,
+                  outputs=outputs,
+                  name=name)
+    return model
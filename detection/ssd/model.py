@@ -10,7 +10,7 @@ from __future__ import unicode_literals
 from tensorflow.keras.layers import Activation, Dense, Input
 from tensorflow.keras.layers import Conv2D, Flatten
 from tensorflow.keras.layers import BatchNormalization, Concatenate
-from tensorflow.keras.layers import ELU, MaxPooling2D, Reshape
+from tensorflow.keras.layers import ELU, MaxPooling2D, Reshape, Lambda
 from tensorflow.keras.models import Model
 from tensorflow.keras import backend as K
 
@@ -57,7 +57,8 @@ def build_ssd(input_shape,
               backbone,
               n_layers=4,
               n_classes=4,
-              aspect_ratios=(1, 2, 0.5)):
+              aspect_ratios=(1, 2, 0.5),
+              rescale_input=False):
     """Build SSD model given a backbone
 
     Arguments:
@@ -66,6 +67,9 @@ def build_ssd(input_shape,
         n_layers (int): Number of layers of ssd head
         n_classes (int): Number of obj classes
         aspect_ratios (list): annchor box aspect ratios
+        rescale_input (bool): Input is uint8 (0 to 255) and is 
+            converted to float (0.0 to 1.0) by the model.
+            Weights are the same as w/o rescale_input.
 
     Returns:
         n_anchors (int): Number of anchor boxes per feature pt
@@ -75,9 +79,15 @@ def build_ssd(input_shape,
     # number of anchor boxes per feature map pt
     n_anchors = len(aspect_ratios) + 1
 
-    inputs = Input(shape=input_shape)
+    if rescale_input:
+        inputs = Input(shape=input_shape, dtype='uint8')
+        images = Lambda(lambda x: K.cast(x, K.floatx()) / 255.0,
+                        name='rescale')(inputs)
+    else:
+        inputs = Input(shape=input_shape)
+        images = inputs
     # no. of base_outputs depends on n_layers
-    base_outputs = backbone(inputs)
+    base_outputs = backbone(images)
     
     outputs = []
     feature_shapes = []
@@ -10,6 +10,14 @@ from __future__ import unicode_literals
 import config
 import argparse
 from resnet import build_resnet
+from mobilenet import build_mobilenet
+
+
+# backbone networks by name (--backbone)
+BACKBONES = {
+    'resnet': build_resnet,
+    'mobilenet': build_mobilenet,
+}
 
 def lr_scheduler(epoch):
     """Learning rate scheduler - called every epoch"""
@@ -35,6 +43,24 @@ def lr_scheduler(epoch):
     return lr
 
 
+def build_backbone(args, input_shape):
+    """Build the backbone network selected by args.backbone,
+    a name in BACKBONES or a builder function"""
+    backbone = args.backbone
+    if not callable(backbone):
+        backbone = BACKBONES[backbone]
+    if backbone is build_mobilenet:
+        return backbone(input_shape,
+                        n_layers=args.layers,
+                        alpha=args.width_multiplier)
+    return backbone(input_shape, n_layers=args.layers)
+
+
+def parse_floats(values):
+    """Comma separated values to list of floats eg "0.1,0.2" """
+    return [float(value) for value in values.split(",")]
+
+
 def ssd_parser():
     """Instatiate a command line parser for ssd network model
     building, training, and testing
@@ -61,14 +87,108 @@ def ssd_parser():
                         default=4,
                         type=int,
                         help=help_)
+    help_ = "Use tf.data input pipeline instead of data generator"
+    parser.add_argument("--tf-data",
+                        default=False,
+                        action='store_true',
+                        help=help_)
+    help_ = "Encode ground truth w/ tf ops instead of NumPy (tf.data)"
+    parser.add_argument("--tf-encode",
+                        default=False,
+                        action='store_true',
+                        help=help_)
+    help_ = "Number of shards of train dataset (tf.data)"
+    parser.add_argument("--num-shards",
+                        default=1,
+                        type=int,
+                        help=help_)
+    help_ = "Index of train dataset shard to use (tf.data)"
+    parser.add_argument("--shard-index",
+                        default=0,
+                        type=int,
+                        help=help_)
     help_ = "Labels IoU threshold"
     parser.add_argument("--threshold",
                         default=0.6,
                         type=float,
                         help=help_)
+    help_ = "Match anchors w/ IoU of all anchor boxes instead of grid index"
+    parser.add_argument("--dense-matching",
+                        default=False,
+                        action='store_true',
+                        help=help_)
+    help_ = "Ship ground truth of positive anchor boxes only to the loss"
+    parser.add_argument("--sparse-targets",
+                        default=False,
+                        action='store_true',
+                        help=help_)
+    help_ = "Rows per image of sparse ground truth"
+    parser.add_argument("--max-positives",
+                        default=256,
+                        type=int,
+                        help=help_)
     help_ = "Backbone or base network"
     parser.add_argument("--backbone",
-                        default=build_resnet,
+                        default="resnet",
+                        choices=sorted(BACKBONES.keys()),
+                        help=help_)
+    help_ = "Width multiplier of the number of filters of mobilenet"
+    parser.add_argument("--width-multiplier",
+                        default=1.0,
+                        type=float,
+                        help=help_)
+    help_ = "Train the model by distillation from a teacher model"
+    parser.add_argument("--distill",
+                        default=False,
+                        action='store_true',
+                        help=help_)
+    help_ = "Teacher h5 model trained weights"
+    parser.add_argument("--teacher-weights",
+                        default=None,
+                        help=help_)
+    help_ = "Teacher backbone network"
+    parser.add_argument("--teacher-backbone",
+                        default="resnet",
+                        choices=sorted(BACKBONES.keys()),
+                        help=help_)
+    help_ = "Teacher width multiplier of mobilenet"
+    parser.add_argument("--teacher-width-multiplier",
+                        default=1.0,
+                        type=float,
+                        help=help_)
+    help_ = "Weight of teacher targets vs ground truth (0.0 to 1.0)"
+    parser.add_argument("--distill-alpha",
+                        default=0.5,
+                        type=float,
+                        help=help_)
+    help_ = "Softening temperature of teacher and student classes"
+    parser.add_argument("--distill-temperature",
+                        default=1.0,
+                        type=float,
+                        help=help_)
+    help_ = "Prune conv filters of the model (fine-tune w/ --train)"
+    parser.add_argument("--prune",
+                        default=False,
+                        action='store_true',
+                        help=help_)
+    help_ = "Fraction of filters removed per prunable conv"
+    parser.add_argument("--prune-ratio",
+                        default=0.5,
+                        type=float,
+                        help=help_)
+    help_ = "Filter ranking: magnitude (L1 norm) or activation"
+    parser.add_argument("--prune-method",
+                        default="magnitude",
+                        choices=["magnitude", "activation"],
+                        help=help_)
+    help_ = "Number of train batches for activation ranking"
+    parser.add_argument("--prune-batches",
+                        default=10,
+                        type=int,
+                        help=help_)
+    help_ = "Pruned model architecture (json in save_dir)"
+    parser.add_argument("--pruned-model",
+                        default=None,
                         help=help_)
     help_ = "Train the model"
     parser.add_argument("--train",
@@ -129,6 +249,24 @@ def ssd_parser():
     parser.add_argument("--train-labels",
                         default="labels_train.csv",
                         help=help_)
+    help_ = "Directory of the pre-encoded ground truth store"
+    parser.add_argument("--target-store",
+                        default=None,
+                        help=help_)
+    help_ = "Encode ground truth of train labels in --target-store"
+    parser.add_argument("--encode",
+                        default=False,
+                        action='store_true',
+                        help=help_)
+    help_ = "Directory of pre-decoded uint8 train images"
+    parser.add_argument("--image-store",
+                        default=None,
+                        help=help_)
+    help_ = "Decode train images in the image store"
+    parser.add_argument("--decode-images",
+                        default=False,
+                        action='store_true',
+                        help=help_)
     help_ = "Test labels csv file name"
     parser.add_argument("--test-labels",
                         default="labels_test.csv",
@@ -147,6 +285,64 @@ def ssd_parser():
     parser.add_argument("--image-file",
                         default=None,
                         help=help_)
+    help_ = "XLA compile the single image predict function"
+    parser.add_argument("--jit-compile",
+                        default=False,
+                        action='store_true', 
+                        help=help_)
+    help_ = "Benchmark single image predict latency w/ this many runs"
+    parser.add_argument("--benchmark-predict",
+                        default=0,
+                        type=int,
+                        help=help_)
+    help_ = "Export SavedModel w/ in-graph decoding and NMS to this dir"
+    parser.add_argument("--export-saved-model",
+                        default=None,
+                        help=help_)
+    help_ = "Export int8 TFLite model to this file"
+    parser.add_argument("--export-tflite",
+                        default=None,
+                        help=help_)
+    help_ = "Number of train images for int8 calibration"
+    parser.add_argument("--calibration-images",
+                        default=100,
+                        type=int,
+                        help=help_)
+    help_ = "Run inference w/ this TFLite model"
+    parser.add_argument("--tflite",
+                        default=None,
+                        help=help_)
+    help_ = "Number of test images per model call during evaluation"
+    parser.add_argument("--eval-batch-size",
+                        default=8,
+                        type=int,
+                        help=help_)
+    help_ = "JSONL file of test detections (resumes if it exists)"
+    parser.add_argument("--eval-results",
+                        default=None,
+                        help=help_)
+    help_ = "Directory of cached raw predictions of test images"
+    parser.add_argument("--prediction-cache",
+                        default=None,
+                        help=help_)
+    help_ = "Evaluate test set mAP on a grid of NMS settings"
+    parser.add_argument("--sweep",
+                        default=False,
+                        action='store_true', 
+                        help=help_)
+    help_ = "Comma separated class thresholds of the sweep"
+    parser.add_argument("--sweep-class-thresholds",
+                        default="0.3,0.4,0.5,0.6,0.7",
+                        help=help_)
+    help_ = "Comma separated NMS IoU thresholds of the sweep"
+    parser.add_argument("--sweep-iou-thresholds",
+                        default="0.1,0.2,0.3,0.4,0.5",
+                        help=help_)
+    help_ = "Sweep both hard and soft NMS"
+    parser.add_argument("--sweep-soft-nms",
+                        default=False,
+                        action='store_true', 
+                        help=help_)
     help_ = "Class probability threshold (>= is an object)"
     parser.add_argument("--class-threshold",
                         default=0.5,
@@ -162,6 +358,21 @@ def ssd_parser():
                         default=False,
                         action='store_true', 
                         help=help_)
+    help_ = "Soft NMS score decay: gaussian or linear"
+    parser.add_argument("--soft-nms-method",
+                        default="gaussian",
+                        choices=["gaussian", "linear"],
+                        help=help_)
+    help_ = "Soft NMS gaussian decay sigma"
+    parser.add_argument("--soft-nms-sigma",
+                        default=0.5,
+                        type=float,
+                        help=help_)
+    help_ = "Max number of top scoring candidates given to NMS"
+    parser.add_argument("--nms-top-k",
+                        default=200,
+                        type=int,
+                        help=help_)
 
     # debug configuration
     help_ = "Level of verbosity for print function"
@@ -0,0 +1,183 @@
+"""Motion gated inference for static camera scenes
+
+Frames are compared w/ the last inferred frame on downscaled and
+blurred grayscale images. While the scene is static, inference is
+skipped and the last detections are reused. Optionally, the detector
+only runs on a crop around the changed regions.
+
+Boxes are in minmax format (xmin, xmax, ymin, ymax).
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import cv2
+import numpy as np
+
+
+class MotionGate:
+    """Frame differencing gate.
+
+    Arguments:
+        threshold (float): Min fraction of changed pixels to run
+            inference
+        pixel_threshold (int): Min gray level difference of a
+            changed pixel
+        scale (float): Downscaling of frames before differencing
+        padding (int): Padding in pixels of the changed region
+        max_crop (float): Max fraction of the frame covered by the
+            changed region to detect on a crop
+    """
+    def __init__(self,
+                 threshold=0.01,
+                 pixel_threshold=25,
+                 scale=0.25,
+                 padding=32,
+                 max_crop=0.5):
+        self.threshold = threshold
+        self.pixel_threshold = pixel_threshold
+        self.scale = scale
+        self.padding = padding
+        self.max_crop = max_crop
+        # downscaled gray frame of the last inference
+        self.reference = None
+        self.frames = 0
+        self.inferences = 0
+
+
+    def preprocess(self, image):
+        """Downscaled and blurred grayscale of a BGR frame"""
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        gray = cv2.resize(gray,
+                          None,
+                          fx=self.scale,
+                          fy=self.scale,
+                          interpolation=cv2.INTER_AREA)
+        return cv2.GaussianBlur(gray, (5, 5), 0)
+
+
+    def update(self, image):
+        """Compare a BGR frame w/ the last inferred frame
+
+        Returns:
+            moving (bool): If inference should run on the frame
+            region (array): Changed region in minmax format
+                (frame coordinates) or None for the whole frame
+                (1st frame or region larger than max_crop)
+        """
+        self.frames += 1
+        gray = self.preprocess(image)
+        if self.reference is None:
+            self.reference = gray
+            self.inferences += 1
+            return True, None
+
+        diff = cv2.absdiff(gray, self.reference)
+        mask = diff > self.pixel_threshold
+        # no changed pixel is static even w/ a zero threshold
+        if not np.any(mask) or np.mean(mask) < self.threshold:
+            return False, None
+
+        # changes are relative to the last inferred frame so that
+        # slow changes add up
+        self.reference = gray
+        self.inferences += 1
+        ys, xs = np.nonzero(mask)
+        height, width = image.shape[:2]
+        region = np.array([xs.min() / self.scale - self.padding,
+                           (xs.max() + 1) / self.scale + self.padding,
+                           ys.min() / self.scale - self.padding,
+                           (ys.max() + 1) / self.scale + self.padding])
+        region = np.clip(region, 0, [width, width, height, height])
+        area = (region[1] - region[0]) * (region[3] - region[2])
+        if area > self.max_crop * width * height:
+            return True, None
+        return True, region
+
+
+    def saved(self):
+        """Fraction of frames w/o inference"""
+        return 1.0 - self.inferences / max(self.frames, 1)
+
+
+def fit_aspect(region, width, height):
+    """Grow a region to the aspect ratio of the width x height
+    frame so that resizing the crop does not distort objects
+
+    Arguments:
+        region (array): Region in minmax format
+        width, height (int): Frame size
+
+    Returns:
+        region (array): Region in minmax format inside the frame
+    """
+    xmin, xmax, ymin, ymax = region
+    w = max(xmax - xmin, 1.0)
+    h = max(ymax - ymin, 1.0)
+    aspect = width / height
+    if w / h < aspect:
+        w = h * aspect
+    else:
+        h = w / aspect
+    # the frame has the same aspect ratio so w and h fit together
+    w = min(w, width)
+    h = min(h, height)
+    # same center, shifted inside the frame
+    xmin = np.clip((xmin + xmax - w) / 2, 0, width - w)
+    ymin = np.clip((ymin + ymax - h) / 2, 0, height - h)
+    return np.array([xmin, xmin + w, ymin, ymin + h])
+
+
+def detect_crop(detector, image, region):
+    """Detect objects on a crop of an image resized to the
+    model input size. The crop is the region grown to the aspect
+    ratio of the image. Detections outside the region are dropped
+    (see merge_detections).
+
+    Arguments:
+        detector (SSD): Object detector w/ detect_batch()
+        image (tensor): RGB image (0.0 to 1.0)
+        region (array): Crop in minmax format
+
+    Returns:
+        boxes (tensor): Boxes in minmax format (image coordinates)
+        class_ids, scores (array): Classes and scores
+    """
+    height, width = image.shape[:2]
+    crop_region = fit_aspect(region, width, height)
+    xmin, xmax, ymin, ymax = np.round(crop_region).astype(int)
+    crop = image[ymin:ymax, xmin:xmax]
+    crop = cv2.resize(crop.astype(np.float32), (width, height))
+    boxes, class_ids, scores, valid_counts = \
+            detector.detect_batch(crop[None])
+    n = valid_counts[0]
+    boxes = boxes[0, :n].astype(float)
+    # crop to image coordinates
+    boxes[:, 0:2] = boxes[:, 0:2] * (xmax - xmin) / width + xmin
+    boxes[:, 2:4] = boxes[:, 2:4] * (ymax - ymin) / height + ymin
+    # previous detections outside the region are kept
+    inside = (boxes[:, 1] > region[0]) & (boxes[:, 0] < region[1]) \
+             & (boxes[:, 3] > region[2]) & (boxes[:, 2] < region[3])
+    return boxes[inside], class_ids[0, :n][inside], scores[0, :n][inside]
+
+
+def merge_detections(previous, current, region):
+    """Replace the previous detections that overlap the region
+    w/ the current (crop) detections
+
+    Arguments:
+        previous, current (tuple): boxes, class_ids, scores
+        region (array): Region in minmax format
+
+    Returns:
+        boxes, class_ids, scores
+    """
+    boxes, class_ids, scores = previous
+    outside = (boxes[:, 1] <= region[0]) | (boxes[:, 0] >= region[1]) \
+              | (boxes[:, 3] <= region[2]) | (boxes[:, 2] >= region[3])
+    return (np.concatenate([boxes[outside], current[0]]),
+            np.concatenate([class_ids[outside], current[1]]),
+            np.concatenate([scores[outside], current[2]]))
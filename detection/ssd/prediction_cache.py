@@ -0,0 +1,73 @@
+"""Cache of raw SSD predictions (classes and offsets) per test image
+
+Post-processing (NMS) and metrics can be rerun w/ other thresholds
+without the network forward pass. Predictions are saved in 
+compressed npz files under a directory named after a hash of the
+model weights. The file name is a hash of the image file contents.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import hashlib
+import threading
+import numpy as np
+
+
+def weights_hash(model):
+    """Hash of the weights of a keras model"""
+    sha = hashlib.sha1()
+    for weights in model.get_weights():
+        sha.update(str(weights.shape).encode())
+        sha.update(np.ascontiguousarray(weights).tobytes())
+    return sha.hexdigest()
+
+
+def file_hash(filename):
+    """Hash of the contents of a file"""
+    sha = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class PredictionCache:
+    """Raw predictions per image of a given model weights.
+
+    Arguments:
+        path (string): Cache directory
+        weights_hash (string): Hash of model weights
+    """
+    def __init__(self, path, weights_hash):
+        self.path = os.path.join(path, weights_hash[:16])
+        os.makedirs(self.path, exist_ok=True)
+
+
+    def filename(self, image_file):
+        """Cache file of an image"""
+        name = file_hash(image_file)[:24] + ".npz"
+        return os.path.join(self.path, name)
+
+
+    def get(self, filename):
+        """Cached classes and offsets or None if not yet cached"""
+        if not os.path.isfile(filename):
+            return None
+        with np.load(filename) as data:
+            return data['classes'], data['offsets']
+
+
+    def put(self, filename, classes, offsets):
+        """Save classes and offsets of an image"""
+        # write to a temp file then rename so that readers 
+        # never see a partial file
+        temp = "%s.%d.%d.tmp.npz" % (filename,
+                                     os.getpid(),
+                                     threading.get_ident())
+        np.savez_compressed(temp, classes=classes, offsets=offsets)
+        os.replace(temp, filename)
@@ -0,0 +1,321 @@
+"""Structured filter pruning of the ssd model
+
+Conv2D filters are ranked by the L1 norm of their kernel (magnitude)
+or by the mean absolute activation on DataGenerator batches
+(activation). The lowest ranked filters are removed: a narrower
+model is rebuilt from the model config and the remaining weights
+are copied over.
+
+A Conv2D is prunable if its output only goes through channel-wise
+layers (eg BatchNormalization, activations, pooling, depthwise conv)
+to other Conv2D layers, whose input channels are then removed too.
+Convs feeding an Add (residual shortcut), a Reshape (ssd heads) or
+a model output keep all their filters.
+
+python3 ssd.py --restore-weights=<weights.h5> --prune --prune-ratio=0.5
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import copy
+import numpy as np
+
+from tensorflow.keras.models import Model
+
+
+# layers that process each channel independently
+CHANNELWISE = ('BatchNormalization', 'Activation', 'ReLU', 'ELU',
+               'LeakyReLU', 'MaxPooling2D', 'AveragePooling2D',
+               'Dropout', 'DepthwiseConv2D', 'InputLayer')
+# nested models (eg backbone)
+NESTED = ('Functional', 'Model')
+
+
+def history(inbound):
+    """(layer name, tensor index) of the inbound tensors of a layer
+    in a model config"""
+    if isinstance(inbound, dict):
+        config = inbound.get('config')
+        if isinstance(config, dict) and 'keras_history' in config:
+            name, _, index = config['keras_history'][0:3]
+            yield name, index
+            return
+        for value in inbound.values():
+            for item in history(value):
+                yield item
+    elif isinstance(inbound, (list, tuple)):
+        if len(inbound) >= 3 and isinstance(inbound[0], str) \
+                and isinstance(inbound[1], int) \
+                and isinstance(inbound[2], int):
+            yield inbound[0], inbound[2]
+            return
+        for value in inbound:
+            for item in history(value):
+                yield item
+
+
+class LayerGraph:
+    """Graph of the layers of a model config. Layers of nested
+    models are named <model name>/<layer name> and connected
+    to the layers of the outer model.
+
+    Arguments:
+        config (dict): Functional model config
+    """
+    def __init__(self, config):
+        # layer config by name
+        self.layers = {}
+        # names of inbound layers by name
+        self.inputs = {}
+        # output layers of nested models
+        self.nested = {}
+        self.outputs = set(self.parse(config))
+        self.consumers = {name: [] for name in self.layers}
+        for name, inputs in self.inputs.items():
+            for inbound in inputs:
+                self.consumers[inbound].append(name)
+
+
+    def parse(self, config, prefix="", outer_inputs=None):
+        """Add the layers of a model config, returns its output layers"""
+        def resolve(name, index):
+            name = prefix + name
+            if name in self.nested:
+                return self.nested[name][index]
+            return name
+
+        for layer in config['layers']:
+            name = prefix + layer['name']
+            inputs = [resolve(*item) for item in
+                      history(layer['inbound_nodes'])]
+            if layer['class_name'] in NESTED:
+                self.nested[name] = self.parse(layer['config'],
+                                               name + "/",
+                                               inputs)
+                continue
+            if layer['class_name'] == 'InputLayer' \
+                    and outer_inputs is not None:
+                inputs = outer_inputs
+            self.layers[name] = layer
+            self.inputs[name] = inputs
+
+        return [resolve(*item) for item in history(config['output_layers'])]
+
+
+    def class_name(self, name):
+        return self.layers[name]['class_name']
+
+
+    def prunable_groups(self):
+        """Prunable convs and the layers affected by their filters
+
+        Returns:
+            groups (dict): Key is conv name, value is a dict of
+                channelwise (layers after the conv), terminals (convs
+                w/ the conv filters as input channels) and leaves
+                (layers w/ outputs feeding terminals)
+        """
+        groups = {}
+        for name in self.layers:
+            if not self.is_conv(name):
+                continue
+            channelwise = []
+            terminals = []
+            leaves = []
+            stack = [name]
+            prunable = True
+            while stack and prunable:
+                current = stack.pop()
+                consumers = self.consumers[current]
+                if current in self.outputs or len(consumers) == 0:
+                    prunable = False
+                    break
+                for consumer in consumers:
+                    if self.is_conv(consumer):
+                        terminals.append(consumer)
+                        if current not in leaves:
+                            leaves.append(current)
+                    elif self.class_name(consumer) in CHANNELWISE:
+                        channelwise.append(consumer)
+                        stack.append(consumer)
+                    else:
+                        prunable = False
+            if prunable and terminals:
+                groups[name] = {'channelwise': channelwise,
+                                'terminals': terminals,
+                                'leaves': leaves}
+        return groups
+
+
+    def is_conv(self, name):
+        """Plain (not grouped, not depthwise) Conv2D"""
+        layer = self.layers[name]
+        return layer['class_name'] == 'Conv2D' \
+               and layer['config'].get('groups', 1) == 1
+
+
+def get_layer(model, name):
+    """Layer of a model or of a nested model by LayerGraph name"""
+    for part in name.split("/"):
+        model = model.get_layer(part)
+    return model
+
+
+def layer_config(config, name):
+    """Layer config of a model config by LayerGraph name"""
+    parts = name.split("/")
+    for part in parts[:-1]:
+        config = [layer for layer in config['layers']
+                  if layer['name'] == part][0]['config']
+    return [layer for layer in config['layers']
+            if layer['name'] == parts[-1]][0]
+
+
+def magnitude_scores(model, groups):
+    """L1 norm of each filter of prunable convs"""
+    scores = {}
+    for name in groups:
+        kernel = get_layer(model, name).get_weights()[0]
+        scores[name] = np.sum(np.abs(kernel), axis=(0, 1, 2))
+    return scores
+
+
+def activation_scores(model, groups, generator, n_batches=10):
+    """Mean absolute activation of each filter of prunable convs
+    measured at the inputs of the convs that consume them"""
+    # probe models per scope (model or nested model)
+    leaves = sorted(set(leaf for group in groups.values()
+                        for leaf in group['leaves']))
+    scopes = {}
+    for leaf in leaves:
+        scope, _, _ = leaf.rpartition("/")
+        scopes.setdefault(scope, []).append(leaf)
+
+    probes = []
+    for scope, names in scopes.items():
+        if scope == "":
+            inner = model
+            feed = None
+        else:
+            # nested model is fed by the outer model
+            inner = get_layer(model, scope)
+            graph = LayerGraph(model.get_config())
+            inputs = graph.inputs[scope + "/" + inner.layers[0].name]
+            feed = Model(model.inputs, get_layer(model, inputs[0]).output)
+        outputs = [get_layer(inner, name.rpartition("/")[2]).output
+                   for name in names]
+        probes.append((feed, Model(inner.inputs, outputs), names))
+
+    sums = {leaf: 0 for leaf in leaves}
+    n_batches = min(n_batches, len(generator))
+    for index in range(n_batches):
+        x, _ = generator[index]
+        for feed, probe, names in probes:
+            inputs = x if feed is None else feed.predict(x)
+            outputs = probe.predict(inputs)
+            if len(names) == 1:
+                outputs = [outputs]
+            for name, output in zip(names, outputs):
+                sums[name] += np.mean(np.abs(output), axis=(0, 1, 2))
+
+    scores = {}
+    for name, group in groups.items():
+        scores[name] = sum(sums[leaf] for leaf in group['leaves'])
+    return scores
+
+
+def prune_model(model,
+                ratio=0.5,
+                method='magnitude',
+                generator=None,
+                n_batches=10,
+                divisor=8):
+    """Remove the lowest ranked filters of prunable convs
+
+    Arguments:
+        model (model): Keras model (eg ssd)
+        ratio (float): Fraction of filters to remove per conv
+        method (string): magnitude or activation ranking
+        generator (DataGenerator): Batches for activation ranking
+        n_batches (int): Number of batches for activation ranking
+        divisor (int): Number of remaining filters is a multiple
+            of divisor
+
+    Returns:
+        pruned (model): Narrower model w/ the remaining weights
+        kept (dict): Key is conv name, value is kept filter indexes
+    """
+    config = model.get_config()
+    graph = LayerGraph(config)
+    groups = graph.prunable_groups()
+    if method == 'activation':
+        scores = activation_scores(model, groups, generator, n_batches)
+    else:
+        scores = magnitude_scores(model, groups)
+
+    # kept filters per prunable conv
+    kept = {}
+    for name, score in scores.items():
+        filters = len(score)
+        n_keep = int(round(filters * (1 - ratio) / divisor)) * divisor
+        n_keep = min(filters, max(divisor, n_keep))
+        if n_keep == filters:
+            continue
+        keep = np.argsort(-score, kind='mergesort')[:n_keep]
+        kept[name] = np.sort(keep)
+
+    # narrower model
+    config = copy.deepcopy(config)
+    for name, keep in kept.items():
+        layer_config(config, name)['config']['filters'] = len(keep)
+    strip_build_config(config)
+    pruned = model.__class__.from_config(config)
+
+    # remaining weights: output channels of pruned convs and
+    # their channelwise layers, input channels of terminal convs
+    out_keep = dict(kept)
+    in_keep = {}
+    for name, keep in kept.items():
+        for layer in groups[name]['channelwise']:
+            out_keep[layer] = keep
+        for layer in groups[name]['terminals']:
+            in_keep[layer] = keep
+
+    for name in graph.layers:
+        weights = get_layer(model, name).get_weights()
+        if not weights:
+            continue
+        class_name = graph.class_name(name)
+        if class_name == 'Conv2D':
+            if name in in_keep:
+                weights[0] = weights[0][:, :, in_keep[name], :]
+            if name in out_keep:
+                keep = out_keep[name]
+                weights[0] = weights[0][..., keep]
+                weights[1:] = [weight[keep] for weight in weights[1:]]
+        elif name in out_keep:
+            keep = out_keep[name]
+            if class_name == 'DepthwiseConv2D':
+                weights[0] = weights[0][:, :, keep, :]
+                weights[1:] = [weight[keep] for weight in weights[1:]]
+            else:
+                # eg BatchNormalization
+                weights = [weight[keep] for weight in weights]
+        get_layer(pruned, name).set_weights(weights)
+
+    return pruned, kept
+
+
+def strip_build_config(config):
+    """Remove saved layer input shapes that pruning makes stale"""
+    if isinstance(config, dict):
+        config.pop('build_config', None)
+        for value in config.values():
+            strip_build_config(value)
+    elif isinstance(config, list):
+        for value in config:
+            strip_build_config(value)
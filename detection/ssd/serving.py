@@ -0,0 +1,237 @@
+"""End-to-end SSD serving model
+
+A post-processing head decodes predicted offsets against constant
+anchor boxes and performs NMS w/ tf.image.combined_non_max_suppression.
+The resulting single graph maps images to final detections and is 
+exported as a SavedModel, served w/o the NumPy post-processing.
+
+python3 ssd.py --restore-weights=<weights.h5> --export-saved-model=<dir>
+
+Parity check of the head against the NumPy boxes.batch_nms:
+
+python3 serving.py
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.layers import Layer
+from tensorflow.keras.models import Model
+
+import layer_utils
+from boxes import batch_nms
+from tf_layer_utils import tf_decode_offsets
+
+
+class DetectionHead(Layer):
+    """Decoding and NMS of ssd class and offset predictions.
+
+    Arguments:
+        anchor_bank (AnchorBank): Anchor boxes of all ssd head layers
+        normalize (bool): If offsets are normalized (Equation 11.4.8)
+        class_threshold (float): Min score of a detection
+        iou_threshold (float): NMS IoU threshold
+        max_detections (int): Detections per image after padding
+
+    Outputs:
+        boxes (tensor): (batch, max_detections, 4) boxes in 
+            minmax format sorted by decreasing score
+        scores (tensor): (batch, max_detections) scores
+        class_ids (tensor): (batch, max_detections) class ids
+        valid_detections (tensor): (batch,) number of valid detections.
+            Entries past valid_detections are zero padding.
+    """
+    def __init__(self,
+                 anchor_bank,
+                 normalize=False,
+                 class_threshold=0.5,
+                 iou_threshold=0.2,
+                 max_detections=200,
+                 **kwargs):
+        super(DetectionHead, self).__init__(**kwargs)
+        self.anchors = tf.constant(anchor_bank.minmax, dtype=tf.float32)
+        self.anchors_centroid = tf.constant(anchor_bank.centroid,
+                                            dtype=tf.float32)
+        self.normalize = normalize
+        self.class_threshold = class_threshold
+        self.iou_threshold = iou_threshold
+        self.max_detections = max_detections
+
+
+    def call(self, inputs):
+        classes, offsets = inputs
+        boxes = tf_decode_offsets(tf.cast(offsets, tf.float32),
+                                  self.anchors,
+                                  self.anchors_centroid,
+                                  normalize=self.normalize)
+        # combined nms boxes are (ymin, xmin, ymax, xmax) 
+        # shared by all classes
+        boxes = tf.stack([boxes[..., 2],
+                          boxes[..., 0],
+                          boxes[..., 3],
+                          boxes[..., 1]], axis=-1)
+        boxes = tf.expand_dims(boxes, axis=2)
+        # only the argmax class of an anchor is a candidate like in
+        # boxes.batch_nms, anchors of argmax background are dropped
+        classes = tf.cast(classes, tf.float32)
+        argmax = tf.one_hot(tf.argmax(classes, axis=-1), classes.shape[-1])
+        # skip background class 0
+        scores = (classes * argmax)[..., 1:]
+        # top max_detections candidates by score before NMS (nms_top_k
+        # of boxes.batch_suppress)
+        k = min(self.max_detections, self.anchors.shape[0])
+        _, top = tf.math.top_k(tf.reduce_max(scores, axis=-1), k=k)
+        boxes = tf.gather(boxes, top, batch_dims=1)
+        scores = tf.gather(scores, top, batch_dims=1)
+        # coordinates are in pixels so no clipping to [0, 1]
+        nms = tf.image.combined_non_max_suppression(
+                boxes,
+                scores,
+                max_output_size_per_class=self.max_detections,
+                max_total_size=self.max_detections,
+                iou_threshold=self.iou_threshold,
+                score_threshold=self.class_threshold,
+                clip_boxes=False)
+        boxes = nms.nmsed_boxes
+        boxes = tf.stack([boxes[..., 1],
+                          boxes[..., 3],
+                          boxes[..., 0],
+                          boxes[..., 2]], axis=-1)
+        class_ids = tf.cast(nms.nmsed_classes, tf.int32) + 1
+        return boxes, nms.nmsed_scores, class_ids, nms.valid_detections
+
+
+def build_serving_model(ssd, anchor_bank, args):
+    """Append the detection head to an ssd model
+
+    Arguments:
+        ssd (model): SSD network model w/ classes and offsets outputs
+        anchor_bank (AnchorBank): Anchor boxes of all ssd head layers
+        args : User-defined configurations (normalize and NMS settings)
+
+    Returns:
+        model (model): Images to boxes, scores, class_ids and 
+            valid_detections
+
+    Raises:
+        ValueError: Soft-NMS is not supported by the detection head
+    """
+    if args.soft_nms:
+        # combined_non_max_suppression only performs hard NMS
+        raise ValueError("Soft-NMS is not supported by the serving "
+                         "model, export w/o --soft-nms")
+    head = DetectionHead(anchor_bank,
+                         normalize=args.normalize,
+                         class_threshold=args.class_threshold,
+                         iou_threshold=args.iou_threshold,
+                         max_detections=args.nms_top_k,
+                         name='detections')
+    outputs = head(ssd.outputs)
+    return Model(inputs=ssd.inputs,
+                 outputs=outputs,
+                 name='ssd_serving')
+
+
+def export_saved_model(model, path):
+    """Export a serving model as a SavedModel w/ a batched
+    serving_default signature"""
+    inputs = model.inputs[0]
+    shape = (None,) + tuple(inputs.shape[1:])
+    signature = [tf.TensorSpec(shape, inputs.dtype, name='images')]
+
+    @tf.function(input_signature=signature)
+    def serve(images):
+        boxes, scores, class_ids, valid_detections = model(images,
+                                                           training=False)
+        return {'boxes': boxes,
+                'scores': scores,
+                'class_ids': class_ids,
+                'valid_detections': valid_detections}
+
+    module = tf.Module()
+    module.model = model
+    module.serve = serve
+    tf.saved_model.save(module, path, signatures={'serving_default': serve})
+
+
+def check_parity(batch_size=4,
+                 n_classes=4,
+                 n_layers=4,
+                 n_tests=5,
+                 seed=0):
+    """Compare DetectionHead with the NumPy reference 
+    boxes.batch_nms on random predictions.
+
+    combined_non_max_suppression suppresses boxes w/ IoU > iou_threshold
+    while boxes.hard_suppress suppresses IoU >= iou_threshold. Results
+    only differ if an IoU is exactly the threshold, which random 
+    predictions do not hit.
+    """
+    image_shape = (480, 640, 3)
+    feature_shapes = [(image_shape[0] // (32 * 2**i),
+                       image_shape[1] // (32 * 2**i),
+                       16) for i in range(n_layers)]
+    anchor_bank = layer_utils.get_anchor_bank(feature_shapes,
+                                              image_shape,
+                                              n_layers=n_layers)
+    n_boxes = len(anchor_bank)
+    rng = np.random.RandomState(seed)
+    for test in range(n_tests):
+        logits = rng.normal(0, 2, (batch_size, n_boxes, n_classes))
+        classes = np.exp(logits)
+        classes /= np.sum(classes, axis=-1, keepdims=True)
+        offsets = rng.normal(0, 4, (batch_size, n_boxes, 8))
+        # class thresholds below 0.5 have anchors w/ several 
+        # non-background classes above threshold
+        for class_threshold, nms_top_k in ((0.3, 200),
+                                           (0.3, n_boxes),
+                                           (0.5, 200)):
+            args = argparse.Namespace(normalize=False,
+                                      class_threshold=class_threshold,
+                                      iou_threshold=0.2,
+                                      soft_nms=False,
+                                      nms_top_k=nms_top_k)
+            boxes, class_ids, scores, valid_counts = \
+                    batch_nms(args, classes, offsets, anchor_bank)
+            head = DetectionHead(anchor_bank,
+                                 class_threshold=class_threshold,
+                                 iou_threshold=args.iou_threshold,
+                                 max_detections=args.nms_top_k)
+            tf_boxes, tf_scores, tf_class_ids, tf_valid_counts = \
+                    head([classes.astype(np.float32),
+                          offsets.astype(np.float32)])
+            np.testing.assert_array_equal(valid_counts,
+                                          tf_valid_counts.numpy())
+            for i, n in enumerate(valid_counts):
+                # order of (near) equal scores may differ
+                tf_scores_i = tf_scores[i, :n].numpy()
+                tf_class_ids_i = tf_class_ids[i, :n].numpy()
+                order = np.lexsort((scores[i, :n], class_ids[i, :n]))
+                tf_order = np.lexsort((tf_scores_i, tf_class_ids_i))
+                np.testing.assert_array_equal(class_ids[i, order],
+                                              tf_class_ids_i[tf_order])
+                np.testing.assert_allclose(scores[i, order],
+                                           tf_scores_i[tf_order],
+                                           rtol=1e-5)
+                np.testing.assert_allclose(boxes[i, order],
+                                           tf_boxes[i, :n].numpy()[tf_order],
+                                           rtol=1e-4,
+                                           atol=1e-3)
+    print("Detection head and NumPy NMS match (%d tests)" % n_tests)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Detection head parity')
+    help_ = "Number of random batches"
+    parser.add_argument("--tests",
+                        default=5,
+                        type=int,
+                        help=help_)
+    args = parser.parse_args()
+    check_parity(n_tests=args.tests)
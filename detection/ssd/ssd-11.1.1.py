@@ -26,7 +26,8 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import tensorflow as tf
-from tensorflow.keras.models import load_model
+from tensorflow.keras.models import load_model, model_from_json
+from tensorflow.keras.models import Model
 from tensorflow.keras.optimizers import Adam
 from tensorflow.keras import backend as K
 from tensorflow.keras.callbacks import ModelCheckpoint
@@ -38,18 +39,34 @@ import label_utils
 import config
 
 import os
+import copy
 import skimage
 import numpy as np
 import argparse
 
 from skimage.io import imread
 from data_generator import DataGenerator
+from target_store import TargetStore
+from image_store import ImageStore
+from tf_dataset import build_dataset
+from evaluator import Evaluator, NMS_SETTINGS
+from distillation import DistillationGenerator, distillation_loss
+from metrics import DetectionMetrics
+from prediction_cache import PredictionCache, weights_hash, file_hash
+from tflite_utils import TFLiteDetector, representative_dataset
+from tflite_utils import convert_int8
+from serving import build_serving_model, export_saved_model
+from pruning import prune_model
 from label_utils import build_label_dictionary
-from boxes import show_boxes
+from layer_utils import get_anchor_bank
+from boxes import show_boxes, batch_nms
 from model import build_ssd
 from loss import focal_loss_categorical, smooth_l1_loss, l1_loss
-from model_utils import lr_scheduler, ssd_parser
+from loss import sparse_loss, sparse_to_dense_class, sparse_to_dense_offset
+from model_utils import lr_scheduler, ssd_parser, parse_floats
+from model_utils import build_backbone
 from common_utils import print_log
+from benchmark import latencies, print_latencies, count_macs
 
 
 class SSD:
@@ -70,8 +87,13 @@ class SSD:
         """
         self.args = args
         self.ssd = None
+        self.predict_fn = None
         self.train_generator = None
         self.build_model()
+        # optional int8 TFLite model for inference
+        self.tflite = None
+        if self.args.tflite:
+            self.tflite = TFLiteDetector(self.args.tflite)
 
 
     def build_model(self):
@@ -88,15 +110,18 @@ class SSD:
         # the number of feature layers is equal to n_layers
         # feature layers are inputs to SSD network heads
         # for class and offsets predictions
-        self.backbone = self.args.backbone(self.input_shape,
-                                           n_layers=self.args.layers)
+        self.backbone = build_backbone(self.args, self.input_shape)
 
         # using the backbone, build ssd network
         # outputs of ssd are class and offsets predictions
+        # w/ image store, uint8 images are converted to float 
+        # by the model itself
+        rescale_input = self.args.image_store is not None
         anchors, features, ssd = build_ssd(self.input_shape,
                                            self.backbone,
                                            n_layers=self.args.layers,
-                                           n_classes=self.n_classes)
+                                           n_classes=self.n_classes,
+                                           rescale_input=rescale_input)
         # n_anchors = num of anchors per feature point (eg 4)
         self.n_anchors = anchors
         # feature_shapes is a list of feature map shapes
@@ -104,6 +129,76 @@ class SSD:
         self.feature_shapes = features
         # ssd network model
         self.ssd = ssd
+        if self.args.pruned_model:
+            self.load_pruned_model()
+        # anchor boxes of all feature maps are computed once
+        self.anchor_bank = get_anchor_bank(self.feature_shapes,
+                                           self.input_shape,
+                                           n_layers=self.args.layers)
+
+
+    def load_pruned_model(self):
+        """Replace the ssd model w/ a pruned architecture (json). 
+        Anchor boxes are the same as the unpruned model."""
+        save_dir = os.path.join(os.getcwd(), self.args.save_dir)
+        filename = os.path.join(save_dir, self.args.pruned_model)
+        log = "Loading pruned model: %s" % filename
+        print_log(log, self.args.verbose)
+        with open(filename) as f:
+            self.ssd = model_from_json(f.read())
+        self.backbone = [layer for layer in self.ssd.layers
+                         if isinstance(layer, Model)][0]
+
+
+    def prune(self):
+        """Remove the lowest ranked conv filters, report MACs, params
+        and latency before and after, and save the pruned model 
+        architecture (json) and weights (h5) in save_dir. 
+        Fine-tune w/ --train."""
+        generator = None
+        if self.args.prune_method == 'activation':
+            if self.train_generator is None:
+                self.build_generator()
+            generator = self.train_generator
+
+        pruned, kept = prune_model(self.ssd,
+                                   ratio=self.args.prune_ratio,
+                                   method=self.args.prune_method,
+                                   generator=generator,
+                                   n_batches=self.args.prune_batches)
+        log = "Pruned %d convs by %s" % (len(kept), self.args.prune_method)
+        print_log(log, self.args.verbose)
+
+        dtype = np.uint8 if self.args.image_store else np.float32
+        image = tf.constant(np.zeros((1,) + self.input_shape, dtype=dtype))
+        for name, model in [('before', self.ssd), ('after', pruned)]:
+            predict_fn = tf.function(lambda x: model(x, training=False))
+            times = latencies(lambda: predict_fn(image), runs=20, warmup=3)
+            log = "%s: %0.2f GMACs, %0.2f Mparams, p50 %0.2fms" \
+                  % (name,
+                     count_macs(model) / 1e9,
+                     model.count_params() / 1e6,
+                     np.percentile(times, 50))
+            print_log(log, self.args.verbose)
+
+        self.ssd = pruned
+        self.backbone = [layer for layer in self.ssd.layers
+                         if isinstance(layer, Model)][0]
+        self.predict_fn = None
+
+        save_dir = os.path.join(os.getcwd(), self.args.save_dir)
+        if not os.path.isdir(save_dir):
+            os.makedirs(save_dir)
+        name = "%s-%dlayer-pruned%d" % (self.backbone.name,
+                                        self.args.layers,
+                                        int(100 * self.args.prune_ratio))
+        filename = os.path.join(save_dir, name + ".json")
+        with open(filename, "w") as f:
+            f.write(self.ssd.to_json())
+        self.ssd.save_weights(os.path.join(save_dir, name + ".h5"))
+        log = "Pruned model: %s (--pruned-model=%s)" % (filename,
+                                                        name + ".json")
+        print_log(log, self.args.verbose)
 
 
     def build_dictionary(self):
@@ -122,8 +217,44 @@ class SSD:
         self.keys = np.array(list(self.dictionary.keys()))
 
 
+    def build_target_store(self):
+        """Encode ground truth of images w/o up-to-date rows
+        in the target store."""
+        path = self.args.target_store
+        if path is None:
+            # training only reads the store given by --target-store
+            raise ValueError("--encode needs --target-store")
+        target_store = TargetStore(path,
+                                   self.anchor_bank,
+                                   self.n_classes,
+                                   normalize=self.args.normalize,
+                                   threshold=self.args.threshold,
+                                   verbose=self.args.verbose)
+        target_store.update(self.dictionary)
+        return target_store
+
+
+    def build_image_store(self):
+        """Decode train images in the image store if not yet done"""
+        path = self.args.image_store
+        if path is None:
+            path = os.path.join(self.args.data_path, "images")
+        image_store = ImageStore(path, verbose=self.args.verbose)
+        if not image_store.is_complete(self.keys, self.input_shape):
+            image_store.build(self.keys,
+                              self.args.data_path,
+                              self.input_shape)
+        return image_store
+
+
     def build_generator(self):
         """Build a multi-thread train data generator."""
+        target_store = None
+        if self.args.target_store:
+            target_store = self.build_target_store()
+        image_store = None
+        if self.args.image_store:
+            image_store = self.build_image_store()
 
         self.train_generator = \
                 DataGenerator(args=self.args,
@@ -131,13 +262,15 @@ class SSD:
                               n_classes=self.n_classes,
                               feature_shapes=self.feature_shapes,
                               n_anchors=self.n_anchors,
-                              shuffle=True)
+                              shuffle=True,
+                              target_store=target_store,
+                              image_store=image_store)
 
 
     def train(self):
         """Train an ssd network."""
         # build the train data generator
-        if self.train_generator is None:
+        if self.train_generator is None and not self.args.tf_data:
             self.build_generator()
 
         optimizer = Adam(lr=1e-3)
@@ -152,6 +285,28 @@ class SSD:
             print_log("Cross-entropy and L1", self.args.verbose)
             loss = ['categorical_crossentropy', l1_loss]
 
+        if self.args.distill:
+            print_log("Distillation from teacher", self.args.verbose)
+            if self.args.sparse_targets or self.args.tf_data:
+                raise ValueError("Distillation needs dense targets "
+                                 "from the data generator")
+            generator = DistillationGenerator(
+                    self.train_generator,
+                    self.build_teacher(),
+                    alpha=self.args.distill_alpha,
+                    temperature=self.args.distill_temperature)
+            loss[0] = distillation_loss(
+                    loss[0],
+                    alpha=self.args.distill_alpha,
+                    temperature=self.args.distill_temperature)
+        else:
+            generator = self.train_generator
+
+        if self.args.sparse_targets:
+            print_log("Sparse ground truth", self.args.verbose)
+            loss = [sparse_loss(loss[0], sparse_to_dense_class),
+                    sparse_loss(loss[1], sparse_to_dense_offset)]
+
         self.ssd.compile(optimizer=optimizer, loss=loss)
 
         # model weights are saved for future validation
@@ -169,6 +324,12 @@ class SSD:
         if self.args.threshold < 1.0:
             model_name += "-extra_anchors" 
 
+        if self.args.distill:
+            model_name += "-distill"
+
+        if self.args.prune or self.args.pruned_model:
+            model_name += "-pruned"
+
         model_name += "-" 
         model_name += self.args.dataset
         model_name += '-{epoch:03d}.h5'
@@ -194,13 +355,53 @@ class SSD:
 
         callbacks = [checkpoint, scheduler]
         # train the ssd network
-        self.ssd.fit_generator(generator=self.train_generator,
-                               use_multiprocessing=True,
+        if self.args.tf_data:
+            print_log("tf.data input pipeline", self.args.verbose)
+            dataset, steps = build_dataset(self.args,
+                                           self.dictionary,
+                                           self.n_classes,
+                                           self.anchor_bank)
+            self.ssd.fit(dataset,
+                         steps_per_epoch=steps,
+                         callbacks=callbacks,
+                         epochs=self.args.epochs)
+            return
+
+        # the teacher runs in the worker threads 
+        use_multiprocessing = not self.args.distill
+        self.ssd.fit_generator(generator=generator,
+                               use_multiprocessing=use_multiprocessing,
                                callbacks=callbacks,
                                epochs=self.args.epochs,
                                workers=self.args.workers)
 
 
+    def build_teacher(self):
+        """Build the teacher ssd model and load its trained weights
+        (--teacher-weights). Anchor boxes must be the same as the 
+        student ones."""
+        teacher_args = copy.copy(self.args)
+        teacher_args.backbone = self.args.teacher_backbone
+        teacher_args.width_multiplier = self.args.teacher_width_multiplier
+        backbone = build_backbone(teacher_args, self.input_shape)
+        rescale_input = self.args.image_store is not None
+        _, features, teacher = build_ssd(self.input_shape,
+                                         backbone,
+                                         n_layers=self.args.layers,
+                                         n_classes=self.n_classes,
+                                         rescale_input=rescale_input)
+        if [tuple(shape) for shape in features] != \
+                [tuple(shape) for shape in self.feature_shapes]:
+            raise ValueError("Teacher and student feature maps differ")
+
+        save_dir = os.path.join(os.getcwd(), self.args.save_dir)
+        filename = os.path.join(save_dir, self.args.teacher_weights)
+        log = "Loading teacher weights: %s" % filename
+        print_log(log, self.args.verbose)
+        teacher.load_weights(filename)
+        return teacher
+
+
     def restore_weights(self):
         """Load previously trained model weights"""
         if self.args.restore_weights:
@@ -211,15 +412,103 @@ class SSD:
             self.ssd.load_weights(filename)
 
 
+    def build_predict_fn(self):
+        """Single image inference as a tf.function w/ a fixed input
+        signature. It is traced once and reused on every call, 
+        avoiding the per call overhead of Model.predict.
+        """
+        dtype = tf.uint8 if self.args.image_store else tf.float32
+        signature = [tf.TensorSpec((1,) + self.input_shape, dtype)]
+        # XLA compilation is optional
+        options = {}
+        if self.args.jit_compile:
+            options['jit_compile'] = True
+        model = self.ssd
+
+        @tf.function(input_signature=signature, **options)
+        def predict_fn(image):
+            return model(image, training=False)
+
+        self.predict_fn = predict_fn
+        return predict_fn
+
+
+    def predict(self, image):
+        """Raw class and offset predictions of a single image
+        (image is expanded to a batch of 1) using predict_fn"""
+        dtype = np.uint8 if self.args.image_store else np.float32
+        image = np.expand_dims(image, axis=0).astype(dtype)
+        if self.tflite is not None:
+            return self.tflite.predict(image)
+        if self.predict_fn is None:
+            self.build_predict_fn()
+        classes, offsets = self.predict_fn(tf.constant(image))
+        return classes.numpy(), offsets.numpy()
+
+
     def detect_objects(self, image):
-        image = np.expand_dims(image, axis=0)
-        classes, offsets = self.ssd.predict(image)
-        image = np.squeeze(image, axis=0)
+        if self.args.image_store:
+            # model input is uint8
+            image = skimage.img_as_ubyte(image)
+        classes, offsets = self.predict(image)
         classes = np.squeeze(classes)
         offsets = np.squeeze(offsets)
         return image, classes, offsets
 
 
+    def benchmark_predict(self, runs=100):
+        """p50 and p99 latencies of single image inference of the
+        compiled predict_fn vs Model.predict"""
+        dtype = np.uint8 if self.args.image_store else np.float32
+        image = np.random.uniform(0, 1, self.input_shape)
+        if self.args.image_store:
+            image = image * 255
+        image = image.astype(dtype)
+        batch = np.expand_dims(image, axis=0)
+        print_log("Single image latency of %d runs" % runs,
+                  self.args.verbose)
+        times = latencies(lambda: self.predict(image), runs=runs)
+        print_latencies("predict_fn", times)
+        times = latencies(lambda: self.ssd.predict(batch), runs=runs)
+        print_latencies("Model.predict", times)
+
+
+    def detect_batch(self, images):
+        """Detect objects on a batch of images. Decoding and NMS
+        are performed on the whole batch at once.
+
+        Arguments:
+            images (tensor): (batch, height, width, channels) images
+
+        Returns:
+            boxes, class_ids, scores, valid_counts (tensor): Padded 
+                detections per image (see boxes.batch_nms)
+        """
+        classes, offsets = self.predict_batch(images)
+        return self.postprocess(classes, offsets)
+
+
+    def predict_batch(self, images):
+        """Raw class and offset predictions of a batch of images"""
+        if self.args.image_store:
+            # model input is uint8
+            images = skimage.img_as_ubyte(images)
+        if len(images) == 1:
+            # single frames (video path) w/o Model.predict overhead
+            return self.predict(images[0])
+        if self.tflite is not None:
+            return self.tflite.predict(images)
+        return self.ssd.predict(images)
+
+
+    def postprocess(self, classes, offsets, args=None):
+        """Batched decoding and NMS of raw predictions
+        (args overrides the NMS settings of self.args)"""
+        if args is None:
+            args = self.args
+        return batch_nms(args, classes, offsets, self.anchor_bank)
+
+
     def evaluate(self, image_file=None, image=None):
         """Evaluate image based on image (np tensor) or filename"""
         show = False
@@ -228,7 +517,7 @@ class SSD:
             show = True
 
         image, classes, offsets = self.detect_objects(image)
-        class_names, rects, _, _ = show_boxes(args,
+        class_names, rects, _, _ = show_boxes(self.args,
                                               image,
                                               classes,
                                               offsets,
@@ -237,13 +526,107 @@ class SSD:
         return class_names, rects
 
 
-    def evaluate_test(self):
+    def export_saved_model(self, path):
+        """Export the ssd model w/ in-graph decoding and NMS"""
+        model = build_serving_model(self.ssd, self.anchor_bank, self.args)
+        export_saved_model(model, path)
+        print_log("Exported serving model to %s" % path,
+                  self.args.verbose)
+
+
+    def export_tflite(self, path):
+        """Export the ssd model to int8 TFLite and compare 
+        its test set mAP w/ the float model"""
+        if self.train_generator is None:
+            self.build_generator()
+        dtype = np.uint8 if self.args.image_store else np.float32
+        dataset = representative_dataset(self.train_generator,
+                                         self.args.calibration_images,
+                                         dtype=dtype)
+        tflite_model = convert_int8(self.ssd, dataset)
+        with open(path, "wb") as f:
+            f.write(tflite_model)
+        log = "Exported int8 TFLite model to %s (%0.1f MB)" \
+              % (path, len(tflite_model) / 2**20)
+        print_log(log, self.args.verbose)
+        self.tflite_parity(path)
+
+
+    def tflite_parity(self, path):
+        """Test set mAP of the float model vs TFLite model"""
+        tflite = self.tflite
+        self.tflite = None
+        float_results = self.evaluate_map()
+        self.tflite = TFLiteDetector(path)
+        tflite_results = self.evaluate_map()
+        self.tflite = tflite
+        for key in ['map_voc', 'map_coco']:
+            log = "%s float: %f  int8: %f  delta: %f" \
+                  % (key,
+                     float_results[key],
+                     tflite_results[key],
+                     tflite_results[key] - float_results[key])
+            print_log(log, self.args.verbose)
+
+
+    def build_test_dictionary(self):
+        """Test dictionary and its keys (image filenames)"""
         # test labels csv path
         path = os.path.join(self.args.data_path,
                             self.args.test_labels)
-        # test dictionary
         dictionary, _ = build_label_dictionary(path)
         keys = np.array(list(dictionary.keys()))
+        return dictionary, keys
+
+
+    def evaluate_map(self):
+        """Test set mAP results (see metrics.DetectionMetrics)"""
+        dictionary, keys = self.build_test_dictionary()
+        detections = self.build_evaluator().run(keys, self.args.data_path)
+        metrics = DetectionMetrics(self.n_classes)
+        for key in keys:
+            labels = np.array(dictionary[key])
+            metrics.add(labels[:, 0:-1],
+                        labels[:, -1],
+                        detections[key]['boxes'],
+                        detections[key]['class_ids'],
+                        detections[key]['scores'])
+        return metrics.evaluate()
+
+
+    def build_evaluator(self, results_file=None):
+        """Evaluation engine w/ the raw prediction cache if enabled"""
+        cache = None
+        settings = None
+        if self.args.prediction_cache is not None or results_file:
+            # raw predictions depend on the model that made them
+            if self.tflite is not None:
+                model_hash = file_hash(self.tflite.model_path)
+            else:
+                model_hash = weights_hash(self.ssd)
+            # detections also depend on the NMS settings
+            settings = {'model': model_hash}
+            for name in NMS_SETTINGS:
+                settings[name] = getattr(self.args, name)
+        if self.args.prediction_cache is not None:
+            cache = PredictionCache(self.args.prediction_cache, model_hash)
+        return Evaluator(self,
+                         batch_size=self.args.eval_batch_size,
+                         workers=self.args.workers,
+                         results_file=results_file,
+                         settings=settings,
+                         cache=cache,
+                         verbose=self.args.verbose)
+
+
+    def evaluate_test(self):
+        # test dictionary
+        dictionary, keys = self.build_test_dictionary()
+        # detect objects on all test images
+        evaluator = self.build_evaluator(self.args.eval_results)
+        detections = evaluator.run(keys, self.args.data_path)
+        # mAP over the test set
+        metrics = DetectionMetrics(self.n_classes)
         # sum of precision
         s_precision = 0
         # sum of recall
@@ -258,19 +641,14 @@ class SSD:
             gt_boxes = labels[:, 0:-1]
             # last one is class
             gt_class_ids = labels[:, -1]
-            # load image id by key
-            image_file = os.path.join(self.args.data_path, key)
-            image = skimage.img_as_float(imread(image_file))
-            image, classes, offsets = self.detect_objects(image)
-            # perform nms
-            _, _, class_ids, boxes = show_boxes(args,
-                                                image,
-                                                classes,
-                                                offsets,
-                                                self.feature_shapes,
-                                                show=False)
-
-            boxes = np.reshape(np.array(boxes), (-1,4))
+            # detected objects after nms
+            boxes = detections[key]['boxes']
+            class_ids = detections[key]['class_ids']
+            metrics.add(gt_boxes,
+                        gt_class_ids,
+                        boxes,
+                        class_ids,
+                        detections[key]['scores'])
             # compute IoUs
             iou = layer_utils.iou(gt_boxes, boxes)
             # skip empty IoUs
@@ -309,6 +687,52 @@ class SSD:
                   self.args.verbose)
         print_log("Recall : %f" % (s_recall/n_test),
                   self.args.verbose)
+        results = metrics.evaluate()
+        print_log("mAP (VOC 11-point, IoU 0.5): %f" % results['map_voc'],
+                  self.args.verbose)
+        print_log("mAP (COCO, IoU 0.50:0.95): %f" % results['map_coco'],
+                  self.args.verbose)
+        print_log("mAP (COCO, IoU 0.50): %f" % results['map_50'],
+                  self.args.verbose)
+        print_log("mAP (COCO, IoU 0.75): %f" % results['map_75'],
+                  self.args.verbose)
+
+
+    def sweep(self):
+        """Test set mAP on a grid of NMS settings. Only post-processing
+        is repeated per setting (see --prediction-cache)."""
+        dictionary, keys = self.build_test_dictionary()
+
+        class_thresholds = parse_floats(self.args.sweep_class_thresholds)
+        iou_thresholds = parse_floats(self.args.sweep_iou_thresholds)
+        soft_nms = [False, True] if self.args.sweep_soft_nms \
+                   else [self.args.soft_nms]
+        grid = [{'class_threshold': class_threshold,
+                 'iou_threshold': iou_threshold,
+                 'soft_nms': soft}
+                for soft in soft_nms
+                for class_threshold in class_thresholds
+                for iou_threshold in iou_thresholds]
+
+        evaluator = self.build_evaluator()
+        results = evaluator.sweep(keys,
+                                  self.args.data_path,
+                                  dictionary,
+                                  self.n_classes,
+                                  grid)
+        # best settings first
+        results.sort(key=lambda result: 
+                     -np.nan_to_num(result[1]['map_coco']))
+        print_log("class_thr  iou_thr  soft_nms  mAP_VOC  mAP_COCO",
+                  self.args.verbose)
+        for settings, metrics in results:
+            log = "%9.2f  %7.2f  %8s  %7.4f  %8.4f" \
+                  % (settings['class_threshold'],
+                     settings['iou_threshold'],
+                     settings['soft_nms'],
+                     metrics['map_voc'],
+                     metrics['map_coco'])
+            print_log(log, self.args.verbose)
 
 
     def print_summary(self):
@@ -330,13 +754,36 @@ if __name__ == '__main__':
     if args.summary:
         ssd.print_summary()
 
+    if args.encode:
+        ssd.build_target_store()
+
+    if args.decode_images:
+        ssd.build_image_store()
+
     if args.restore_weights:
         ssd.restore_weights()
+
+    if args.prune:
+        ssd.prune()
+
+    if args.export_tflite:
+        ssd.export_tflite(args.export_tflite)
+
+    # evaluate trained weights or a TFLite model
+    if args.restore_weights or args.tflite:
+        if args.sweep:
+            ssd.sweep()
         if args.evaluate:
             if args.image_file is None:
                 ssd.evaluate_test()
             else:
                 ssd.evaluate(image_file=args.image_file)
             
+    if args.export_saved_model:
+        ssd.export_saved_model(args.export_saved_model)
+
+    if args.benchmark_predict > 0:
+        ssd.benchmark_predict(args.benchmark_predict)
+
     if args.train:
         ssd.train()
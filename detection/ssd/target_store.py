@@ -0,0 +1,199 @@
+"""Encoded target store
+
+Ground truth classes, offsets and masks depend only on the labels
+and the anchor boxes. They are encoded once and saved in one
+memory-mapped float32 array w/ a row per image. Each row is tagged
+w/ a hash of the image labels, anchor boxes, and encoding settings
+so only images whose labels changed are encoded again.
+
+python3 ssd.py --encode --target-store=dataset/drinks/targets
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import json
+import hashlib
+import numpy as np
+
+from layer_utils import get_gt_data_batch, pad_labels
+from common_utils import print_log
+
+
+class TargetStore:
+    """A (n_images, n_boxes, n_classes + 8) float32 array saved as .npy
+    made of gt_class, gt_offset and gt_mask (same layout as the
+    generator y), and an index of image filename (dictionary key) to
+    array row and labels hash.
+
+    Arguments:
+        path (string): Directory of the target store
+        anchor_bank (AnchorBank): Anchor boxes of all ssd head layers
+        n_classes (int): Number of object classes
+        normalize (bool): If normalization should be applied
+        threshold (float): If less than 1.0, anchor boxes>threshold
+            are also part of positive anchor boxes
+        verbose (int): Level of verbosity for print function
+    """
+    def __init__(self,
+                 path,
+                 anchor_bank,
+                 n_classes,
+                 normalize=False,
+                 threshold=0.6,
+                 verbose=1):
+        self.path = path
+        self.anchor_bank = anchor_bank
+        self.n_classes = n_classes
+        self.normalize = normalize
+        self.threshold = threshold
+        self.verbose = verbose
+        self.data_file = os.path.join(path, "targets.npy")
+        self.index_file = os.path.join(path, "index.json")
+        self.targets = None
+        # key to (row, labels hash)
+        self.index = {}
+        if os.path.isfile(self.index_file):
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+
+        # encoding settings shared by all rows
+        params = hashlib.sha1()
+        params.update(np.ascontiguousarray(anchor_bank.minmax).tobytes())
+        settings = (n_classes, bool(normalize), float(threshold))
+        params.update(repr(settings).encode())
+        self.params_hash = params.hexdigest()
+
+
+    def __getstate__(self):
+        """Memory map is not pickled but opened again by workers"""
+        state = self.__dict__.copy()
+        state['targets'] = None
+        return state
+
+
+    def open(self):
+        """Memory map the target array"""
+        if self.targets is None:
+            self.targets = np.load(self.data_file, mmap_mode='r')
+        return self.targets
+
+
+    def labels_hash(self, labels):
+        """Hash of the labels of an image and the encoding settings"""
+        labels_hash = hashlib.sha1(self.params_hash.encode())
+        labels = np.array(labels, dtype=np.float32)
+        labels_hash.update(np.ascontiguousarray(labels).tobytes())
+        return labels_hash.hexdigest()
+
+
+    def stale_keys(self, dictionary):
+        """Keys of images w/o an up-to-date row"""
+        if not os.path.isfile(self.data_file):
+            return list(dictionary.keys())
+        return [key for key, labels in dictionary.items()
+                if key not in self.index
+                or self.index[key][1] != self.labels_hash(labels)]
+
+
+    def update(self, dictionary, batch_size=32):
+        """Encode the targets of images whose row is missing
+        or out of date. Rows of images no longer in dictionary
+        are removed.
+
+        Arguments:
+            dictionary : Dictionary of image filenames and object labels
+            batch_size (int): Number of images encoded at once
+
+        Returns:
+            n_encoded (int): Number of images encoded
+        """
+        stale = self.stale_keys(dictionary)
+        if not stale and len(self.index) == len(dictionary):
+            print_log("Encoded targets: 0 of %d images" % len(dictionary),
+                      self.verbose)
+            return 0
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        # rows follow the dictionary order
+        keys = list(dictionary.keys())
+        rows = {key: i for i, key in enumerate(keys)}
+        n_boxes = len(self.anchor_bank)
+        tmp_file = self.data_file + ".tmp"
+        dim = (len(keys), n_boxes, self.n_classes + 8)
+        targets = np.lib.format.open_memmap(tmp_file,
+                                            mode='w+',
+                                            dtype=np.float32,
+                                            shape=dim)
+
+        # up-to-date rows are copied from the previous array
+        stale_set = set(stale)
+        if os.path.isfile(self.data_file):
+            previous = self.open()
+            for key in keys:
+                if key not in stale_set:
+                    targets[rows[key]] = previous[self.index[key][0]]
+
+        for start in range(0, len(stale), batch_size):
+            batch_keys = stale[start : start + batch_size]
+            labels, counts = pad_labels([dictionary[key]
+                                         for key in batch_keys])
+            batch = np.zeros((len(batch_keys), *dim[1:]), dtype=np.float32)
+            get_gt_data_batch(labels,
+                              counts,
+                              self.anchor_bank,
+                              batch[..., 0:self.n_classes],
+                              batch[..., self.n_classes:self.n_classes + 4],
+                              batch[..., self.n_classes + 4:],
+                              normalize=self.normalize,
+                              threshold=self.threshold)
+            targets[[rows[key] for key in batch_keys]] = batch
+
+        targets.flush()
+        del targets
+        self.targets = None
+        os.replace(tmp_file, self.data_file)
+
+        index = {str(key): [rows[key], self.labels_hash(dictionary[key])]
+                 for key in keys}
+        with open(self.index_file + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(self.index_file + ".tmp", self.index_file)
+        self.index = index
+
+        log = "Encoded targets: %d of %d images" % (len(stale),
+                                                    len(dictionary))
+        print_log(log, self.verbose)
+        return len(stale)
+
+
+    def get(self, key):
+        """Memory-mapped (n_boxes, n_classes + 8) targets of image key"""
+        return self.open()[self.index[key][0]]
+
+
+    def gather(self, keys):
+        """float32 targets of images keys. A view of the memory map
+        if the rows are consecutive, otherwise a single copy.
+
+        Arguments:
+            keys (array): Image filenames (dictionary keys)
+
+        Returns:
+            gt_class (tensor): (batch, n_boxes, n_classes) output classes
+            gt_offset_mask (tensor): (batch, n_boxes, 8) output offsets
+                and masks
+        """
+        rows = np.array([self.index[key][0] for key in keys], dtype=int)
+        targets = self.open()
+        if len(rows) > 0 and np.all(np.diff(rows) == 1):
+            targets = targets[rows[0] : rows[-1] + 1]
+        else:
+            targets = np.take(targets, rows, axis=0)
+        return targets[..., 0:self.n_classes], targets[..., self.n_classes:]
@@ -0,0 +1,156 @@
+"""tf.data input pipeline for SSD training
+
+Alternative to the DataGenerator keras Sequence. Files are read and
+decoded by parallel tf.data map calls and batches are prefetched, 
+so the input pipeline scales with cores w/o forked Python workers.
+
+python3 ssd.py -t --tf-data
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import numpy as np
+import tensorflow as tf
+
+from layer_utils import get_gt_data_batch, pad_labels
+from layer_utils import encode_gt_batch, pack_sparse_gt
+from tf_layer_utils import tf_get_gt_data_batch
+
+
+def shard_keys(dictionary, num_shards=1, shard_index=0):
+    """Deterministic shard of dictionary keys (image filenames)
+
+    Arguments:
+        dictionary : Dictionary of image filenames and object labels
+        num_shards (int): Number of shards (eg number of workers)
+        shard_index (int): Index of the shard of this worker
+
+    Returns:
+        keys (list): Sorted keys of the shard
+    """
+    keys = sorted(dictionary.keys())
+    return keys[shard_index::num_shards]
+
+
+def build_dataset(args,
+                  dictionary,
+                  n_classes,
+                  anchor_bank,
+                  shuffle=True,
+                  seed=None):
+    """Build a tf.data pipeline of batches of images and
+    ground truth classes, offsets and masks, or sparse ground
+    truth (same format as DataGenerator)
+
+    Arguments:
+        args : User-defined configuration
+        dictionary : Dictionary of image filenames and object labels
+        n_classes (int): Number of object classes
+        anchor_bank (AnchorBank): Anchor boxes of all ssd head layers
+        shuffle (Bool): If dataset should be shuffled every epoch
+        seed (int): Shuffle seed
+
+    Returns:
+        dataset (tf.data.Dataset): Infinite dataset of batches
+        steps_per_epoch (int): Number of batches per epoch
+    """
+    if args.sparse_targets and args.tf_encode:
+        raise ValueError("Sparse targets are encoded w/ NumPy, "
+                         "use either --sparse-targets or --tf-encode")
+    keys = shard_keys(dictionary, args.num_shards, args.shard_index)
+    paths = [os.path.join(args.data_path, key) for key in keys]
+    labels, counts = pad_labels([dictionary[key] for key in keys])
+    labels = labels.astype(np.float32)
+    input_shape = (args.height, args.width, args.channels)
+    n_boxes = len(anchor_bank)
+
+    def load_image(path, labels, counts):
+        """Read and decode an image file"""
+        image = tf.io.read_file(path)
+        image = tf.io.decode_image(image,
+                                   channels=args.channels,
+                                   expand_animations=False)
+        # w/ image store, model input is uint8
+        if args.image_store is None:
+            image = tf.image.convert_image_dtype(image, tf.float32)
+        image.set_shape(input_shape)
+        return image, labels, counts
+
+    def encode(labels, counts):
+        """Ground truth of a batch (NumPy)"""
+        batch_size = labels.shape[0]
+        gt_class = np.zeros((batch_size, n_boxes, n_classes),
+                            dtype=np.float32)
+        gt_offset_mask = np.zeros((batch_size, n_boxes, 8),
+                                  dtype=np.float32)
+        get_gt_data_batch(labels,
+                          counts,
+                          anchor_bank,
+                          gt_class,
+                          gt_offset_mask[..., 0:4],
+                          gt_offset_mask[..., 4:8],
+                          normalize=args.normalize,
+                          threshold=args.threshold,
+                          dense=args.dense_matching)
+        return gt_class, gt_offset_mask
+
+    def encode_sparse(labels, counts):
+        """Sparse ground truth of a batch (NumPy)"""
+        matches = encode_gt_batch(labels,
+                                  counts,
+                                  anchor_bank,
+                                  normalize=args.normalize,
+                                  threshold=args.threshold,
+                                  dense=args.dense_matching)
+        return pack_sparse_gt(*matches,
+                              labels.shape[0],
+                              args.max_positives)
+
+    def encode_batch(images, labels, counts):
+        """Ground truth of a batch"""
+        if args.sparse_targets:
+            gt_sparse = tf.numpy_function(encode_sparse,
+                                          [labels, counts],
+                                          tf.float32)
+            gt_sparse.set_shape((args.batch_size, None, 6))
+            return images, (gt_sparse, gt_sparse)
+
+        if args.tf_encode:
+            # encoding w/ tf ops runs outside the GIL
+            gt_class, gt_offset_mask = \
+                    tf_get_gt_data_batch(labels,
+                                         counts,
+                                         anchor_bank,
+                                         n_classes,
+                                         normalize=args.normalize,
+                                         threshold=args.threshold)
+            return images, (gt_class, gt_offset_mask)
+
+        gt_class, gt_offset_mask = tf.numpy_function(encode,
+                                                     [labels, counts],
+                                                     [tf.float32,
+                                                      tf.float32])
+        gt_class.set_shape((args.batch_size, n_boxes, n_classes))
+        gt_offset_mask.set_shape((args.batch_size, n_boxes, 8))
+        return images, (gt_class, gt_offset_mask)
+
+    dataset = tf.data.Dataset.from_tensor_slices((paths, labels, counts))
+    if shuffle:
+        dataset = dataset.shuffle(len(paths),
+                                  seed=seed,
+                                  reshuffle_each_iteration=True)
+    dataset = dataset.repeat()
+    dataset = dataset.map(load_image,
+                          num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.batch(args.batch_size, drop_remainder=True)
+    dataset = dataset.map(encode_batch,
+                          num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+    steps_per_epoch = len(paths) // args.batch_size
+    return dataset, steps_per_epoch
@@ -0,0 +1,311 @@
+"""Layer utils as TensorFlow ops
+
+Ground truth matching and encoding of layer_utils.get_gt_data_batch
+implemented with TensorFlow ops. It runs inside a tf.data map or on
+the training device so encoding is not bound to the Python GIL.
+
+Parity check against the NumPy implementation:
+
+python3 tf_layer_utils.py
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys
+import argparse
+import numpy as np
+import tensorflow as tf
+
+import layer_utils
+
+
+def tf_iou(anchors, boxes):
+    """Compute IoU of anchor boxes wrt batch of boxes
+
+    Arguments:
+        anchors (tensor): (n_anchors, 4) float64 anchor boxes
+        boxes (tensor): (batch, n_gt, 4) boxes coordinates in pixels
+
+    Returns:
+        iou (tensor): (batch, n_anchors, n_gt) float64 IoU
+    """
+    # boxes areas in boxes precision like layer_utils.iou()
+    boxes_areas = (boxes[..., 1] - boxes[..., 0]) \
+                  * (boxes[..., 3] - boxes[..., 2])
+    boxes_areas = tf.cast(boxes_areas, tf.float64)
+    anchors_areas = (anchors[:, 1] - anchors[:, 0]) \
+                    * (anchors[:, 3] - anchors[:, 2])
+
+    boxes = tf.cast(boxes, tf.float64)[:, None, :, :]
+    anchors = anchors[None, :, None, :]
+    width = tf.minimum(anchors[..., 1], boxes[..., 1])
+    width -= tf.maximum(anchors[..., 0], boxes[..., 0])
+    width = tf.maximum(width, 0.)
+    height = tf.minimum(anchors[..., 3], boxes[..., 3])
+    height -= tf.maximum(anchors[..., 2], boxes[..., 2])
+    height = tf.maximum(height, 0.)
+    intersection_areas = width * height
+
+    union_areas = anchors_areas[None, :, None] + boxes_areas[:, None, :]
+    union_areas -= intersection_areas
+    return intersection_areas / union_areas
+
+
+def tf_minmax2centroid(boxes):
+    """Minmax to centroid format in boxes precision
+    (xmin, xmax, ymin, ymax) to (cx, cy, w, h)"""
+    width = boxes[..., 1] - boxes[..., 0]
+    height = boxes[..., 3] - boxes[..., 2]
+    cx = 0.5 * width + boxes[..., 0]
+    cy = 0.5 * height + boxes[..., 2]
+    return tf.stack([cx, cy, width, height], axis=-1)
+
+
+def tf_centroid2minmax(boxes):
+    """Centroid to minmax format 
+    (cx, cy, w, h) to (xmin, xmax, ymin, ymax)"""
+    half_width = 0.5 * boxes[..., 2]
+    half_height = 0.5 * boxes[..., 3]
+    return tf.stack([boxes[..., 0] - half_width,
+                     boxes[..., 0] + half_width,
+                     boxes[..., 1] - half_height,
+                     boxes[..., 1] + half_height], axis=-1)
+
+
+def tf_decode_offsets(offsets,
+                      anchors,
+                      anchors_centroid,
+                      normalize=False):
+    """Convert predicted offsets to bounding boxes, 
+    same as boxes.decode_offsets()
+
+    Arguments:
+        offsets (tensor): Predicted offsets (batch, n_boxes, 4 or 8)
+        anchors (tensor): Anchor boxes in minmax format (n_boxes, 4)
+        anchors_centroid (tensor): Anchor boxes in centroid format
+        normalize (bool): If offsets are normalized (Equation 11.4.8)
+
+    Returns:
+        boxes (tensor): Bounding boxes in minmax format (batch, n_boxes, 4)
+    """
+    if not normalize:
+        return anchors + offsets[..., 0:4]
+
+    # invert Equation 11.4.8 in (cx, cy, w, h) format
+    cxcy = offsets[..., 0:2] * 0.1 * anchors_centroid[:, 2:4]
+    cxcy += anchors_centroid[:, 0:2]
+    wh = tf.exp(offsets[..., 2:4] * 0.2) * anchors_centroid[:, 2:4]
+    boxes = tf.concat([cxcy, wh], axis=-1)
+    return tf_centroid2minmax(boxes)
+
+
+def tf_first_argmax(x, axis):
+    """Index of the max along axis. Ties go to the smallest index
+    like np.argmax (tf.argmax does not guarantee it)."""
+    is_max = tf.equal(x, tf.reduce_max(x, axis=axis, keepdims=True))
+    index = tf.cumsum(tf.ones_like(x, dtype=tf.int32), axis=axis) - 1
+    n = tf.shape(x)[axis]
+    return tf.reduce_min(tf.where(is_max, index, n), axis=axis)
+
+
+def tf_get_gt_data_batch(labels,
+                         counts,
+                         anchor_bank,
+                         n_classes,
+                         normalize=False,
+                         threshold=0.6):
+    """Retrieve ground truth class, bbox offset, and mask of a 
+    whole batch across all ssd head layers. Same matching rules as
+    layer_utils.get_gt_data_batch().
+
+    Arguments:
+        labels (tensor): (batch, max n_gt, 5) padded ground truth labels
+        counts (tensor): (batch,) number of valid labels per image
+        anchor_bank (AnchorBank): Anchor boxes of all ssd head layers
+        n_classes (int): Number of object classes
+        normalize (bool): If normalization should be applied
+        threshold (float): If less than 1.0, anchor boxes>threshold
+            are also part of positive anchor boxes
+
+    Returns:
+        gt_class (tensor): (batch, n_boxes, n_classes) float32 classes
+        gt_offset_mask (tensor): (batch, n_boxes, 8) float32 offsets
+            and masks
+    """
+    labels = tf.convert_to_tensor(labels)
+    n_gt = tf.shape(labels)[1]
+    gt_index = tf.range(n_gt)
+    # padded ground truth boxes are never matched
+    valid = gt_index[None, :] < tf.cast(tf.reshape(counts, (-1, 1)),
+                                        tf.int32)
+    valid = valid[:, None, :]
+    boxes = labels[..., 0:4]
+    class_ids = tf.one_hot(tf.cast(labels[..., 4], tf.int32),
+                           n_classes,
+                           dtype=tf.float32)
+    background = tf.one_hot(0, n_classes, dtype=tf.float32)
+
+    gt_class = []
+    gt_offset_mask = []
+    for index in range(len(anchor_bank.offsets) - 1):
+        start = anchor_bank.offsets[index]
+        end = anchor_bank.offsets[index + 1]
+        anchors = tf.constant(anchor_bank.minmax[start:end])
+        n_anchors = end - start
+        # (batch, n_anchors, n_gt)
+        iou = tf_iou(anchors, boxes)
+
+        # anchor w/ max iou per ground truth bbox
+        maxiou_per_gt = tf_first_argmax(iou, axis=1)
+        best = tf.equal(tf.range(n_anchors)[None, :, None],
+                        maxiou_per_gt[:, None, :])
+        best &= valid
+        # extra anchor boxes based on IoU
+        if threshold < 1.0:
+            extra = (iou > threshold) & valid
+        else:
+            extra = tf.zeros_like(best)
+        matched = best | extra
+        positive = tf.reduce_any(matched, axis=-1)
+
+        # class generation: union of classes of matched boxes
+        classes = tf.matmul(tf.cast(matched, tf.float32), class_ids)
+        classes = tf.minimum(classes, 1.0)
+        classes = tf.where(positive[..., None], classes, background)
+        gt_class.append(classes)
+
+        # an anchor box matched by several ground truth boxes 
+        # gets the offsets of the last extra match, else of
+        # the last best match (same as get_gt_data)
+        priority = tf.where(extra,
+                            n_gt + gt_index[None, None, :],
+                            tf.where(best, gt_index[None, None, :], -1))
+        last = tf_first_argmax(priority, axis=-1)
+        label = tf.gather(labels, last, batch_dims=1)
+
+        # offsets generation
+        if normalize:
+            anchor = tf.constant(anchor_bank.centroid[start:end])[None]
+            # labels centroid in labels precision like minmax2centroid()
+            label = tf.cast(tf_minmax2centroid(label), tf.float64)
+            # Equation 11.4.8
+            offsets1 = label[..., 0:2] - anchor[..., 0:2]
+            offsets1 /= anchor[..., 2:4]
+            offsets1 /= 0.1
+            offsets2 = tf.math.log(label[..., 2:4] / anchor[..., 2:4])
+            offsets2 /= 0.2
+            offsets = tf.concat([offsets1, offsets2], axis=-1)
+        # (xmin, xmax, ymin, ymax) format
+        else:
+            offsets = tf.cast(label[..., 0:4], tf.float64) - anchors[None]
+
+        mask = tf.tile(tf.cast(positive, tf.float32)[..., None], [1, 1, 4])
+        offsets = tf.where(positive[..., None], offsets, 0.)
+        offsets = tf.cast(offsets, tf.float32)
+        gt_offset_mask.append(tf.concat([offsets, mask], axis=-1))
+
+    gt_class = tf.concat(gt_class, axis=1)
+    gt_offset_mask = tf.concat(gt_offset_mask, axis=1)
+    return gt_class, gt_offset_mask
+
+
+def tie_labels(anchor_bank, rng, n_classes, n_labels=4):
+    """Ground truth boxes halfway between two anchor boxes of the
+    same size so that both have the same IoU"""
+    minmax = anchor_bank.minmax
+    size = minmax[:, [1, 3]] - minmax[:, [0, 2]]
+    labels = []
+    while len(labels) < n_labels:
+        i = rng.randint(len(minmax))
+        same = np.all(size == size[i], axis=1) \
+               & (minmax[:, 2] == minmax[i, 2]) \
+               & (minmax[:, 0] > minmax[i, 0])
+        if not np.any(same):
+            continue
+        j = np.flatnonzero(same)[np.argmin(minmax[same, 0])]
+        shift = 0.5 * (minmax[j, 0] - minmax[i, 0])
+        box = minmax[i] + np.array([shift, shift, 0, 0])
+        labels.append(np.append(box, rng.randint(1, n_classes)))
+    return np.array(labels, dtype=np.float32)
+
+
+def check_parity(batch_size=8,
+                 n_classes=4,
+                 n_layers=4,
+                 n_tests=10,
+                 seed=0):
+    """Compare tf_get_gt_data_batch with the NumPy reference
+    layer_utils.get_gt_data_batch on random labels
+
+    Raises:
+        AssertionError: Ground truth of TF and NumPy differ
+    """
+    image_shape = (480, 640, 3)
+    feature_shapes = [(image_shape[0] // (32 * 2**i),
+                       image_shape[1] // (32 * 2**i),
+                       16) for i in range(n_layers)]
+    anchor_bank = layer_utils.get_anchor_bank(feature_shapes,
+                                              image_shape,
+                                              n_layers=n_layers)
+    n_boxes = len(anchor_bank)
+    rng = np.random.RandomState(seed)
+    for test in range(n_tests):
+        labels = []
+        for _ in range(batch_size):
+            n_gt = rng.randint(1, 10)
+            xmin = rng.uniform(0, image_shape[1] - 20, n_gt)
+            ymin = rng.uniform(0, image_shape[0] - 20, n_gt)
+            width = rng.uniform(10, image_shape[1] / 2, n_gt)
+            height = rng.uniform(10, image_shape[0] / 2, n_gt)
+            classes = rng.randint(1, n_classes, n_gt)
+            label = np.stack([xmin, xmin + width, ymin, ymin + height,
+                              classes], axis=1)
+            labels.append(label.astype(np.float32))
+        # grid aligned boxes w/ equal IoUs of several anchors
+        labels[0] = tie_labels(anchor_bank, rng, n_classes)
+        labels, counts = layer_utils.pad_labels(labels)
+
+        for normalize in (False, True):
+            for threshold in (0.6, 1.0):
+                gt_class = np.zeros((batch_size, n_boxes, n_classes))
+                gt_offset_mask = np.zeros((batch_size, n_boxes, 8))
+                layer_utils.get_gt_data_batch(labels,
+                                              counts,
+                                              anchor_bank,
+                                              gt_class,
+                                              gt_offset_mask[..., 0:4],
+                                              gt_offset_mask[..., 4:8],
+                                              normalize=normalize,
+                                              threshold=threshold)
+                tf_class, tf_offset_mask = \
+                        tf_get_gt_data_batch(labels,
+                                             counts,
+                                             anchor_bank,
+                                             n_classes,
+                                             normalize=normalize,
+                                             threshold=threshold)
+                np.testing.assert_array_equal(gt_class, tf_class.numpy())
+                np.testing.assert_allclose(gt_offset_mask,
+                                           tf_offset_mask.numpy(),
+                                           rtol=1e-5,
+                                           atol=1e-5)
+    print("TF and NumPy ground truth match (%d tests)" % n_tests)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='TF ground truth parity')
+    help_ = "Number of random batches"
+    parser.add_argument("--tests",
+                        default=10,
+                        type=int,
+                        help=help_)
+    args = parser.parse_args()
+    try:
+        check_parity(n_tests=args.tests)
+    except AssertionError as error:
+        print("TF and NumPy ground truth differ: %s" % error)
+        sys.exit(1)
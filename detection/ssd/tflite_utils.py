@@ -0,0 +1,137 @@
+"""int8 TFLite export and inference of the ssd model
+
+Post-training full integer quantization calibrated on train images
+drawn from the DataGenerator. BatchNormalization of the inference
+graph is folded into the adjacent convolutions by the converter.
+
+python3 ssd.py --restore-weights=<weights.h5> --export-tflite=ssd.tflite
+python3 ssd.py --tflite=ssd.tflite --evaluate
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import numpy as np
+import tensorflow as tf
+
+
+def representative_dataset(generator, n_images=100, dtype=np.float32):
+    """Calibration images for quantization, one image per sample
+
+    Arguments:
+        generator (DataGenerator): Train data generator
+        n_images (int): Number of calibration images
+        dtype (numpy.dtype): Model input type
+    """
+    def dataset():
+        count = 0
+        for index in range(len(generator)):
+            x, _ = generator[index]
+            for image in x:
+                if count >= n_images:
+                    return
+                yield [np.expand_dims(image, axis=0).astype(dtype)]
+                count += 1
+    return dataset
+
+
+def convert_int8(model, dataset):
+    """Convert a keras model to a full integer TFLite model 
+    w/ uint8 input and float outputs
+
+    Arguments:
+        model (model): Keras model w/ fixed input shape 
+        dataset (function): Representative dataset generator
+
+    Returns:
+        tflite_model (bytes): Serialized TFLite model
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = dataset
+    # integer only kernels, quantize/dequantize at the boundaries
+    converter.target_spec.supported_ops = \
+            [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.uint8
+    return converter.convert()
+
+
+class TFLiteDetector:
+    """Inference of a TFLite ssd model w/ the same raw outputs
+    as the keras model.
+
+    Arguments:
+        model_path (string): TFLite model file
+        n_threads (int): Number of interpreter threads
+    """
+    def __init__(self, model_path, n_threads=None):
+        self.model_path = model_path
+        self.interpreter = tf.lite.Interpreter(model_path=model_path,
+                                               num_threads=n_threads)
+        self.interpreter.allocate_tensors()
+        self.input_details = self.interpreter.get_input_details()[0]
+        self.classes_details, self.offsets_details = \
+                self.keras_outputs()
+
+
+    def keras_outputs(self):
+        """Details of the classes and offsets outputs, found by the
+        keras output layer names of the model signature ("classes" 
+        and "offsets", or "cls_out1" and "off_out1" w/ 1 layer)"""
+        if self.interpreter.get_signature_list():
+            runner = self.interpreter.get_signature_runner()
+            details = runner.get_output_details()
+            offsets = [d for name, d in details.items() if 'off' in name]
+            classes = [d for name, d in details.items() if 'cls' in name
+                       or 'class' in name]
+        else:
+            # offsets are (1, n_boxes, 8): predicted offsets concat 
+            # w/ themselves (see model.build_ssd)
+            details = self.interpreter.get_output_details()
+            offsets = [d for d in details if d['shape'][-1] == 8]
+            classes = [d for d in details if d['shape'][-1] != 8]
+        if len(offsets) != 1 or len(classes) != 1:
+            raise ValueError("Classes and offsets outputs of %s "
+                             "not found" % self.model_path)
+        return classes[0], offsets[0]
+
+
+    def quantize(self, image):
+        """Image in the keras model input range (0.0 to 1.0 float 
+        or uint8 w/ image store) to TFLite model input type"""
+        dtype = self.input_details['dtype']
+        if dtype == np.float32:
+            return image.astype(np.float32)
+        if image.dtype == dtype:
+            # keras model input is uint8 too
+            return image
+        scale, zero_point = self.input_details['quantization']
+        image = np.round(image / scale + zero_point)
+        info = np.iinfo(dtype)
+        return np.clip(image, info.min, info.max).astype(dtype)
+
+
+    def output(self, details):
+        """Output tensor as float"""
+        output = self.interpreter.get_tensor(details['index'])
+        scale, zero_point = details['quantization']
+        if output.dtype != np.float32 and scale > 0:
+            output = (output.astype(np.float32) - zero_point) * scale
+        return output
+
+
+    def predict(self, images):
+        """Raw class and offset predictions of a batch of images.
+        The TFLite model runs one image at a time."""
+        classes = []
+        offsets = []
+        for image in images:
+            image = self.quantize(np.expand_dims(image, axis=0))
+            self.interpreter.set_tensor(self.input_details['index'], image)
+            self.interpreter.invoke()
+            classes.append(self.output(self.classes_details))
+            offsets.append(self.output(self.offsets_details))
+        return np.concatenate(classes), np.concatenate(offsets)
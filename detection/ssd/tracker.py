@@ -0,0 +1,284 @@
+"""Lightweight IoU tracker to run the detector every N frames
+
+In between detections, tracked boxes are propagated w/ their
+centroid velocity and optionally refined by sparse optical flow.
+Tracks keep stable ids so that objects can be counted per track.
+
+Boxes are in minmax format (xmin, xmax, ymin, ymax).
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import cv2
+import numpy as np
+
+from layer_utils import iou
+
+
+class Track:
+    """Tracked object
+
+    Arguments:
+        track_id (int): Unique id
+        box (array): Box in minmax format
+        class_id (int): Object class
+        score (float): Detection score
+        frame (int): Frame index of the detection
+    """
+    def __init__(self, track_id, box, class_id, score, frame=0):
+        self.track_id = track_id
+        self.box = np.array(box, dtype=float)
+        # last detected box and its frame index
+        self.detected_box = self.box.copy()
+        self.frame = frame
+        self.class_id = int(class_id)
+        self.score = float(score)
+        # centroid displacement per frame
+        self.velocity = np.zeros(2)
+        # number of matched detections
+        self.hits = 1
+        # consecutive detections w/o a match
+        self.misses = 0
+        # 1.0 after a detection, decays while propagated
+        self.confidence = 1.0
+
+
+    def update(self, box, score, frame):
+        """Update w/ a matched detection at frame index"""
+        box = np.array(box, dtype=float)
+        if frame > self.frame:
+            velocity = centroid(box) - centroid(self.detected_box)
+            velocity /= frame - self.frame
+            self.velocity = 0.5 * self.velocity + 0.5 * velocity
+        self.box = box
+        self.detected_box = box.copy()
+        self.frame = frame
+        self.score = float(score)
+        self.hits += 1
+        self.misses = 0
+        self.confidence = 1.0
+
+
+    def shift(self, dx, dy):
+        self.box += np.array([dx, dx, dy, dy])
+
+
+def centroid(box):
+    return np.array([0.5 * (box[0] + box[1]), 0.5 * (box[2] + box[3])])
+
+
+class IoUTracker:
+    """Greedy IoU matching of detections to tracks of the same class.
+
+    Arguments:
+        iou_threshold (float): Min IoU of a detection and a track
+        max_misses (int): Tracks are removed after this number of
+            consecutive detections w/o a match
+        min_hits (int): Tracks are confirmed (counted) after this
+            number of matched detections
+        decay (float): Confidence decay per propagated frame
+        optical_flow (bool): Refine propagated boxes w/ Lucas-Kanade
+            optical flow
+    """
+    def __init__(self,
+                 iou_threshold=0.3,
+                 max_misses=2,
+                 min_hits=2,
+                 decay=0.9,
+                 optical_flow=False):
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.min_hits = min_hits
+        self.decay = decay
+        self.optical_flow = optical_flow
+        self.tracks = []
+        self.next_id = 1
+        self.gray = None
+        # frame index
+        self.frame = 0
+
+
+    def update(self, boxes, class_ids, scores, gray=None):
+        """Match detections to tracks, start new tracks for
+        unmatched detections and remove lost tracks"""
+        boxes = np.reshape(np.asarray(boxes, dtype=float), (-1, 4))
+        matched_tracks = set()
+        matched_boxes = set()
+        if self.tracks and len(boxes):
+            track_boxes = np.array([track.box for track in self.tracks])
+            ious = iou(track_boxes, boxes)
+            track_classes = np.array([t.class_id for t in self.tracks])
+            same_class = track_classes[:, None] == np.asarray(class_ids)
+            ious = np.where(same_class, ious, 0)
+            # greedy matching by decreasing IoU
+            for index in np.argsort(-ious, axis=None, kind='mergesort'):
+                i, j = np.unravel_index(index, ious.shape)
+                if ious[i, j] < self.iou_threshold:
+                    break
+                if i in matched_tracks or j in matched_boxes:
+                    continue
+                self.tracks[i].update(boxes[j], scores[j], self.frame)
+                matched_tracks.add(i)
+                matched_boxes.add(j)
+
+        tracks = []
+        for i, track in enumerate(self.tracks):
+            if i not in matched_tracks:
+                track.misses += 1
+                if track.misses > self.max_misses:
+                    continue
+            tracks.append(track)
+        for j in range(len(boxes)):
+            if j not in matched_boxes:
+                tracks.append(Track(self.next_id,
+                                    boxes[j],
+                                    class_ids[j],
+                                    scores[j],
+                                    self.frame))
+                self.next_id += 1
+        self.tracks = tracks
+        self.gray = gray
+        self.frame += 1
+
+
+    def propagate(self, gray=None):
+        """Move tracks to the next frame w/o detection"""
+        shifts = None
+        if self.optical_flow and gray is not None \
+                and self.gray is not None:
+            shifts = self.flow(self.gray, gray)
+        for i, track in enumerate(self.tracks):
+            track.confidence *= self.decay
+            if shifts is not None and shifts[i] is not None:
+                dx, dy, fraction = shifts[i]
+                # fewer tracked points, lower confidence
+                track.confidence *= fraction
+            else:
+                dx, dy = track.velocity
+            track.shift(dx, dy)
+        self.gray = gray
+        self.frame += 1
+
+
+    def flow(self, previous, current, n_points=25):
+        """Median optical flow of points inside each track box
+
+        Returns:
+            shifts (list): (dx, dy, fraction of tracked points)
+                per track or None if no point was tracked
+        """
+        height, width = previous.shape[:2]
+        points = []
+        for track in self.tracks:
+            xmin, xmax, ymin, ymax = track.box
+            side = int(np.sqrt(n_points))
+            x = np.linspace(xmin, xmax, side + 2)[1:-1]
+            y = np.linspace(ymin, ymax, side + 2)[1:-1]
+            grid = np.stack(np.meshgrid(x, y), axis=-1).reshape(-1, 2)
+            grid[:, 0] = np.clip(grid[:, 0], 0, width - 1)
+            grid[:, 1] = np.clip(grid[:, 1], 0, height - 1)
+            points.append(grid)
+        if not points:
+            return []
+        start = np.concatenate(points).astype(np.float32)[:, None, :]
+        end, status, _ = cv2.calcOpticalFlowPyrLK(previous,
+                                                  current,
+                                                  start,
+                                                  None)
+        motion = (end - start)[:, 0, :]
+        status = status[:, 0].astype(bool)
+        shifts = []
+        offset = 0
+        for grid in points:
+            index = slice(offset, offset + len(grid))
+            offset += len(grid)
+            tracked = status[index]
+            if not np.any(tracked):
+                shifts.append(None)
+                continue
+            dx, dy = np.median(motion[index][tracked], axis=0)
+            shifts.append((dx, dy, np.mean(tracked)))
+        return shifts
+
+
+    def confirmed(self):
+        """Tracks w/ enough matched detections"""
+        return [track for track in self.tracks
+                if track.hits >= self.min_hits]
+
+
+    def counts(self):
+        """Number of unique confirmed track ids per class id"""
+        track_ids = {}
+        for track in self.confirmed():
+            track_ids.setdefault(track.class_id, set()).add(track.track_id)
+        return {class_id: len(ids) for class_id, ids in track_ids.items()}
+
+
+    def min_confidence(self):
+        if not self.tracks:
+            return 1.0
+        return min(track.confidence for track in self.tracks)
+
+
+class DetectEveryN:
+    """Run the detector every N frames or when the confidence of
+    a track drops below min_confidence. Tracks are propagated on
+    the other frames.
+
+    Arguments:
+        detector (SSD): Object detector w/ detect_batch()
+        every (int): Detection period in frames
+        min_confidence (float): Detect if a track confidence is lower
+        tracker (IoUTracker): Tracker
+    """
+    def __init__(self,
+                 detector,
+                 every=5,
+                 min_confidence=0.5,
+                 tracker=None):
+        self.detector = detector
+        self.every = every
+        self.min_confidence = min_confidence
+        self.tracker = tracker if tracker is not None else IoUTracker()
+        self.frames = 0
+        self.detections = 0
+
+
+    def process(self, image, bgr=None):
+        """Detect or track objects on a frame
+
+        Arguments:
+            image (tensor): RGB image (0.0 to 1.0)
+            bgr (tensor): Optional uint8 BGR frame for optical flow
+
+        Returns:
+            tracks (list): Confirmed tracks
+        """
+        gray = None
+        if self.tracker.optical_flow and bgr is not None:
+            gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+        detect = self.frames % self.every == 0 \
+                 or self.tracker.min_confidence() < self.min_confidence
+        if detect:
+            boxes, class_ids, scores, valid_counts = \
+                    self.detector.detect_batch(image[None])
+            n = valid_counts[0]
+            self.tracker.update(boxes[0, :n],
+                                class_ids[0, :n],
+                                scores[0, :n],
+                                gray=gray)
+            self.detections += 1
+        else:
+            self.tracker.propagate(gray=gray)
+        self.frames += 1
+        return self.tracker.confirmed()
+
+
+    def saved(self):
+        """Fraction of frames w/o detection"""
+        return 1.0 - self.detections / max(self.frames, 1)
@@ -2,13 +2,37 @@
 
 python3 video_demo.py --restore-weights=weights/<weights.h5>
 
+Pipelined capture, inference and render/record threads:
+
+python3 video_demo.py --restore-weights=weights/<weights.h5> --pipeline
+
+Motion gated inference (skip inference while the scene is static):
+
+python3 video_demo.py --restore-weights=weights/<weights.h5> --motion-gate
+
+Headless batch detection on a video file or a directory of frames:
+
+python3 video_demo.py --restore-weights=weights/<weights.h5> \
+        --video=<video file or dir> --output=annotated.mp4 \
+        --detections=detections.jsonl
+
+Several cameras or video files w/ one shared model (frames of all
+streams are batched under a latency deadline):
+
+python3 video_demo.py --restore-weights=weights/<weights.h5> \
+        --streams=0,1,lane3.mp4 --record
+
 """
 
 import ssd
 import numpy as np
 import cv2
 import argparse
-import datetime
+import json
+import os
+import queue
+import threading
+import time
 import skimage
 import label_utils
 import config
@@ -17,6 +41,184 @@ from ssd import SSD
 from boxes import show_boxes
 from skimage.io import imread
 from model_utils import ssd_parser
+from tracker import IoUTracker, DetectEveryN
+from motion_gate import MotionGate, detect_crop, merge_detections
+
+
+class FrameCounter():
+    """Live frame rate and capture to display latency
+    (exponential moving averages)"""
+    def __init__(self, momentum=0.9):
+        self.momentum = momentum
+        self.fps = 0.0
+        self.latency = 0.0
+        self.last_time = None
+
+
+    def tick(self, capture_time=None):
+        """Count a displayed frame captured at capture_time"""
+        now = time.time()
+        if self.last_time is not None:
+            fps = 1.0 / max(now - self.last_time, 1e-6)
+            self.fps = self.momentum * self.fps + (1 - self.momentum) * fps
+        self.last_time = now
+        if capture_time is not None:
+            latency = now - capture_time
+            self.latency = self.momentum * self.latency \
+                           + (1 - self.momentum) * latency
+
+
+    def text(self):
+        return "%0.1f FPS %0.0fms" % (self.fps, 1000 * self.latency)
+
+
+class LatestFrame():
+    """Capture thread that only holds the latest frame.
+    Frames not read before the next one is captured are dropped.
+    """
+    def __init__(self, capture):
+        self.capture = capture
+        self.condition = threading.Condition()
+        self.frame = None
+        self.capture_time = None
+        self.dropped = 0
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def run(self):
+        while not self.stopped:
+            ret, frame = self.capture.read()
+            if not ret:
+                break
+            with self.condition:
+                if self.frame is not None:
+                    self.dropped += 1
+                self.frame = frame
+                self.capture_time = time.time()
+                self.condition.notify()
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+
+    def read(self):
+        """Wait for and take the latest frame (None if stopped)"""
+        with self.condition:
+            while self.frame is None and not self.stopped:
+                self.condition.wait()
+            frame, self.frame = self.frame, None
+            return frame, self.capture_time
+
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+
+
+def draw_detections(image, class_names, rects):
+    """Draw bounding boxes and class names on a BGR image
+
+    Returns:
+        items (dict): Number of detected objects per class name
+    """
+    font = cv2.FONT_HERSHEY_DUPLEX
+    line_type = 1
+    items = {}
+    for i in range(len(class_names)):
+        rect = rects[i]
+        x1 = int(rect[0])
+        y1 = int(rect[1])
+        x2 = int(rect[0] + rect[2])
+        y2 = int(rect[1] + rect[3])
+        # eg "Coke: 0.95" or "Coke #3: 0.95" w/ tracking
+        name = class_names[i].split(":")[0]
+        class_name = name.split(" #")[0]
+        if class_name in items.keys():
+            items[class_name] += 1
+        else:
+            items[class_name] = 1
+        index = label_utils.class2index(class_name)
+        color = label_utils.get_box_rgbcolor(index)
+        cv2.rectangle(image, (x1, y1), (x2, y2), color, 3)
+        cv2.putText(image,
+                    name,
+                    (x1, y1-15),
+                    font,
+                    0.5,
+                    color,
+                    line_type)
+    return items
+
+
+def draw_items(image, items):
+    """Draw the number and price of objects per class name
+    on a BGR image"""
+    font = cv2.FONT_HERSHEY_DUPLEX
+    count = len(items.keys())
+    if count == 0:
+        return
+    xmin = 10
+    ymin = 10
+    xmax = 220
+    ymax = 40 + count * 30
+    cv2.rectangle(image, (xmin, ymin), (xmax, ymax), (255, 255, 255), thickness=-1)
+
+    prices = config.params['prices']
+    total = 0.0
+    for key in items.keys():
+        count = items[key]
+        cost = count * prices[label_utils.class2index(key)]
+        total += cost
+        display = "%0.2f :%dx %s" % (cost, count, key)
+        cv2.putText(image,
+                    display,
+                    (xmin + 10, ymin + 25),
+                    font,
+                    0.55,
+                    (0, 0, 0),
+                    1)
+        ymin += 30
+
+    cv2.line(image, (xmin + 10, ymin), (xmax - 10, ymin), (0,0,0), 1)
+
+    display = "P%0.2f Total" % (total)
+    cv2.putText(image,
+                display,
+                (xmin + 5, ymin + 25),
+                font,
+                0.75,
+                (0, 0, 0),
+                1)
+
+
+def detection_labels(boxes, class_ids, scores):
+    """Class names and (x, y, w, h) rects like show_boxes of 
+    boxes in minmax format"""
+    class_names = ["%s: %0.2f" % (label_utils.index2class(i), s)
+                   for i, s in zip(class_ids, scores)]
+    rects = [(box[0], box[2], box[1] - box[0], box[3] - box[2])
+             for box in boxes]
+    return class_names, rects
+
+
+def put_latest(bounded_queue, item):
+    """Put item in a bounded queue, dropping the oldest (stale) item 
+    if the queue is full. Returns True if an item was dropped."""
+    try:
+        bounded_queue.put_nowait(item)
+        return False
+    except queue.Full:
+        pass
+    try:
+        bounded_queue.get_nowait()
+    except queue.Empty:
+        pass
+    bounded_queue.put_nowait(item)
+    return True
 
 
 class  VideoDemo():
@@ -26,13 +228,27 @@ class  VideoDemo():
                  width=640,
                  height=480,
                  record=False,
-                 filename="demo.mp4"):
+                 filename="demo.mp4",
+                 queue_size=2,
+                 tracking=None,
+                 motion_gate=None,
+                 motion_crops=False):
         self.camera = camera
         self.detector = detector
         self.width = width
         self.height = height
         self.record = record
         self.filename = filename
+        self.queue_size = queue_size
+        # DetectEveryN to detect every N frames and track in between
+        self.tracking = tracking
+        # MotionGate to reuse the last detections on static frames
+        self.motion_gate = motion_gate
+        # detect on a crop around the changed region (w/o tracking)
+        self.motion_crops = motion_crops and tracking is None
+        # last class_names, rects and (boxes, class_ids, scores)
+        self.labels = None
+        self.detections = None
         self.videowriter = None
         self.initialize()
 
@@ -53,6 +269,177 @@ class  VideoDemo():
                                                 (self.width, self.height), 
                                                 isColor=True)
 
+    def detect(self, image, img):
+        """Detect objects on a frame w/ motion gating
+
+        Arguments:
+            image (tensor): uint8 BGR frame
+            img (tensor): RGB frame (0.0 to 1.0)
+
+        Returns:
+            class_names (list): "name: score" or "name #track id: score"
+            rects (list): (x, y, w, h) boxes
+        """
+        if self.motion_gate is None:
+            return self.detect_frame(image, img)
+        moving, region = self.motion_gate.update(image)
+        if not moving and self.labels is not None:
+            return self.labels
+        if region is not None and self.detections is not None \
+                and self.motion_crops:
+            current = detect_crop(self.detector, img, region)
+            self.detections = merge_detections(self.detections,
+                                               current,
+                                               region)
+            self.labels = detection_labels(*self.detections)
+        else:
+            self.labels = self.detect_frame(image, img)
+        return self.labels
+
+
+    def detect_frame(self, image, img):
+        """Detect objects on a frame (or track them w/ tracking)"""
+        if self.motion_crops:
+            boxes, class_ids, scores, valid_counts = \
+                    self.detector.detect_batch(img[None])
+            n = valid_counts[0]
+            self.detections = (np.asarray(boxes[0, :n], dtype=float),
+                               class_ids[0, :n],
+                               scores[0, :n])
+            return detection_labels(*self.detections)
+        if self.tracking is None:
+            return self.detector.evaluate(image=img)
+        tracks = self.tracking.process(img, bgr=image)
+        class_names = ["%s #%d: %0.2f" % (label_utils.index2class(t.class_id),
+                                          t.track_id,
+                                          t.score)
+                       for t in tracks]
+        rects = [(t.box[0], t.box[2], t.box[1] - t.box[0], t.box[3] - t.box[2])
+                 for t in tracks]
+        return class_names, rects
+
+
+    def tracked_items(self):
+        """Number of tracked objects per class name counted once
+        per track (None w/o tracking)"""
+        if self.tracking is None:
+            return None
+        counts = self.tracking.tracker.counts()
+        return {label_utils.index2class(class_id): count
+                for class_id, count in counts.items()}
+
+
+    def print_saved(self):
+        """Print the fraction of inferences saved by tracking and
+        motion gating"""
+        if self.motion_gate is not None:
+            print("Motion on %d of %d frames (%0.0f%% saved)" 
+                  % (self.motion_gate.inferences,
+                     self.motion_gate.frames,
+                     100 * self.motion_gate.saved()))
+        if self.tracking is not None:
+            print("Inference on %d of %d frames (%0.0f%% saved)" 
+                  % (self.tracking.detections,
+                     self.tracking.frames,
+                     100 * self.tracking.saved()))
+
+
+    def draw_counter(self, image, counter):
+        """Draw frame rate and latency on a BGR image"""
+        cv2.putText(image,
+                    counter.text(),
+                    (10, self.height - 15),
+                    cv2.FONT_HERSHEY_DUPLEX,
+                    0.6,
+                    (0, 0, 0),
+                    1)
+
+
+    def infer(self, capture, render_queue, stop):
+        """Inference stage: detect objects on the latest frame"""
+        while not stop.is_set():
+            image, capture_time = capture.read()
+            if image is None:
+                break
+            img = cv2.cvtColor(image, cv2.COLOR_BGR2RGB) / 255.0
+            class_names, rects = self.detect(image, img)
+            items = self.tracked_items()
+            if put_latest(render_queue, 
+                          (image, capture_time, class_names, rects, items)):
+                self.stale += 1
+        # end of stream
+        stop.set()
+
+
+    def write(self, record_queue):
+        """Record stage: write rendered frames to the video file"""
+        while True:
+            image = record_queue.get()
+            if image is None:
+                break
+            if self.videowriter.isOpened():
+                self.videowriter.write(image)
+
+
+    def pipeline(self):
+        """Capture, inference and render/record run concurrently,
+        connected by bounded queues. The frame rate is the one of 
+        the slowest stage. Stale frames are dropped, including 
+        frames a slow video writer cannot keep up with.
+        """
+        stop = threading.Event()
+        self.stale = 0
+        capture = LatestFrame(self.capture)
+        render_queue = queue.Queue(maxsize=self.queue_size)
+        inference = threading.Thread(target=self.infer,
+                                     args=(capture, render_queue, stop),
+                                     daemon=True)
+        inference.start()
+
+        writer = None
+        if self.videowriter is not None:
+            record_queue = queue.Queue(maxsize=self.queue_size)
+            writer = threading.Thread(target=self.write,
+                                      args=(record_queue,),
+                                      daemon=True)
+            writer.start()
+
+        counter = FrameCounter()
+        unrecorded = 0
+        while not (stop.is_set() and render_queue.empty()):
+            try:
+                item = render_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            image, capture_time, class_names, rects, items = item
+            draw_detections(image, class_names, rects)
+            if items is not None:
+                draw_items(image, items)
+            counter.tick(capture_time)
+            self.draw_counter(image, counter)
+            cv2.imshow('image', image)
+            if writer is not None:
+                # a slow video writer drops frames instead of
+                # stalling the display
+                if put_latest(record_queue, image):
+                    unrecorded += 1
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
+
+        stop.set()
+        capture.stop()
+        inference.join()
+        if writer is not None:
+            record_queue.put(None)
+            writer.join()
+        print("%s, dropped frames: %d at capture, %d stale, "
+              "%d unrecorded"
+              % (counter.text(), capture.dropped, self.stale, unrecorded))
+        self.print_saved()
+        self.capture.release()
+        cv2.destroyAllWindows()
+
+
     def loop(self):
         font = cv2.FONT_HERSHEY_DUPLEX
         pos = (10,30)
@@ -60,9 +447,10 @@ class  VideoDemo():
         font_color = (0, 0, 0)
         line_type = 1
 
+        counter = FrameCounter()
         while True:
-            start_time = datetime.datetime.now()
             ret, image = self.capture.read()
+            capture_time = time.time()
 
             #filename = "temp.jpg"
             #cv2.imwrite(filename, image)
@@ -70,46 +458,14 @@ class  VideoDemo():
 
             img = cv2.cvtColor(image, cv2.COLOR_BGR2RGB) / 255.0
 
-            class_names, rects = self.detector.evaluate(image=img)
-            
-            #elapsed_time = datetime.datetime.now() - start_time
-            #hz = 1.0 / elapsed_time.total_seconds()
-            #hz = "%0.2fHz" % hz
-            #cv2.putText(image,
-            #            hz,
-            #            pos,
-            #            font,
-            #            font_scale,
-            #            font_color,
-            #            line_type)
-
-            items = {}
-            for i in range(len(class_names)):
-                rect = rects[i]
-                x1 = rect[0]
-                y1 = rect[1]
-                x2 = x1 + rect[2]
-                y2 = y1 + rect[3]
-                x1 = int(x1)
-                x2 = int(x2)
-                y1 = int(y1)
-                y2 = int(y2)
-                name = class_names[i].split(":")[0]
-                if name in items.keys():
-                    items[name] += 1
-                else:
-                    items[name] = 1
-                index = label_utils.class2index(name)
-                color = label_utils.get_box_rgbcolor(index)
-                cv2.rectangle(image, (x1, y1), (x2, y2), color, 3)
-                # print(x1, y1, x2, y2, class_names[i])
-                cv2.putText(image,
-                            name,
-                            (x1, y1-15),
-                            font,
-                            0.5,
-                            color,
-                            line_type)
+            class_names, rects = self.detect(image, img)
+            draw_detections(image, class_names, rects)
+            # w/ tracking, objects are counted once per track
+            items = self.tracked_items()
+            if items is not None:
+                draw_items(image, items)
+            counter.tick(capture_time)
+            self.draw_counter(image, counter)
 
             cv2.imshow('image', image)
             if self.videowriter is not None:
@@ -118,48 +474,503 @@ class  VideoDemo():
             if cv2.waitKey(1) & 0xFF == ord('q'):
                 break
 
-            continue
-
-            count = len(items.keys())
-            if count > 0:
-                xmin = 10
-                ymin = 10
-                xmax = 220
-                ymax = 40 + count * 30
-                cv2.rectangle(image, (xmin, ymin), (xmax, ymax), (255, 255, 255), thickness=-1)
-
-                prices = config.params['prices']
-                total = 0.0
-                for key in items.keys():
-                    count = items[key]
-                    cost = count * prices[label_utils.class2index(key)]
-                    total += cost
-                    display = "%0.2f :%dx %s" % (cost, count, key)
-                    cv2.putText(image,
-                                display,
-                                (xmin + 10, ymin + 25),
-                                font,
-                                0.55,
-                                (0, 0, 0),
-                                1)
-                    ymin += 30
-
-                cv2.line(image, (xmin + 10, ymin), (xmax - 10, ymin), (0,0,0), 1)
-
-                display = "P%0.2f Total" % (total)
-                cv2.putText(image,
-                            display,
-                            (xmin + 5, ymin + 25),
-                            font,
-                            0.75,
-                            (0, 0, 0),
-                            1)
-
         # When everything done, release the capture
+        self.print_saved()
         self.capture.release()
         cv2.destroyAllWindows()
 
 
+class FrameReader():
+    """Background decoding of the frames of a video file or of the
+    image files of a directory (in filename order) into a bounded 
+    queue. Frames are resized to width x height.
+    """
+    def __init__(self, source, width=640, height=480, queue_size=64):
+        self.source = source
+        self.width = width
+        self.height = height
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.fps = None
+        if os.path.isdir(source):
+            self.files = sorted(os.path.join(source, name) 
+                                for name in os.listdir(source))
+            self.capture = None
+        else:
+            self.files = None
+            self.capture = cv2.VideoCapture(source)
+            if not self.capture.isOpened():
+                raise ValueError("Error opening video %s" % source)
+            self.fps = self.capture.get(cv2.CAP_PROP_FPS) or None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def decode(self):
+        """Generator of BGR frames"""
+        if self.capture is not None:
+            while True:
+                ret, frame = self.capture.read()
+                if not ret:
+                    break
+                yield frame
+            self.capture.release()
+            return
+        for filename in self.files:
+            frame = cv2.imread(filename)
+            # skip non image files
+            if frame is not None:
+                yield frame
+
+
+    def run(self):
+        for frame in self.decode():
+            if frame.shape[:2] != (self.height, self.width):
+                frame = cv2.resize(frame, (self.width, self.height))
+            self.frames.put(frame)
+        # end of stream
+        self.frames.put(None)
+
+
+    def batches(self, batch_size):
+        """Generator of lists of up to batch_size frames"""
+        batch = []
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            batch.append(frame)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+class VideoFileDetector():
+    """Headless object detection on a video file or a directory of 
+    frames. Frames are decoded in a background thread, detected in
+    batches (batched NMS) and annotated and encoded by a writer thread.
+
+    Arguments:
+        detector (SSD): Object detector w/ detect_batch()
+        source (string): Video file or directory of frames
+        output (string): Annotated video file (None to skip)
+        detections (string): JSONL file of detections per frame
+        batch_size (int): Number of frames per model call
+        width, height (int): Model input size
+        fps (float): Output frame rate if unknown from the source
+    """
+    def __init__(self,
+                 detector,
+                 source,
+                 output=None,
+                 detections=None,
+                 batch_size=8,
+                 width=640,
+                 height=480,
+                 fps=10.0):
+        self.detector = detector
+        self.source = source
+        self.output = output
+        self.detections = detections
+        self.batch_size = batch_size
+        self.width = width
+        self.height = height
+        self.fps = fps
+
+
+    def write(self, results, fps):
+        """Writer thread: annotate frames, encode the output video
+        and save detections"""
+        videowriter = None
+        if self.output is not None:
+            videowriter = cv2.VideoWriter(self.output,
+                                          cv2.VideoWriter_fourcc(*'mp4v'),
+                                          fps,
+                                          (self.width, self.height),
+                                          isColor=True)
+        jsonl = None
+        if self.detections is not None:
+            jsonl = open(self.detections, "w")
+
+        while True:
+            item = results.get()
+            if item is None:
+                break
+            index, frame, boxes, class_ids, scores = item
+            if jsonl is not None:
+                record = {'frame': index,
+                          'boxes': boxes.tolist(),
+                          'class_ids': class_ids.tolist(),
+                          'scores': scores.tolist()}
+                jsonl.write(json.dumps(record) + "\n")
+            if videowriter is not None:
+                class_names, rects = detection_labels(boxes,
+                                                      class_ids,
+                                                      scores)
+                draw_detections(frame, class_names, rects)
+                videowriter.write(frame)
+
+        if videowriter is not None:
+            videowriter.release()
+        if jsonl is not None:
+            jsonl.close()
+
+
+    def run(self):
+        """Detect objects on all frames and report throughput
+
+        Returns:
+            n_frames (int): Number of processed frames
+            elapsed (float): Processing time in seconds
+        """
+        start_time = time.time()
+        reader = FrameReader(self.source,
+                             width=self.width,
+                             height=self.height,
+                             queue_size=4 * self.batch_size)
+        fps = reader.fps or self.fps
+        results = queue.Queue(maxsize=4 * self.batch_size)
+        writer = threading.Thread(target=self.write,
+                                  args=(results, fps),
+                                  daemon=True)
+        writer.start()
+
+        n_frames = 0
+        for batch in reader.batches(self.batch_size):
+            images = np.stack([cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                               for frame in batch])
+            images = images.astype(np.float32) / 255.0
+            boxes, class_ids, scores, valid_counts = \
+                    self.detector.detect_batch(images)
+            for i, frame in enumerate(batch):
+                n = valid_counts[i]
+                results.put((n_frames + i,
+                             frame,
+                             boxes[i, :n],
+                             class_ids[i, :n],
+                             scores[i, :n]))
+            n_frames += len(batch)
+
+        results.put(None)
+        writer.join()
+        elapsed = time.time() - start_time
+        log = "%d frames in %0.1fs: %0.1f frames/sec" \
+              % (n_frames, elapsed, n_frames / max(elapsed, 1e-6))
+        if reader.fps:
+            log += " (%0.1fx real time)" \
+                   % (n_frames / reader.fps / max(elapsed, 1e-6))
+        print(log)
+        return n_frames, elapsed
+
+
+class Stream():
+    """Camera or video source of MultiStreamDetector w/ its renderer.
+    Cameras only deliver their latest frame, video files (or
+    directories of frames) deliver every frame.
+
+    Arguments:
+        index (int): Stream index
+        source (string): Camera index or video file or directory
+        width, height (int): Model input size
+        filename (string): Annotated output video (None to skip)
+        fps (float): Output frame rate if unknown from the source
+        queue_size (int): Size of the detection queue
+        max_pending (int): Max frames of a video file waiting for
+            inference. 1 for cameras so that the latest frame is sent.
+    """
+    def __init__(self,
+                 index,
+                 source,
+                 width=640,
+                 height=480,
+                 filename=None,
+                 fps=10.0,
+                 queue_size=2,
+                 max_pending=1):
+        self.index = index
+        self.source = source
+        self.width = width
+        self.height = height
+        self.filename = filename
+        self.fps = fps
+        self.camera = source.isdigit()
+        self.results = queue.Queue(maxsize=queue_size)
+        if self.camera:
+            max_pending = 1
+        # released when a frame is taken by the batcher
+        self.pending = threading.Semaphore(max_pending)
+        self.counter = FrameCounter()
+        self.frames = 0
+        # detections dropped by a renderer slower than inference
+        self.stale = 0
+        self.released = False
+        # latest rendered frame not yet displayed
+        self.image = None
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+
+    def open(self):
+        if self.camera:
+            capture = cv2.VideoCapture(int(self.source))
+            if not capture.isOpened():
+                raise ValueError("Error opening camera %s" % self.source)
+            capture.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+            capture.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+            self.reader = LatestFrame(capture)
+        else:
+            self.reader = FrameReader(self.source,
+                                      width=self.width,
+                                      height=self.height)
+            self.fps = self.reader.fps or self.fps
+
+
+    def read(self):
+        """Next BGR frame and its capture time (None at the end)"""
+        if self.camera:
+            frame, capture_time = self.reader.read()
+        else:
+            frame = self.reader.frames.get()
+            capture_time = time.time()
+        size = (self.height, self.width)
+        if frame is not None and frame.shape[:2] != size:
+            frame = cv2.resize(frame, (self.width, self.height))
+        return frame, capture_time
+
+
+    def capture(self, requests, stop):
+        """Capture thread: put (stream, frame, capture time) in the
+        request queue shared by all streams"""
+        while not stop.is_set():
+            # a stream does not fill the request queue ahead of others
+            if not self.pending.acquire(timeout=0.1):
+                continue
+            frame, capture_time = self.read()
+            if frame is None:
+                break
+            requests.put((self, frame, capture_time))
+        # end of stream
+        requests.put((self, None, None))
+
+
+    def render(self):
+        """Renderer thread: annotate and record detected frames"""
+        videowriter = None
+        if self.filename is not None:
+            videowriter = cv2.VideoWriter(self.filename,
+                                          cv2.VideoWriter_fourcc(*'mp4v'),
+                                          self.fps,
+                                          (self.width, self.height),
+                                          isColor=True)
+        while True:
+            item = self.results.get()
+            if item is None:
+                break
+            frame, capture_time, boxes, class_ids, scores = item
+            class_names, rects = detection_labels(boxes, class_ids, scores)
+            draw_detections(frame, class_names, rects)
+            self.counter.tick(capture_time)
+            cv2.putText(frame,
+                        self.counter.text(),
+                        (10, self.height - 15),
+                        cv2.FONT_HERSHEY_DUPLEX,
+                        0.6,
+                        (0, 0, 0),
+                        1)
+            if videowriter is not None:
+                videowriter.write(frame)
+            with self.lock:
+                self.image = frame
+            self.frames += 1
+
+        if videowriter is not None:
+            videowriter.release()
+        self.done.set()
+
+
+    def take(self):
+        """Latest rendered frame not yet displayed (or None)"""
+        with self.lock:
+            image, self.image = self.image, None
+            return image
+
+
+    def stop(self):
+        """Stop and release the camera"""
+        if self.camera and not self.released:
+            self.reader.stop()
+            self.reader.capture.release()
+            self.released = True
+
+
+class MultiStreamDetector():
+    """Object detection on several cameras or video files w/ one
+    shared model. Frames of all streams go to one request queue and
+    are detected in dynamic batches: a batch is sent to the model
+    when it is full or max_latency after its first frame is captured.
+    Detections are fanned out to per stream renderers/recorders.
+
+    Arguments:
+        detector (SSD): Object detector w/ detect_batch()
+        sources (list): Camera indexes or video files or directories
+        batch_size (int): Max number of frames per model call
+        max_latency (float): Max wait in seconds since the capture of 
+            the 1st frame of a batch to fill the batch
+        width, height (int): Model input size
+        filenames (list): Annotated output video per stream
+            (None to skip)
+        display (bool): Show the streams in windows
+    """
+    def __init__(self,
+                 detector,
+                 sources,
+                 batch_size=4,
+                 max_latency=0.05,
+                 width=640,
+                 height=480,
+                 filenames=None,
+                 display=True):
+        self.detector = detector
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.display = display
+        if filenames is None:
+            filenames = [None] * len(sources)
+        # room for the frames of a stream in 2 batches, video files
+        # have at most a batch waiting for inference
+        self.streams = [Stream(i,
+                               source,
+                               width=width,
+                               height=height,
+                               filename=filename,
+                               queue_size=2 * batch_size,
+                               max_pending=batch_size)
+                        for i, (source, filename)
+                        in enumerate(zip(sources, filenames))]
+        self.requests = queue.Queue(maxsize=2 * batch_size)
+        # streams w/o end of stream
+        self.active = len(self.streams)
+        self.batches = 0
+        self.batched = 0
+
+
+    def collect(self):
+        """Dynamic batch of up to batch_size frames of any stream
+
+        Returns:
+            batch (list): (stream, frame, capture time) items, empty
+                at the end of all streams
+        """
+        batch = []
+        deadline = None
+        while self.active > 0 and len(batch) < self.batch_size:
+            timeout = None
+            if deadline is not None:
+                # past the deadline, only frames already waiting 
+                # are added
+                timeout = max(deadline - time.time(), 0)
+            try:
+                stream, frame, capture_time = \
+                        self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if frame is None:
+                self.active -= 1
+                continue
+            stream.pending.release()
+            batch.append((stream, frame, capture_time))
+            if deadline is None:
+                # the 1st frame waits at most max_latency since its
+                # capture, including its time in the request queue
+                deadline = capture_time + self.max_latency
+        return batch
+
+
+    def infer(self):
+        """Inference thread: detect batches and fan out detections"""
+        while True:
+            batch = self.collect()
+            if not batch:
+                break
+            images = np.stack([cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                               for _, frame, _ in batch])
+            images = images.astype(np.float32) / 255.0
+            boxes, class_ids, scores, valid_counts = \
+                    self.detector.detect_batch(images)
+            for i, (stream, frame, capture_time) in enumerate(batch):
+                n = valid_counts[i]
+                item = (frame,
+                        capture_time,
+                        boxes[i, :n],
+                        class_ids[i, :n],
+                        scores[i, :n])
+                if not stream.camera:
+                    # video files are recorded w/o dropping frames
+                    stream.results.put(item)
+                elif put_latest(stream.results, item):
+                    # a slow camera renderer drops its stale detections 
+                    # instead of stalling the other streams
+                    stream.stale += 1
+            self.batches += 1
+            self.batched += len(batch)
+
+        for stream in self.streams:
+            stream.results.put(None)
+
+
+    def run(self):
+        """Run all streams until they end (or q is pressed)"""
+        start_time = time.time()
+        stop = threading.Event()
+        threads = []
+        for stream in self.streams:
+            stream.open()
+            threads.append(threading.Thread(target=stream.capture,
+                                            args=(self.requests, stop),
+                                            daemon=True))
+            threads.append(threading.Thread(target=stream.render,
+                                            daemon=True))
+        inference = threading.Thread(target=self.infer, daemon=True)
+        threads.append(inference)
+        for thread in threads:
+            thread.start()
+
+        # windows are updated by the main thread
+        while not all(stream.done.is_set() for stream in self.streams):
+            if not self.display:
+                time.sleep(0.1)
+                continue
+            for stream in self.streams:
+                image = stream.take()
+                if image is not None:
+                    cv2.imshow("stream %d" % stream.index, image)
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                stop.set()
+                for stream in self.streams:
+                    stream.stop()
+
+        stop.set()
+        for stream in self.streams:
+            stream.stop()
+        inference.join()
+        if self.display:
+            cv2.destroyAllWindows()
+
+        # frames of a batch are rendered in bursts, use mean rates
+        elapsed = max(time.time() - start_time, 1e-6)
+        for stream in self.streams:
+            print("Stream %d (%s): %d frames, %0.1f FPS %0.0fms, %d stale"
+                  % (stream.index,
+                     stream.source,
+                     stream.frames,
+                     stream.frames / elapsed,
+                     1000 * stream.counter.latency,
+                     stream.stale))
+        print("%d batches, mean batch size %0.1f"
+              % (self.batches, self.batched / max(self.batches, 1)))
+
+
 if __name__ == '__main__':
     parser = ssd_parser()
     help_ = "Camera index"
@@ -176,6 +987,87 @@ if __name__ == '__main__':
     parser.add_argument("--filename",
                         default="demo.mp4",
                         help=help_)
+    help_ = "Pipelined capture, inference and render/record threads"
+    parser.add_argument("--pipeline",
+                        default=False,
+                        action='store_true', 
+                        help=help_)
+    help_ = "Run the detector every N frames and track objects in between"
+    parser.add_argument("--detect-every",
+                        default=1,
+                        type=int,
+                        help=help_)
+    help_ = "Detect before N frames if a track confidence is lower"
+    parser.add_argument("--track-min-confidence",
+                        default=0.5,
+                        type=float,
+                        help=help_)
+    help_ = "Refine tracked boxes w/ optical flow"
+    parser.add_argument("--optical-flow",
+                        default=False,
+                        action='store_true', 
+                        help=help_)
+    help_ = "Skip inference and reuse the last detections on static frames"
+    parser.add_argument("--motion-gate",
+                        default=False,
+                        action='store_true', 
+                        help=help_)
+    help_ = "Min fraction of changed pixels to run inference"
+    parser.add_argument("--motion-threshold",
+                        default=0.01,
+                        type=float,
+                        help=help_)
+    help_ = "Min gray level difference of a changed pixel"
+    parser.add_argument("--motion-pixel-threshold",
+                        default=25,
+                        type=int,
+                        help=help_)
+    help_ = "Detect on a crop around the changed region (w/o tracking)"
+    parser.add_argument("--motion-crops",
+                        default=False,
+                        action='store_true', 
+                        help=help_)
+    help_ = "Video file or directory of frames for headless detection"
+    parser.add_argument("--video",
+                        default=None,
+                        help=help_)
+    help_ = "Annotated output video of headless detection"
+    parser.add_argument("--output",
+                        default=None,
+                        help=help_)
+    help_ = "JSONL file of detections per frame of headless detection"
+    parser.add_argument("--detections",
+                        default=None,
+                        help=help_)
+    help_ = "Number of frames per model call of headless detection"
+    parser.add_argument("--video-batch-size",
+                        default=8,
+                        type=int,
+                        help=help_)
+    help_ = "Comma separated camera indexes or video files sharing one model"
+    parser.add_argument("--streams",
+                        default=None,
+                        help=help_)
+    help_ = "Max number of frames of all streams per model call"
+    parser.add_argument("--stream-batch-size",
+                        default=4,
+                        type=int,
+                        help=help_)
+    help_ = "Max wait in ms to fill a batch of frames of all streams"
+    parser.add_argument("--max-latency",
+                        default=50.0,
+                        type=float,
+                        help=help_)
+    help_ = "Do not show the streams in windows"
+    parser.add_argument("--headless",
+                        default=False,
+                        action='store_true', 
+                        help=help_)
+    help_ = "Output frame rate of a directory of frames"
+    parser.add_argument("--fps",
+                        default=10.0,
+                        type=float,
+                        help=help_)
 
     args = parser.parse_args()
 
@@ -183,8 +1075,56 @@ if __name__ == '__main__':
 
     if args.restore_weights:
         ssd.restore_weights()
+
+    # trained weights or a TFLite model
+    if (args.restore_weights or args.tflite) and args.streams:
+        sources = args.streams.split(",")
+        filenames = None
+        if args.record:
+            # eg demo-0.mp4, demo-1.mp4
+            root, ext = os.path.splitext(args.filename)
+            filenames = ["%s-%d%s" % (root, i, ext)
+                         for i in range(len(sources))]
+        detector = MultiStreamDetector(ssd,
+                                       sources,
+                                       batch_size=args.stream_batch_size,
+                                       max_latency=args.max_latency / 1000,
+                                       width=args.width,
+                                       height=args.height,
+                                       filenames=filenames,
+                                       display=not args.headless)
+        detector.run()
+    elif (args.restore_weights or args.tflite) and args.video:
+        detector = VideoFileDetector(ssd,
+                                     args.video,
+                                     output=args.output,
+                                     detections=args.detections,
+                                     batch_size=args.video_batch_size,
+                                     width=args.width,
+                                     height=args.height,
+                                     fps=args.fps)
+        detector.run()
+    elif args.restore_weights or args.tflite:
+        tracking = None
+        if args.detect_every > 1:
+            tracker = IoUTracker(optical_flow=args.optical_flow)
+            tracking = DetectEveryN(ssd,
+                                    every=args.detect_every,
+                                    min_confidence=args.track_min_confidence,
+                                    tracker=tracker)
+        motion_gate = None
+        if args.motion_gate:
+            motion_gate = MotionGate(
+                    threshold=args.motion_threshold,
+                    pixel_threshold=args.motion_pixel_threshold)
         videodemo = VideoDemo(detector=ssd,
                               camera=args.camera,
                               record=args.record,
-                              filename=args.filename)
-        videodemo.loop()
+                              filename=args.filename,
+                              tracking=tracking,
+                              motion_gate=motion_gate,
+                              motion_crops=args.motion_crops)
+        if args.pipeline:
+            videodemo.pipeline()
+        else:
+            videodemo.loop()